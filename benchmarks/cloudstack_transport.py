@@ -0,0 +1,66 @@
+# Copyright 2016 hm authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""Requests per second of the CloudStack client against a local stub
+CloudStack API, with and without the pooled keep-alive transport.
+
+    python benchmarks/cloudstack_transport.py [requests]
+"""
+
+import BaseHTTPServer
+import SocketServer
+import sys
+import threading
+import time
+
+from hm.iaas import cloudstack_client, transport
+
+
+class StubCloudStackHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    wbufsize = -1
+    body = '{"queryasyncjobresultresponse": {"jobstatus": 1, "jobresult": {}}}'
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubCloudStackServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def run(client, requests):
+    start = time.time()
+    for i in range(requests):
+        client.queryAsyncJobResult({"jobid": str(i)})
+    return requests / (time.time() - start)
+
+
+def main(requests):
+    server = StubCloudStackServer(("127.0.0.1", 0), StubCloudStackHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = "http://127.0.0.1:{}/client/api".format(server.server_address[1])
+    pooled_transport = transport.PooledTransport()
+    try:
+        plain = cloudstack_client.CloudStack(url, "key", "secret")
+        pooled = cloudstack_client.CloudStack(url, "key", "secret", pooled_transport)
+        print "without pooling: {:.0f} req/s".format(run(plain, requests))
+        print "with pooling:    {:.0f} req/s".format(run(pooled, requests))
+    finally:
+        pooled_transport.close()
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
@@ -0,0 +1,42 @@
+# Copyright 2016 hm authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""Cost of lb_managers.by_name for the cloudstack manager, building a new
+manager on every call and reusing the cached instance.
+
+    python benchmarks/manager_by_name.py [calls]
+"""
+
+import sys
+import time
+
+from hm import lb_managers
+from hm.lb_managers import cloudstack  # noqa
+
+conf = {
+    "CLOUDSTACK_API_URL": "http://localhost:8080/client/api",
+    "CLOUDSTACK_API_KEY": "key",
+    "CLOUDSTACK_SECRET_KEY": "secret",
+    "CLOUDSTACK_LB_NETWORK_ID": "net-1",
+    "CLOUDSTACK_LB_PORT_MAPPING": "80:8080",
+    "CLOUDSTACK_PROJECT_ID": "project-1",
+}
+
+
+def run(calls, cached):
+    start = time.time()
+    for i in range(calls):
+        if not cached:
+            lb_managers.clear_cache()
+        lb_managers.by_name("cloudstack", conf)
+    return (time.time() - start) / calls * 1e6
+
+
+def main(calls):
+    print "uncached: {:.1f} us/call".format(run(calls, False))
+    print "cached:   {:.1f} us/call".format(run(calls, True))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -0,0 +1,47 @@
+# Copyright 2016 hm authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""Memory used by Host objects loaded from documents shaped like the ones
+MongoDBStorage reads, measured by the growth of the process RSS.
+
+    python benchmarks/model_memory.py [hosts]
+"""
+
+import gc
+import resource
+import sys
+
+from hm.model.host import Host
+
+
+def rss_kb():
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def document(i):
+    return {
+        "_id": "vm-{:08d}".format(i),
+        "dns_name": "10.{}.{}.{}".format(i >> 16 & 255, i >> 8 & 255, i & 255),
+        "manager": "cloudstack",
+        "group": "group-{}".format(i % 100),
+        "alternative_id": i % 3,
+    }
+
+
+def main(count):
+    documents = [document(i) for i in range(count)]
+    gc.collect()
+    before = rss_kb()
+    hosts = [Host.from_dict(doc) for doc in documents]
+    gc.collect()
+    used = rss_kb() - before
+    print "{} hosts: {:.1f} MB, {:.0f} bytes/host".format(len(hosts), used / 1024.0, used * 1024.0 / count)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,53 @@
+# Copyright 2016 hm authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""Host.list latency and open MongoDB connections under repeated calls,
+with the shared client registry and with a new client per storage, as hm
+did before. Needs a MongoDB server at MONGO_URI.
+
+    python benchmarks/mongodb_storage.py [calls]
+"""
+
+import sys
+import time
+
+from hm import storage
+from hm.model.host import Host
+
+
+def open_connections():
+    stor = storage.MongoDBStorage()
+    return stor.db.command("serverStatus")["connections"]["current"]
+
+
+def run(calls, shared):
+    storage.close()
+    before = open_connections()
+    start = time.time()
+    for i in range(calls):
+        if not shared:
+            storage.reset()
+        Host.list({"group": "benchmark"})
+    elapsed = time.time() - start
+    time.sleep(1)
+    return elapsed / calls * 1000, open_connections() - before
+
+
+def main(calls):
+    stor = storage.MongoDBStorage()
+    stor._hosts_collection().remove({"group": "benchmark"})
+    stor.store_hosts([Host("bench-{}".format(i), "10.0.0.{}".format(i), group="benchmark")
+                      for i in range(10)])
+    try:
+        for name, shared in (("new client per call", False), ("shared client", True)):
+            latency, connections = run(calls, shared)
+            print "{:<20} {:.2f} ms/call, {} new connections".format(name, latency, connections)
+    finally:
+        storage.close()
+        storage.MongoDBStorage()._hosts_collection().remove({"group": "benchmark"})
+        storage.close()
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
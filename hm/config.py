@@ -2,13 +2,19 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import collections
+import hashlib
 import os
+import re
+import threading
 
 
 undefined = object()
 
 
 def get_config(name, default=undefined, config=None):
+    if isinstance(config, ConfigSnapshot):
+        return config.value(name, default)
     try:
         value = (config or {}).get(name)
         if value is None:
@@ -22,3 +28,154 @@ def get_config(name, default=undefined, config=None):
 
 class MissConfigurationError(Exception):
     pass
+
+
+_indexed_name = re.compile(r"^(.+)_(\d+)$")
+
+
+class ConfigSnapshot(collections.Mapping):
+    """Immutable view of a config dict over the environment, resolved once.
+    Values in the dict take precedence over environment variables, like in
+    get_config. Names ending in _<n> are also indexed by their base name,
+    for alternative configs and numbered lists."""
+
+    __slots__ = ("_values", "_indexed", "_lists", "_hash")
+
+    def __init__(self, conf=None, environ=None):
+        values = dict(os.environ if environ is None else environ)
+        values.update((k, v) for k, v in (conf or {}).items() if v is not None)
+        indexed = collections.defaultdict(dict)
+        for name, value in values.items():
+            match = _indexed_name.match(name)
+            if match:
+                indexed[match.group(1)][int(match.group(2))] = value
+        lists = {}
+        for name, variants in indexed.items():
+            items = []
+            while variants.get(len(items)):
+                items.append(variants[len(items)])
+            if items:
+                lists[name] = tuple(items)
+        object.__setattr__(self, "_values", values)
+        object.__setattr__(self, "_indexed", dict(indexed))
+        object.__setattr__(self, "_lists", lists)
+        object.__setattr__(self, "_hash", None)
+
+    def value(self, name, default=undefined):
+        value = self._values.get(name)
+        if value is None:
+            if default is not undefined:
+                return default
+            raise MissConfigurationError("env var {} is required".format(name))
+        return value
+
+    def alternate(self, name, alternative_id, default=None):
+        """Returns name_<alternative_id>, falling back to name."""
+        value = self._indexed.get(name, {}).get(int(alternative_id))
+        if value is not None:
+            return value
+        return self.value(name, default)
+
+    def indexed_list(self, name):
+        """Returns the values of name_0, name_1, ... up to the first missing
+        or empty one."""
+        return self._lists.get(name, ())
+
+    def get_int(self, name, default=undefined):
+        return int(self.value(name, default))
+
+    def get_float(self, name, default=undefined):
+        return float(self.value(name, default))
+
+    def get_bool(self, name, default=undefined):
+        value = self.value(name, default)
+        return value is True or value in ["true", "True", "1"]
+
+    def get_list(self, name, default=undefined, sep=","):
+        value = self.value(name, default)
+        if not value:
+            return []
+        return value.split(sep)
+
+    def __getitem__(self, name):
+        return self._values[name]
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __getattr__(self, name):
+        try:
+            return self._values[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("config snapshots are immutable")
+
+    def __hash__(self):
+        if self._hash is None:
+            object.__setattr__(self, "_hash", hash(freeze(self._values)))
+        return self._hash
+
+
+def freeze(value):
+    """Returns a hashable snapshot of a config value, used to key objects
+    built from a config dict by its contents."""
+    if isinstance(value, dict):
+        return tuple(sorted((k, freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple, set, frozenset)):
+        items = [freeze(v) for v in value]
+        if isinstance(value, (set, frozenset)):
+            items.sort()
+        return (type(value).__name__, tuple(items))
+    try:
+        hash(value)
+    except TypeError:
+        return repr(value)
+    return value
+
+
+def fingerprint(settings, prefixes=None, exclude=()):
+    """Returns a digest of the settings whose names start with one of
+    prefixes, or of all of them when prefixes is None, leaving out the ones
+    starting with any of exclude."""
+    prefixes = tuple(prefixes) if prefixes is not None else ("",)
+    items = sorted((k, freeze(v)) for k, v in settings.items()
+                   if k.startswith(prefixes) and not k.startswith(tuple(exclude)))
+    return hashlib.sha1(repr(items)).hexdigest()
+
+
+class InstanceCache(object):
+    """Bounded LRU cache of objects built from a name and a config dict.
+    Entries are keyed by the config contents and the environment, which
+    instances may read settings missing from the dict from, so changing
+    either builds a new instance. Each instance gets its own copy of the
+    config."""
+
+    def __init__(self, max_size=64):
+        self.max_size = max_size
+        self._instances = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, name, conf, factory):
+        key = (name, freeze(conf or {}), frozenset(os.environ.items()))
+        with self._lock:
+            instance = self._instances.pop(key, None)
+            if instance is not None:
+                self._instances[key] = instance
+                return instance
+        instance = factory(dict(conf) if conf else None)
+        with self._lock:
+            self._instances[key] = instance
+            while len(self._instances) > self.max_size:
+                self._instances.popitem(last=False)
+        return instance
+
+    def clear(self, name=None):
+        with self._lock:
+            for key in list(self._instances):
+                if name is None or key[0] == name:
+                    del self._instances[key]
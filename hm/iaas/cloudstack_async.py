@@ -0,0 +1,201 @@
+# Copyright 2016 hm authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import functools
+import heapq
+import itertools
+import sys
+import threading
+import time
+import types
+
+from concurrent import futures
+
+from hm import config, log
+from hm.iaas import polling
+from hm.iaas.cloudstack_client import CloudStack, AsyncJobError, JOB_PENDING, JOB_ERROR
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor(conf=None):
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            workers = int(config.get_config("CLOUDSTACK_ASYNC_WORKERS", 20, conf))
+            _executor = futures.ThreadPoolExecutor(max_workers=workers)
+        return _executor
+
+
+class Return(Exception):
+
+    def __init__(self, value=None):
+        super(Return, self).__init__(value)
+        self.value = value
+
+
+def coroutine(fn):
+    """Runs a generator function yielding futures, resuming it with each
+    future's result once it is done, without holding a thread while waiting.
+    The call returns a future with the value given to Return."""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        future = futures.Future()
+        try:
+            gen = fn(*args, **kwargs)
+        except Return as r:
+            future.set_result(r.value)
+            return future
+        except Exception:
+            future.set_exception_info(*sys.exc_info()[1:])
+            return future
+        if not isinstance(gen, types.GeneratorType):
+            future.set_result(gen)
+            return future
+        _step(gen, future, None, None)
+        return future
+    return wrapper
+
+
+def _step(gen, future, value, exc_info):
+    try:
+        if exc_info:
+            yielded = gen.throw(*exc_info)
+        else:
+            yielded = gen.send(value)
+    except StopIteration:
+        future.set_result(None)
+        return
+    except Return as r:
+        future.set_result(r.value)
+        return
+    except Exception:
+        future.set_exception_info(*sys.exc_info()[1:])
+        return
+    if isinstance(yielded, list):
+        yielded = gather(yielded)
+
+    def resume(done):
+        try:
+            result = done.result()
+        except Exception:
+            _step(gen, future, None, sys.exc_info())
+        else:
+            _step(gen, future, result, None)
+    yielded.add_done_callback(resume)
+
+
+def gather(fs):
+    """Returns a future with the list of results of fs, failing with the
+    first exception found once all of them are done."""
+    future = futures.Future()
+    if not fs:
+        future.set_result([])
+        return future
+    pending = [len(fs)]
+    lock = threading.Lock()
+
+    def done(_):
+        with lock:
+            pending[0] -= 1
+            if pending[0]:
+                return
+        for f in fs:
+            exc, tb = f.exception_info()
+            if exc is not None:
+                future.set_exception_info(exc, tb)
+                return
+        future.set_result([f.result() for f in fs])
+    for f in fs:
+        f.add_done_callback(done)
+    return future
+
+
+class _Scheduler(object):
+
+    def __init__(self):
+        self._queue = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def call_later(self, delay, fn, *args):
+        with self._cond:
+            heapq.heappush(self._queue, (time.time() + delay, next(self._counter), fn, args))
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="hm-cloudstack-scheduler")
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    now = time.time()
+                    if self._queue and self._queue[0][0] <= now:
+                        _, _, fn, args = heapq.heappop(self._queue)
+                        break
+                    timeout = self._queue[0][0] - now if self._queue else None
+                    self._cond.wait(timeout)
+            try:
+                fn(*args)
+            except:
+                log.exception("error running scheduled call")
+
+
+scheduler = _Scheduler()
+
+
+class AsyncCloudStack(CloudStack):
+    """CloudStack client whose commands return futures. Requests run in a
+    shared thread pool and wait_for_job polls through a timer, so waiting
+    for a job holds no thread between polls."""
+
+    def __init__(self, api_url, api_key, secret, transport=None, executor=None):
+        super(AsyncCloudStack, self).__init__(api_url, api_key, secret, transport)
+        self.executor = executor or get_executor()
+
+    def make_request(self, command, args, response_key=None):
+        return self.executor.submit(super(AsyncCloudStack, self).make_request,
+                                    command, args, response_key)
+
+    def wait_for_job(self, job_id, policy):
+        policy = polling.as_policy(policy)
+        command = self._job_command(job_id)
+        if self.job_watcher is not None:
+            return self.job_watcher.watch(job_id, policy, command)
+        future = futures.Future()
+        self._schedule_poll(future, job_id, policy, policy.schedule(command), command)
+        return future
+
+    def _schedule_poll(self, future, job_id, policy, schedule, command):
+        delay = schedule.next_delay()
+        if delay is None:
+            future.set_exception(schedule.timeout_error(job_id))
+            return
+        scheduler.call_later(delay, self._poll_job, future, job_id, policy, schedule, command)
+
+    def _poll_job(self, future, job_id, policy, schedule, command):
+        poll = self.queryAsyncJobResult({"jobid": job_id})
+        poll.add_done_callback(
+            lambda done: self._job_polled(done, future, job_id, policy, schedule, command))
+
+    def _job_polled(self, done, future, job_id, policy, schedule, command):
+        exc, tb = done.exception_info()
+        if exc is not None:
+            future.set_exception_info(exc, tb)
+            return
+        result = done.result()
+        status = result["jobstatus"]
+        if status == JOB_PENDING:
+            self._schedule_poll(future, job_id, policy, schedule, command)
+            return
+        if status == JOB_ERROR:
+            future.set_exception(AsyncJobError("async job error: {}".format(result)))
+            return
+        policy.observe(command, schedule.elapsed())
+        future.set_result(result)
@@ -2,13 +2,16 @@
 # Source: http://goo.gl/KQUeMd
 
 import base64
+import collections
 import hmac
 import hashlib
 import json
+import threading
 import urllib
 import time
 
 from hm import log
+from hm.iaas import polling
 
 
 JOB_PENDING = 0
@@ -18,39 +21,46 @@ JOB_ERROR = 2
 
 class CloudStack(object):
 
-    def __init__(self, api_url, api_key, secret):
+    def __init__(self, api_url, api_key, secret, transport=None):
         self.api_url = api_url
         self.api_key = api_key
         self.secret = secret
+        self.transport = transport
+        self.job_watcher = None
+        self.job_commands = collections.OrderedDict()
+        self._job_commands_lock = threading.Lock()
 
     def encode_user_data(self, data):
         return base64.b64encode(data)
 
     def request(self, args):
+        self.value = self.signed_url(args)
+
+    def signed_url(self, args):
         args["apiKey"] = self.api_key
-        self.params = []
-        self.sig_params = []
-        self._sort_request(args)
-        self._create_signature()
-        self._build_post_request()
+        params, sig_params = self._sort_request(args)
+        signature = self._create_signature(sig_params)
+        return self._build_post_request(params, signature)
 
     def _sort_request(self, args):
+        params = []
+        sig_params = []
         keys = sorted(args.keys())
         for key in keys:
-            self.sig_params.append(
+            sig_params.append(
                 key.lower() + "=" + urllib.quote_plus(args[key]).lower().replace('+', '%20'))
-            self.params.append(key + "=" + urllib.quote_plus(args[key]))
+            params.append(key + "=" + urllib.quote_plus(args[key]))
+        return params, sig_params
 
-    def _create_signature(self):
-        self.query = "&".join(self.params)
-        self.sig_query = "&".join(self.sig_params)
-        digest = hmac.new(self.secret, msg=self.sig_query,
+    def _create_signature(self, sig_params):
+        sig_query = "&".join(sig_params)
+        digest = hmac.new(self.secret, msg=sig_query,
                           digestmod=hashlib.sha1).digest()
-        self.signature = base64.b64encode(digest)
+        return base64.b64encode(digest)
 
-    def _build_post_request(self):
-        self.query += "&signature=" + urllib.quote_plus(self.signature)
-        self.value = self.api_url + "?" + self.query
+    def _build_post_request(self, params, signature):
+        query = "&".join(params) + "&signature=" + urllib.quote_plus(signature)
+        return self.api_url + "?" + query
 
     def __getattr__(self, name):
         def handler(*args, **kwargs):
@@ -60,14 +70,16 @@ class CloudStack(object):
         return handler
 
     def _http_get(self, url):
+        if self.transport is not None:
+            return self.transport.get(url)
         response = urllib.urlopen(url)
         return response.read()
 
     def make_request(self, command, args, response_key=None):
         args["response"] = "json"
         args["command"] = command
-        self.request(args)
-        data = self._http_get(self.value)
+        url = self.signed_url(args)
+        data = self._http_get(url)
         key = command.lower() + "response"
         rsp_data = json.loads(data)
         response = rsp_data.get(key)
@@ -76,25 +88,41 @@ class CloudStack(object):
             response = rsp_data.get(key)
         if response is None or 'errorcode' in response:
             raise InvalidResponse("Invalid response running '{} {}': {}".format(command, args, data))
-        log.debug("GET {}: {}".format(self.value, response))
+        log.debug("GET {}: {}".format(url, response))
+        if isinstance(response, dict) and response.get("jobid"):
+            self._remember_job(response["jobid"], command)
         return response
 
-    def wait_for_job(self, job_id, max_tries):
-        status = JOB_PENDING
-        tries = 0
-        result = None
-        while tries < max_tries:
+    def _remember_job(self, job_id, command):
+        with self._job_commands_lock:
+            self.job_commands[job_id] = command
+            while len(self.job_commands) > 1000:
+                self.job_commands.popitem(last=False)
+
+    def _job_command(self, job_id):
+        with self._job_commands_lock:
+            return self.job_commands.pop(job_id, None)
+
+    def wait_for_job(self, job_id, policy):
+        policy = polling.as_policy(policy)
+        command = self._job_command(job_id)
+        if self.job_watcher is not None:
+            return self.job_watcher.wait_for_job(job_id, policy, command)
+        schedule = policy.schedule(command)
+        while True:
+            delay = schedule.next_delay()
+            if delay is None:
+                raise schedule.timeout_error(job_id)
+            if delay:
+                time.sleep(delay)
             result = self.queryAsyncJobResult({"jobid": job_id})
             status = result["jobstatus"]
-            if status != JOB_PENDING:
-                break
-            time.sleep(1)
-            tries += 1
-        if status == JOB_PENDING:
-            raise MaxTryWaitingForJobError(max_tries, job_id)
-        if status == JOB_ERROR:
-            raise AsyncJobError("async job error: {}".format(result))
-        return result
+            if status == JOB_PENDING:
+                continue
+            if status == JOB_ERROR:
+                raise AsyncJobError("async job error: {}".format(result))
+            policy.observe(command, schedule.elapsed())
+            return result
 
 
 class AsyncJobError(Exception):
@@ -112,3 +140,13 @@ class MaxTryWaitingForJobError(Exception):
         self.job_id = job_id
         msg = "exceeded {0} tries waiting for job {1}".format(max_tries, job_id)
         super(MaxTryWaitingForJobError, self).__init__(msg)
+
+
+class JobDeadlineExceededError(MaxTryWaitingForJobError):
+
+    def __init__(self, deadline, job_id):
+        self.max_tries = None
+        self.deadline = deadline
+        self.job_id = job_id
+        msg = "exceeded {0} seconds waiting for job {1}".format(deadline, job_id)
+        Exception.__init__(self, msg)
@@ -0,0 +1,188 @@
+# Copyright 2016 hm authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import threading
+import time
+
+from concurrent import futures
+
+from hm import config, log
+from hm.iaas import polling
+from hm.iaas.cloudstack_client import CloudStack, AsyncJobError, InvalidResponse, JOB_PENDING, JOB_ERROR
+
+
+_watchers = {}
+_watchers_lock = threading.Lock()
+
+
+def from_config(client, conf=None):
+    """Returns the shared watcher for client's account when
+    CLOUDSTACK_JOB_WATCHER is enabled, None otherwise."""
+    if config.get_config("CLOUDSTACK_JOB_WATCHER", "false", conf) not in ["true", "True", "1"]:
+        return None
+    interval = float(config.get_config("CLOUDSTACK_JOB_WATCHER_INTERVAL", 1, conf))
+    return get_watcher(client, interval)
+
+
+def get_watcher(client, interval=1):
+    key = (client.api_url, client.api_key)
+    with _watchers_lock:
+        watcher = _watchers.get(key)
+        if watcher is None:
+            watcher = _watchers[key] = JobWatcher(
+                CloudStack(client.api_url, client.api_key, client.secret, client.transport), interval)
+            watcher.start()
+        return watcher
+
+
+class _Watch(object):
+
+    def __init__(self, job_id, policy, command):
+        self.job_id = job_id
+        self.policy = policy
+        self.command = command
+        self.schedule = policy.schedule(command)
+        self.due = None
+        self.future = futures.Future()
+
+    def reschedule(self, now):
+        delay = self.schedule.next_delay()
+        if delay is None:
+            return False
+        self.due = now + delay
+        return True
+
+
+class JobWatcher(object):
+    """Polls every registered async job due for polling in a single pass,
+    using one listAsyncJobs call when the API supports it and
+    queryAsyncJobResult only for jobs missing from its response. Passes are
+    at least interval seconds apart, so jobs due close together share one.
+    listAsyncJobs is given up only after list_jobs_attempts consecutive
+    invalid responses; errors querying a job count as one of its tries."""
+
+    def __init__(self, client, interval=1, list_jobs_attempts=3):
+        self.client = client
+        self.interval = interval
+        self.list_jobs_attempts = list_jobs_attempts
+        self.use_list_jobs = True
+        self._list_jobs_failures = 0
+        self._watches = {}
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        with self._cond:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="hm-cloudstack-job-watcher")
+                self._thread.daemon = True
+                self._thread.start()
+
+    def watch(self, job_id, policy, command=None):
+        w = _Watch(job_id, polling.as_policy(policy), command)
+        if not w.reschedule(time.time()):
+            w.future.set_exception(w.schedule.timeout_error(job_id))
+            return w.future
+        with self._cond:
+            self._watches.setdefault(job_id, []).append(w)
+            self._cond.notify()
+        return w.future
+
+    def wait_for_job(self, job_id, policy, command=None):
+        return self.watch(job_id, policy, command).result()
+
+    def poll(self, now=None):
+        now = now or time.time()
+        with self._cond:
+            job_ids = [job_id for job_id, watches in self._watches.items()
+                       if any(w.due <= now for w in watches)]
+        if not job_ids:
+            return
+        results, errors = self._query(job_ids)
+        now = time.time()
+        finished = []
+        with self._cond:
+            for job_id in job_ids:
+                watches = self._watches.pop(job_id, [])
+                pending = []
+                for w in watches:
+                    try:
+                        outcome = self._outcome(w, results.get(job_id), errors.get(job_id), now)
+                    except Exception as e:
+                        outcome = None, e
+                    if outcome is None:
+                        pending.append(w)
+                    else:
+                        finished.append((w, outcome))
+                if pending:
+                    self._watches[job_id] = pending
+        for w, (result, error) in finished:
+            if error is not None:
+                w.future.set_exception(error)
+            else:
+                w.future.set_result(result)
+
+    def _outcome(self, w, result, error, now):
+        if error is not None:
+            if w.reschedule(now):
+                return None
+            return None, error
+        status = result["jobstatus"]
+        if status == JOB_PENDING:
+            if w.reschedule(now):
+                return None
+            return None, w.schedule.timeout_error(w.job_id)
+        if status == JOB_ERROR:
+            return None, AsyncJobError("async job error: {}".format(result))
+        w.policy.observe(w.command, w.schedule.elapsed())
+        return result, None
+
+    def _query(self, job_ids):
+        results = {}
+        errors = {}
+        if self.use_list_jobs:
+            try:
+                rsp = self.client.listAsyncJobs({"listall": "true"})
+                wanted = set(job_ids)
+                for job in rsp.get("asyncjobs", []):
+                    if job.get("jobid") in wanted:
+                        results[job["jobid"]] = job
+                self._list_jobs_failures = 0
+            except InvalidResponse:
+                self._list_jobs_failures += 1
+                if self._list_jobs_failures >= self.list_jobs_attempts:
+                    log.exception("listAsyncJobs unavailable, polling jobs one by one")
+                    self.use_list_jobs = False
+                else:
+                    log.exception("error listing async jobs, polling jobs one by one")
+            except Exception:
+                log.exception("error listing async jobs, polling jobs one by one")
+        for job_id in job_ids:
+            if job_id in results:
+                continue
+            try:
+                results[job_id] = self.client.queryAsyncJobResult({"jobid": job_id})
+            except Exception as e:
+                errors[job_id] = e
+        return results, errors
+
+    def _run(self):
+        last_poll = 0
+        while True:
+            with self._cond:
+                while True:
+                    now = time.time()
+                    due = [w.due for watches in self._watches.values() for w in watches]
+                    if not due:
+                        self._cond.wait()
+                        continue
+                    poll_at = max(min(due), last_poll + self.interval)
+                    if poll_at <= now:
+                        break
+                    self._cond.wait(poll_at - now)
+            last_poll = time.time()
+            try:
+                self.poll(last_poll)
+            except:
+                log.exception("error polling async jobs")
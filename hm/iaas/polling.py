@@ -0,0 +1,171 @@
+# Copyright 2016 hm authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import random
+import threading
+import time
+
+from hm import config
+
+
+_policies = {}
+_policies_lock = threading.Lock()
+
+
+def from_config(conf=None):
+    """Returns the polling policy configured by CLOUDSTACK_POLLING_POLICY:
+    "max_tries" (the default, polling every second up to
+    CLOUDSTACK_MAX_TRIES times), "backoff" or "adaptive". Policies are
+    shared by every manager configured alike, so adaptive policies learn
+    from all jobs in the process."""
+    name = config.get_config("CLOUDSTACK_POLLING_POLICY", "max_tries", conf)
+    if name == "max_tries":
+        key = (name, int(config.get_config("CLOUDSTACK_MAX_TRIES", 100, conf)))
+    elif name in ("backoff", "adaptive"):
+        key = (name,
+               float(config.get_config("CLOUDSTACK_POLLING_FIRST_DELAY", 0.25, conf)),
+               float(config.get_config("CLOUDSTACK_POLLING_FACTOR", 1.5, conf)),
+               float(config.get_config("CLOUDSTACK_POLLING_MAX_DELAY", 10, conf)),
+               float(config.get_config("CLOUDSTACK_POLLING_DEADLINE", 300, conf)),
+               config.get_config("CLOUDSTACK_POLLING_JITTER", "false", conf) in ["true", "True", "1"])
+    else:
+        raise config.MissConfigurationError("invalid CLOUDSTACK_POLLING_POLICY: {}".format(name))
+    with _policies_lock:
+        policy = _policies.get(key)
+        if policy is None:
+            policy = _policies[key] = _policy_classes[name](*key[1:])
+        return policy
+
+
+def as_policy(policy):
+    if isinstance(policy, (int, long)):
+        return MaxTriesPolicy(policy)
+    return policy
+
+
+class MaxTriesPolicy(object):
+    """Compatibility policy: polls right away and then every interval
+    seconds, giving up after max_tries polls."""
+
+    def __init__(self, max_tries=100, interval=1):
+        self.max_tries = max_tries
+        self.interval = interval
+
+    def schedule(self, command=None):
+        return _MaxTriesSchedule(self)
+
+    def observe(self, command, duration):
+        pass
+
+
+class BackoffPolicy(object):
+    """Waits first_delay seconds before the first poll and grows the delay
+    by factor up to max_delay, giving up once deadline seconds have passed.
+    With jitter each delay is drawn between half and all of its value."""
+
+    def __init__(self, first_delay=0.25, factor=1.5, max_delay=10, deadline=300, jitter=False):
+        self.first_delay = first_delay
+        self.factor = factor
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.jitter = jitter
+
+    def schedule(self, command=None):
+        return _BackoffSchedule(self, self.initial_delay(command))
+
+    def initial_delay(self, command):
+        return self.first_delay
+
+    def observe(self, command, duration):
+        pass
+
+    def delay(self, attempt):
+        delay = min(self.first_delay * (self.factor ** attempt), self.max_delay)
+        if self.jitter:
+            delay = random.uniform(delay / 2, delay)
+        return delay
+
+
+class AdaptivePolicy(BackoffPolicy):
+    """Backoff policy whose first poll for each command is delayed to the
+    usual duration of that command, learned from the jobs observed so far."""
+
+    weight = 0.3
+
+    def __init__(self, *args, **kwargs):
+        super(AdaptivePolicy, self).__init__(*args, **kwargs)
+        self.durations = {}
+        self._lock = threading.Lock()
+
+    def initial_delay(self, command):
+        with self._lock:
+            duration = self.durations.get(command)
+        if duration is None:
+            return self.first_delay
+        return min(max(self.first_delay, duration * 0.9), self.deadline)
+
+    def observe(self, command, duration):
+        if command is None:
+            return
+        with self._lock:
+            current = self.durations.get(command)
+            if current is None:
+                self.durations[command] = duration
+            else:
+                self.durations[command] = current + self.weight * (duration - current)
+
+
+class _MaxTriesSchedule(object):
+
+    def __init__(self, policy):
+        self.policy = policy
+        self.tries = 0
+        self.started = time.time()
+
+    def next_delay(self):
+        if self.tries >= self.policy.max_tries:
+            return None
+        self.tries += 1
+        return 0 if self.tries == 1 else self.policy.interval
+
+    def elapsed(self):
+        return time.time() - self.started
+
+    def timeout_error(self, job_id):
+        from hm.iaas.cloudstack_client import MaxTryWaitingForJobError
+        return MaxTryWaitingForJobError(self.policy.max_tries, job_id)
+
+
+class _BackoffSchedule(object):
+
+    def __init__(self, policy, initial_delay):
+        self.policy = policy
+        self.initial_delay = initial_delay
+        self.attempt = 0
+        self.started = time.time()
+
+    def next_delay(self):
+        remaining = self.policy.deadline - self.elapsed()
+        if remaining <= 0:
+            return None
+        if self.attempt == 0:
+            delay = self.initial_delay
+        else:
+            delay = self.policy.delay(self.attempt)
+        self.attempt += 1
+        return min(delay, remaining)
+
+    def elapsed(self):
+        return time.time() - self.started
+
+    def timeout_error(self, job_id):
+        from hm.iaas.cloudstack_client import JobDeadlineExceededError
+        return JobDeadlineExceededError(self.policy.deadline, job_id)
+
+
+_policy_classes = {
+    "max_tries": MaxTriesPolicy,
+    "backoff": BackoffPolicy,
+    "adaptive": AdaptivePolicy,
+}
@@ -0,0 +1,166 @@
+# Copyright 2016 hm authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import errno
+import httplib
+import select
+import socket
+import threading
+import time
+import urlparse
+
+from hm import config
+
+
+_transports = {}
+_transports_lock = threading.Lock()
+
+
+def get_transport(conf=None):
+    """Returns the process-wide PooledTransport matching the HTTP settings
+    in conf, so every manager configured alike shares the same connections.
+    Returns None, meaning one connection per request, when
+    CLOUDSTACK_HTTP_POOL_SIZE is 0."""
+    pool_size = int(config.get_config("CLOUDSTACK_HTTP_POOL_SIZE", 10, conf))
+    if pool_size <= 0:
+        return None
+    idle_timeout = float(config.get_config("CLOUDSTACK_HTTP_IDLE_TIMEOUT", 30, conf))
+    timeout = float(config.get_config("CLOUDSTACK_HTTP_TIMEOUT", 60, conf))
+    key = (pool_size, idle_timeout, timeout)
+    with _transports_lock:
+        transport = _transports.get(key)
+        if transport is None:
+            transport = _transports[key] = PooledTransport(pool_size, idle_timeout, timeout)
+        return transport
+
+
+def close_transports():
+    with _transports_lock:
+        transports = _transports.values()
+        _transports.clear()
+    for transport in transports:
+        transport.close()
+
+
+class PooledTransport(object):
+    """HTTP GET transport keeping up to pool_size idle keep-alive connections
+    per endpoint. Connections idle for more than idle_timeout seconds are
+    discarded instead of reused; timeout applies to each request."""
+
+    def __init__(self, pool_size=10, idle_timeout=30, timeout=60):
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def get(self, url):
+        parsed = urlparse.urlsplit(url)
+        endpoint = (parsed.scheme, parsed.netloc)
+        path = parsed.path or "/"
+        if parsed.query:
+            path = "{}?{}".format(path, parsed.query)
+        conn, reused = self._acquire(endpoint)
+        try:
+            response = self._do_get(conn, path, reused)
+        except _StaleConnection:
+            conn.close()
+            conn = self._new_connection(endpoint)
+            try:
+                response = self._do_get(conn, path, False)
+            except:
+                conn.close()
+                raise
+        except:
+            conn.close()
+            raise
+        if response.will_close:
+            conn.close()
+        else:
+            self._release(endpoint, conn)
+        return response.data
+
+    def close(self):
+        with self._lock:
+            pools = self._pools.values()
+            self._pools = {}
+        for pool in pools:
+            for conn, _ in pool:
+                conn.close()
+
+    def _do_get(self, conn, path, reused):
+        """Sends the request and reads the response. Raises _StaleConnection
+        only when a reused connection failed before the server could have
+        seen the request: resetting it while we were sending or closing it
+        without a single byte of response. Anything else, timeouts
+        included, may happen after the request was processed and is not
+        safe to retry."""
+        try:
+            conn.request("GET", path, headers={"Connection": "keep-alive"})
+        except socket.timeout:
+            raise
+        except socket.error as e:
+            if reused and e.errno in (errno.ECONNRESET, errno.EPIPE):
+                raise _StaleConnection(e)
+            raise
+        try:
+            response = conn.getresponse()
+        except httplib.BadStatusLine as e:
+            if reused and _is_empty_status(e):
+                raise _StaleConnection(e)
+            raise
+        response.data = response.read()
+        return response
+
+    def _acquire(self, endpoint):
+        now = time.time()
+        stale = []
+        conn = None
+        with self._lock:
+            pool = self._pools.get(endpoint, [])
+            while pool:
+                candidate, last_used = pool.pop()
+                if now - last_used <= self.idle_timeout and not _is_dropped(candidate):
+                    conn = candidate
+                    break
+                stale.append(candidate)
+        for candidate in stale:
+            candidate.close()
+        if conn is not None:
+            return conn, True
+        return self._new_connection(endpoint), False
+
+    def _release(self, endpoint, conn):
+        with self._lock:
+            pool = self._pools.setdefault(endpoint, [])
+            if len(pool) < self.pool_size:
+                pool.append((conn, time.time()))
+                return
+        conn.close()
+
+    def _new_connection(self, endpoint):
+        scheme, netloc = endpoint
+        if scheme == "https":
+            return httplib.HTTPSConnection(netloc, timeout=self.timeout)
+        return httplib.HTTPConnection(netloc, timeout=self.timeout)
+
+
+def _is_dropped(conn):
+    """An idle keep-alive connection should have nothing to read: when its
+    socket is readable the server either closed it or sent garbage."""
+    if conn.sock is None:
+        return True
+    try:
+        return bool(select.select([conn.sock], [], [], 0)[0])
+    except (select.error, socket.error, ValueError):
+        return True
+
+
+def _is_empty_status(error):
+    line = error.line or ""
+    return line in ("", "''") or line.startswith("No status line received")
+
+
+class _StaleConnection(Exception):
+    pass
@@ -0,0 +1,193 @@
+# Copyright 2016 hm authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import contextlib
+import sys
+import threading
+import time
+import uuid
+
+from concurrent import futures
+
+from hm import config, log, model
+
+
+RUNNING = "running"
+FAILED = "failed"
+RECOVERING = "recovering"
+UNRECOVERABLE = "unrecoverable"
+
+_handlers = {}
+_local = threading.local()
+
+
+def register(kind, handler):
+    """Registers handler(operation, conf) to recover operations of kind. It
+    returns "resumed" or "rolled_back", and raises if it could do neither:
+    RollbackNotSupported when retrying would not help either."""
+    _handlers[kind] = handler
+
+
+def enabled(conf=None):
+    return config.get_config("HM_JOURNAL", "false", conf) in ["true", "True", "1"]
+
+
+class Operation(object):
+    """A journaled multi-step operation. Each completed step is stored with
+    the ids of the resources it created, so the operation can be finished
+    or undone by another process if this one dies."""
+
+    def __init__(self, storage, doc):
+        self.storage = storage
+        self.id = doc['_id']
+        self.kind = doc['kind']
+        self.manager = doc.get('manager')
+        self.params = doc.get('params', {})
+        self.steps = list(doc.get('steps', []))
+
+    def record(self, name, **data):
+        step = dict(data, name=name)
+        self.storage.add_operation_step(self.id, step, {'updated_at': time.time()})
+        self.steps.append(step)
+
+    def forget(self, name, **data):
+        """Removes the steps matching name and data, once they are undone."""
+        query = dict(data, name=name)
+        self.storage.remove_operation_step(self.id, query)
+        self.steps = [step for step in self.steps
+                      if any(step.get(k) != v for k, v in query.items())]
+
+    def step(self, name):
+        for step in reversed(self.steps):
+            if step['name'] == name:
+                return step
+        return None
+
+
+def begin(kind, manager, conf=None, **params):
+    """Starts journaling an operation in this thread, returning it, or None
+    when HM_JOURNAL is disabled. Steps recorded until end are stored."""
+    if not enabled(conf):
+        return None
+    storage = model.storage(conf)
+    doc = {'_id': uuid.uuid4().hex, 'kind': kind, 'manager': manager, 'params': params,
+           'status': RUNNING, 'steps': [], 'updated_at': time.time()}
+    storage.store_operation(doc)
+    op = Operation(storage, doc)
+    _stack().append(op)
+    return op
+
+
+def end(op, error=None):
+    """Ends op. It is removed when it succeeded or failed before recording
+    any step, and kept as failed for resume_or_rollback otherwise."""
+    if op is None:
+        return
+    stack = _stack()
+    if op in stack:
+        stack.remove(op)
+    try:
+        if error is not None and op.steps:
+            op.storage.update_operation(op.id, {'status': FAILED, 'error': str(error),
+                                                'updated_at': time.time()})
+        else:
+            op.storage.remove_operation(op.id)
+    except:
+        log.exception("error ending operation {}".format(op.id))
+
+
+@contextlib.contextmanager
+def operation(kind, manager, conf=None, **params):
+    op = begin(kind, manager, conf, **params)
+    try:
+        yield op
+    except:
+        exc_info = sys.exc_info()
+        end(op, exc_info[1])
+        raise exc_info[0], exc_info[1], exc_info[2]
+    end(op)
+
+
+def current():
+    stack = _stack()
+    return stack[-1] if stack else None
+
+
+def record(name, **data):
+    """Records a step in the operation running in this thread, if any."""
+    op = current()
+    if op is not None:
+        op.record(name, **data)
+
+
+def forget(name, **data):
+    op = current()
+    if op is not None:
+        op.forget(name, **data)
+
+
+def resume_or_rollback(conf=None, older_than=None, max_parallel=None):
+    """Recovers failed operations, and running ones not updated for
+    older_than seconds (HM_JOURNAL_STALE_AFTER, 3600 by default), in
+    parallel. Each operation is claimed before recovery, so several
+    processes may run this at once. Returns the ids of the operations by
+    outcome: "resumed", "rolled_back", "failed" or "unrecovered". Unrecovered
+    operations are kept as unrecoverable and not tried again."""
+    from hm.model import host, load_balancer  # noqa
+    if older_than is None:
+        older_than = float(config.get_config("HM_JOURNAL_STALE_AFTER", 3600, conf))
+    if max_parallel is None:
+        max_parallel = int(config.get_config("HM_JOURNAL_MAX_PARALLEL", 10, conf))
+    storage = model.storage(conf)
+    deadline = time.time() - older_than
+    docs = [doc for doc in storage.list_operations({})
+            if doc['status'] != UNRECOVERABLE and (doc['status'] == FAILED or doc['updated_at'] <= deadline)]
+    outcomes = {"resumed": [], "rolled_back": [], "failed": [], "unrecovered": []}
+    if not docs:
+        return outcomes
+    workers = max(1, min(max_parallel, len(docs)))
+    with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(lambda doc: _recover(storage, doc, conf), docs))
+    for op_id, outcome in results:
+        if outcome is not None:
+            outcomes[outcome].append(op_id)
+    return outcomes
+
+
+def _recover(storage, doc, conf):
+    claimed = storage.update_operation(doc['_id'], {'status': RECOVERING, 'updated_at': time.time()},
+                                       expected={'status': doc['status'], 'updated_at': doc['updated_at']})
+    if not claimed:
+        return doc['_id'], None
+    op = Operation(storage, doc)
+    try:
+        handler = _handlers.get(op.kind)
+        if handler is None:
+            raise RecoveryError("no recovery handler for operation kind {}".format(op.kind))
+        outcome = handler(op, conf)
+    except RollbackNotSupported as e:
+        log.error("operation {} ({}) left unrecovered: {}".format(op.id, op.kind, e))
+        storage.update_operation(op.id, {'status': UNRECOVERABLE, 'error': str(e), 'updated_at': time.time()})
+        return op.id, "unrecovered"
+    except Exception as e:
+        log.exception("error recovering operation {} ({})".format(op.id, op.kind))
+        storage.update_operation(op.id, {'status': FAILED, 'error': str(e), 'updated_at': time.time()})
+        return op.id, "failed"
+    storage.remove_operation(op.id)
+    return op.id, outcome
+
+
+def _stack():
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+class RecoveryError(Exception):
+    pass
+
+
+class RollbackNotSupported(NotImplementedError):
+    pass
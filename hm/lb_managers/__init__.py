@@ -2,10 +2,14 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
-from hm import config
+import sys
+import uuid
+
+from hm import config, journal
 
 
 _managers = {}
+_instances = config.InstanceCache(int(config.get_config("HM_MANAGERS_CACHE_SIZE", 64)))
 _expected_methods = ['create_load_balancer', 'destroy_load_balancer', 'attach_real', 'detach_real']
 
 
@@ -14,18 +18,77 @@ def register(name, cls):
         if not getattr(cls, m, None):
             raise InvalidLBManager("Expected method '{}' not found in {}".format(m, cls))
     _managers[name] = cls
+    _instances.clear(name)
 
 
 def by_name(name, conf=None):
-    return _managers[name](conf)
+    return _instances.get(name, conf, _managers[name])
+
+
+def clear_cache():
+    _instances.clear()
 
 
 class BaseLBManager(object):
+    pool_settings = None
+
     def __init__(self, conf):
         self.config = conf or {}
+        self.settings = config.ConfigSnapshot(self.config)
 
     def get_conf(self, name, default=config.undefined):
-        return config.get_config(name, default, self.config)
+        return self.settings.value(name, default)
+
+    def pool_fingerprint(self):
+        """Returns a digest of the settings pooled load balancers are provisioned
+        with, so they are only claimed by callers configured alike. Only the
+        settings starting with the prefixes in pool_settings count, or every
+        setting but the pool ones when it is None."""
+        return config.fingerprint(self.settings, self.pool_settings, exclude=("HOST_POOL_", "LB_POOL_"))
+
+    def rollback_operation(self, operation):
+        """Undoes the steps journaled by an interrupted operation. Managers
+        without rollback support raise RollbackNotSupported, so the
+        operation is kept, with the resources it left behind, for an
+        operator to clean up."""
+        raise journal.RollbackNotSupported("{} can not roll back {} {}, steps left: {}".format(
+            type(self).__name__, operation.kind, operation.id, operation.steps))
+
+    def create_pool_load_balancer(self):
+        raise NotImplementedError("{} does not support load balancer pools".format(type(self).__name__))
+
+    def claim_pool_load_balancer(self, lb, name):
+        raise NotImplementedError("{} does not support load balancer pools".format(type(self).__name__))
+
+    def pool_name(self):
+        """Returns a unique placeholder name for a load balancer created for
+        the pool, prefixed by LB_POOL_NAME_PREFIX."""
+        return "{}{}".format(self.get_conf("LB_POOL_NAME_PREFIX", "hm-pool-"), uuid.uuid4().hex[:12])
+
+    def stored_nic(self, host, index):
+        """Returns the NIC at index stored in host when it was created, or
+        None when it has no such NIC and the VM must be looked up."""
+        nics = getattr(host, 'nics', None)
+        if not nics or index >= len(nics) or not nics[index].get("networkid"):
+            return None
+        return nics[index]
+
+    def attach_reals(self, lb, hosts):
+        """Attaches every host. When it fails after attaching some of them,
+        it raises AttachRealsError with the hosts attached."""
+        attached = []
+        for host in hosts:
+            try:
+                self.attach_real(lb, host)
+            except:
+                if not attached:
+                    raise
+                raise AttachRealsError(attached, sys.exc_info())
+            attached.append(host)
+
+    def detach_reals(self, lb, hosts):
+        for host in hosts:
+            self.detach_real(lb, host)
 
 
 class LBConfig(object):
@@ -46,3 +109,12 @@ class LBConfig(object):
 
 class InvalidLBManager(Exception):
     pass
+
+
+class AttachRealsError(Exception):
+
+    def __init__(self, attached, exc_info):
+        self.attached = attached
+        self.exc_info = exc_info
+        super(AttachRealsError, self).__init__("failed after attaching {} hosts: {}".format(
+            len(attached), exc_info[1]))
@@ -4,20 +4,26 @@
 
 import sys
 
-from hm import lb_managers, log
+from hm import journal, lb_managers, log
 from hm.model import load_balancer
+from hm.iaas import cloudstack_async, job_watcher, polling, transport
 from hm.iaas.cloudstack_client import CloudStack, AsyncJobError
 
 
 class CloudstackLB(lb_managers.BaseLBManager):
+    pool_settings = ("CLOUDSTACK_",)
 
     def __init__(self, config=None):
         super(CloudstackLB, self).__init__(config)
         url = self.get_conf("CLOUDSTACK_API_URL")
         key = self.get_conf("CLOUDSTACK_API_KEY")
         secret_key = self.get_conf("CLOUDSTACK_SECRET_KEY")
-        self.cs_client = CloudStack(url, key, secret_key)
-        self.async_max_tries = int(self.get_conf("CLOUDSTACK_MAX_TRIES", 100))
+        self.cs_client = CloudStack(url, key, secret_key, transport.get_transport(self.config))
+        self.async_client = cloudstack_async.AsyncCloudStack(url, key, secret_key, self.cs_client.transport,
+                                                             cloudstack_async.get_executor(self.config))
+        self.cs_client.job_watcher = job_watcher.from_config(self.cs_client, self.config)
+        self.async_client.job_watcher = self.cs_client.job_watcher
+        self.polling = polling.from_config(self.config)
         self.project_id = self.get_conf("CLOUDSTACK_PROJECT_ID", None)
         self.associate_ip_command = self.get_conf("CLOUDSTACK_LB_ASSOCIATE_IP_COMMAND", "associateIpAddress")
         self.disassociate_ip_command = self.get_conf("CLOUDSTACK_LB_DISASSOCIATE_IP_COMMAND",
@@ -38,8 +44,10 @@ class CloudstackLB(lb_managers.BaseLBManager):
 
     def create_load_balancer(self, name):
         ip_id = self._associate_ip()
+        journal.record('associate_ip', ip_id=ip_id, project_id=self.project_id)
         try:
             lb_id, address = self._create_lb_rule(ip_id, name)
+            journal.record('create_lb_rule', lb_id=lb_id, project_id=self.project_id)
             self._assign_lb_additional_networks(lb_id)
             try:
                 self._create_lb_hc(lb_id)
@@ -47,6 +55,7 @@ class CloudstackLB(lb_managers.BaseLBManager):
                 exc_info = sys.exc_info()
                 try:
                     self._delete_lb_rule(lb_id, self.project_id)
+                    journal.forget('create_lb_rule')
                 except:
                     log.exception('error in rollback trying to delete lb rule')
                 raise exc_info[0], exc_info[1], exc_info[2]
@@ -59,50 +68,148 @@ class CloudstackLB(lb_managers.BaseLBManager):
             exc_info = sys.exc_info()
             try:
                 self._dissociate_ip(ip_id, self.project_id)
+                journal.forget('associate_ip')
             except:
                 log.exception('error in rollback trying to dissociate ip')
             raise exc_info[0], exc_info[1], exc_info[2]
 
+    def create_pool_load_balancer(self):
+        return self.create_load_balancer(self.pool_name())
+
+    def claim_pool_load_balancer(self, lb, name):
+        params = {
+            'id': lb.id,
+            'name': self._rule_name(name),
+        }
+        if getattr(lb, 'project_id', None):
+            params['projectid'] = lb.project_id
+        self._wait_if_jobid(self.cs_client.updateLoadBalancerRule(params))
+        lb.name = name
+        return lb
+
     def destroy_load_balancer(self, lb):
         self._delete_lb_rule(lb.id, lb.project_id)
         self._dissociate_ip(lb.ip_id, lb.project_id)
 
+    def rollback_operation(self, operation):
+        for step in reversed(operation.steps):
+            if step['name'] == 'claim_pool_lb':
+                self.destroy_load_balancer(load_balancer.LoadBalancer.from_dict(step['document']))
+            elif step['name'] == 'create_lb_rule':
+                self._delete_lb_rule(step['lb_id'], step['project_id'])
+            elif step['name'] == 'associate_ip':
+                self._dissociate_ip(step['ip_id'], step['project_id'])
+            else:
+                continue
+            operation.forget(step['name'])
+
     def attach_real(self, lb, host):
+        self.attach_reals(lb, [host])
+
+    @cloudstack_async.coroutine
+    def attach_real_async(self, lb, host):
+        client = self.async_client
+        list_params, network_params, assign_params = self._attach_params(lb, host.id)
+        if self.assign_network_command:
+            nic = self.stored_nic(host, self.lb_network_index)
+            if nic is None:
+                vms = yield client.listVirtualMachines(list_params)
+                nic = vms["virtualmachine"][0]["nic"][self.lb_network_index]
+            network_params["networkids"] = nic["networkid"]
+            net_rsp = yield client.make_request(self.assign_network_command, network_params)
+            try:
+                yield self._wait_if_jobid_async(net_rsp)
+            except AsyncJobError:
+                log.exception('ignored error assigning network to lb')
+        rsp = yield client.assignToLoadBalancerRule(assign_params)
+        yield self._wait_if_jobid_async(rsp)
+
+    def attach_reals(self, lb, hosts):
+        if not hosts:
+            return
+        vm_ids = ",".join(host.id for host in hosts)
+        list_params, network_params, assign_params = self._attach_params(lb, vm_ids)
+        if self.assign_network_command:
+            network_ids, stored = self._network_ids(lb, hosts)
+            if not self._assign_networks(network_params, network_ids) and stored:
+                # the stored NICs may be stale, so the networks are looked up again
+                live_ids = self._lookup_network_ids(lb, hosts)
+                if live_ids != network_ids:
+                    self._assign_networks(network_params, live_ids)
+        rsp = self.cs_client.assignToLoadBalancerRule(assign_params)
+        self._wait_if_jobid(rsp)
+
+    def _assign_networks(self, network_params, network_ids):
+        params = dict(network_params, networkids=",".join(network_ids))
+        net_rsp = self.cs_client.make_request(self.assign_network_command, params)
+        try:
+            self._wait_if_jobid(net_rsp)
+        except AsyncJobError:
+            log.exception('ignored error assigning network to lb')
+            return False
+        return True
+
+    def _network_ids(self, lb, hosts):
+        """Returns the sorted ids of the networks of hosts in the load balancer
+        network index, and whether any of them came from NICs stored in the
+        hosts. The VMs of hosts without stored NICs are looked up."""
+        nics = [self.stored_nic(host, self.lb_network_index) for host in hosts]
+        missing = [host for host, nic in zip(hosts, nics) if nic is None]
+        network_ids = set(nic["networkid"] for nic in nics if nic is not None)
+        if missing:
+            network_ids.update(self._lookup_network_ids(lb, missing))
+        return sorted(network_ids), len(missing) < len(hosts)
+
+    def _lookup_network_ids(self, lb, hosts):
+        list_params, _, _ = self._attach_params(lb, ",".join(host.id for host in hosts))
+        if len(hosts) == 1:
+            vms = self.cs_client.listVirtualMachines(list_params)["virtualmachine"]
+        else:
+            list_params["ids"] = list_params.pop("id")
+            vms = self.cs_client.listVirtualMachines(list_params).get("virtualmachine", [])
+        return sorted(set(vm["nic"][self.lb_network_index]["networkid"] for vm in vms))
+
+    def detach_real(self, lb, host):
+        rsp = self.cs_client.removeFromLoadBalancerRule(self._detach_params(lb, host.id))
+        self._wait_if_jobid(rsp)
+
+    def detach_reals(self, lb, hosts):
+        if not hosts:
+            return
+        vm_ids = ",".join(host.id for host in hosts)
+        rsp = self.cs_client.removeFromLoadBalancerRule(self._detach_params(lb, vm_ids))
+        self._wait_if_jobid(rsp)
+
+    @cloudstack_async.coroutine
+    def detach_real_async(self, lb, host):
+        rsp = yield self.async_client.removeFromLoadBalancerRule(self._detach_params(lb, host.id))
+        yield self._wait_if_jobid_async(rsp)
+
+    def _attach_params(self, lb, vm_ids):
         list_params = {
-            "id": host.id,
+            "id": vm_ids,
         }
         network_params = {
             "id": lb.id,
         }
         assign_params = {
             'id': lb.id,
-            'virtualmachineids': host.id,
+            'virtualmachineids': vm_ids,
         }
         if hasattr(lb, 'project_id'):
             list_params["projectid"] = lb.project_id
             network_params["projectid"] = lb.project_id
             assign_params['projectid'] = lb.project_id
-        if self.assign_network_command:
-            vms = self.cs_client.listVirtualMachines(list_params)["virtualmachine"]
-            nic = vms[0]["nic"][self.lb_network_index]
-            network_params["networkids"] = nic["networkid"]
-            net_rsp = self.cs_client.make_request(self.assign_network_command, network_params)
-            try:
-                self._wait_if_jobid(net_rsp)
-            except AsyncJobError:
-                log.exception('ignored error assigning network to lb')
-        rsp = self.cs_client.assignToLoadBalancerRule(assign_params)
-        self._wait_if_jobid(rsp)
+        return list_params, network_params, assign_params
 
-    def detach_real(self, lb, host):
+    def _detach_params(self, lb, vm_ids):
         params = {
             'id': lb.id,
-            'virtualmachineids': host.id,
+            'virtualmachineids': vm_ids,
         }
         if hasattr(lb, 'project_id'):
             params['projectid'] = lb.project_id
-        rsp = self.cs_client.removeFromLoadBalancerRule(params)
-        self._wait_if_jobid(rsp)
+        return params
 
     def _associate_ip(self):
         ip_params = {
@@ -124,8 +231,6 @@ class CloudstackLB(lb_managers.BaseLBManager):
 
     def _create_lb_rule(self, ip_id, name):
         public, private, additional = self._slit_ports()
-        if self.lb_domain:
-            name = '{}.{}'.format(name, self.lb_domain)
         lb_params = {
             'networkid': self.lb_network_id,
             'algorithm': self.lb_algorithm,
@@ -134,7 +239,7 @@ class CloudstackLB(lb_managers.BaseLBManager):
             'openfirewall': self.lb_open_firewall,
             'dsr': self.lb_dsr,
             'publicipid': ip_id,
-            'name': name,
+            'name': self._rule_name(name),
         }
         if additional:
             lb_params['additionalportmap'] = additional
@@ -146,20 +251,14 @@ class CloudstackLB(lb_managers.BaseLBManager):
         result = self._wait_if_jobid(lb_rsp)
         return lb_rsp['id'], result['loadbalancer']['publicip']
 
+    def _rule_name(self, name):
+        if self.lb_domain:
+            return '{}.{}'.format(name, self.lb_domain)
+        return name
+
     def _assign_lb_additional_networks(self, lb_id):
-        network_ids = []
-        i = 0
-        while True:
-            try:
-                id = self.get_conf("CLOUDSTACK_LB_NETWORK_ID_%s" % i)
-                i += 1
-                if not id:
-                    break
-                if id == self.lb_network_id:
-                    continue
-                network_ids.append(id)
-            except:
-                break
+        network_ids = [id for id in self.settings.indexed_list("CLOUDSTACK_LB_NETWORK_ID")
+                       if id != self.lb_network_id]
         if not network_ids:
             return
         assign_networks_params = {
@@ -194,9 +293,16 @@ class CloudstackLB(lb_managers.BaseLBManager):
     def _wait_if_jobid(self, rsp):
         if 'jobid' not in rsp:
             return rsp
-        job_result = self.cs_client.wait_for_job(rsp['jobid'], self.async_max_tries)
+        job_result = self.cs_client.wait_for_job(rsp['jobid'], self.polling)
         return job_result['jobresult']
 
+    @cloudstack_async.coroutine
+    def _wait_if_jobid_async(self, rsp):
+        if 'jobid' not in rsp:
+            raise cloudstack_async.Return(rsp)
+        job_result = yield self.async_client.wait_for_job(rsp['jobid'], self.polling)
+        raise cloudstack_async.Return(job_result['jobresult'])
+
     def _delete_lb_rule(self, lb_id, project_id):
         lb_params = {
             'id': lb_id,
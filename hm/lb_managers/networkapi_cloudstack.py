@@ -2,8 +2,14 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
-from hm import lb_managers, log
+import sys
+import threading
+
+from concurrent import futures
+
+from hm import cache, lb_managers, log
 from hm.model import load_balancer
+from hm.iaas import transport
 from hm.iaas.cloudstack_client import CloudStack
 
 network_api_available = True
@@ -15,19 +21,30 @@ except ImportError:
 
 
 class NetworkApiCloudstackLB(lb_managers.BaseLBManager):
+    pool_settings = ("CLOUDSTACK_", "NETWORKAPI_", "VIP_")
 
     def __init__(self, config=None):
         super(NetworkApiCloudstackLB, self).__init__(config)
         url = self.get_conf("CLOUDSTACK_API_URL")
         key = self.get_conf("CLOUDSTACK_API_KEY")
         secret_key = self.get_conf("CLOUDSTACK_SECRET_KEY")
-        self.cs_client = CloudStack(url, key, secret_key)
+        self.cs_client = CloudStack(url, key, secret_key, transport.get_transport(self.config))
 
         self.networkapi_endpoint = self.get_conf("NETWORKAPI_ENDPOINT")
         self.networkapi_user = self.get_conf("NETWORKAPI_USER")
         self.networkapi_password = self.get_conf("NETWORKAPI_PASSWORD")
+        self.client_evip = EnvironmentVIP.EnvironmentVIP(self.networkapi_endpoint, self.networkapi_user,
+                                                         self.networkapi_password)
+        self.client_ip = Ip.Ip(self.networkapi_endpoint, self.networkapi_user, self.networkapi_password)
+        self.client_vip = Vip.Vip(self.networkapi_endpoint, self.networkapi_user, self.networkapi_password)
+        self.environment_vips = None
+        self._networks_lock = threading.Lock()
+        environment_vip_ttl = float(self.get_conf("NETWORKAPI_ENVIRONMENT_VIP_CACHE_TTL", 300))
+        if environment_vip_ttl > 0:
+            self.environment_vips = cache.LRUCache(64, environment_vip_ttl)
         self.create_project_id = self.get_conf("CLOUDSTACK_PROJECT_ID", None)
         self.vip_network_index = int(self.get_conf("CLOUDSTACK_VIP_NETWORK_INDEX", 0))
+        self.max_parallel_reals = int(self.get_conf("VIP_MAX_PARALLEL_REALS", 10))
         self.vip_config = VIPConfig(
             environment_p44=self.get_conf("NETWORKAPI_AMBIENTE_P44_TXT"),
             client=self.get_conf("NETWORKAPI_CLIENTE_TXT"),
@@ -51,6 +68,22 @@ class NetworkApiCloudstackLB(lb_managers.BaseLBManager):
             ip_id=ip_id,
             project_id=self.create_project_id)
 
+    def create_pool_load_balancer(self):
+        return self.create_load_balancer(self.pool_name())
+
+    def claim_pool_load_balancer(self, lb, name):
+        """Relabels the IP of a pooled VIP with name. The VIP keeps the host
+        it was created with, as changing it requires applying the VIP again."""
+        self.client_ip.edit_ipv4(lb.address, u"tsuru hm {0}".format(name), lb.ip_id)
+        lb.name = name
+        return lb
+
+    def rollback_operation(self, operation):
+        for step in reversed(operation.steps):
+            if step['name'] == 'claim_pool_lb':
+                self.destroy_load_balancer(load_balancer.LoadBalancer.from_dict(step['document']))
+                operation.forget(step['name'])
+
     def destroy_load_balancer(self, lb):
         data = {
             "vipid": lb.id
@@ -61,59 +94,167 @@ class NetworkApiCloudstackLB(lb_managers.BaseLBManager):
         return self._remove_vip(lb)
 
     def attach_real(self, lb, host):
-        real_data, network_data = self._get_association_data(lb, host)
-        self.cs_client.addGloboNetworkVipToAccount(network_data)
-        self.cs_client.associateGloboNetworkRealToVip(real_data)
+        self._with_nic(lb, self._vip_nics(lb, [host])[0], lambda nic: self._attach(lb, nic))
 
     def detach_real(self, lb, host):
-        real_data, _ = self._get_association_data(lb, host)
+        self._with_nic(lb, self._vip_nics(lb, [host])[0], lambda nic: self._detach(lb, nic))
+
+    def attach_reals(self, lb, hosts):
+        items = self._vip_nics(lb, hosts)
+        networks = dict((nic["networkid"], self._association_data(lb, nic)[1]) for _, nic, _ in items)
+        self._run_parallel(lambda network_data: self._add_network(lb, network_data), networks.values())
+        results = self._submit_parallel(
+            lambda item: self._with_nic(lb, item, lambda nic: self._attach(lb, nic)), items)
+        failed = [result for result in results if result.exception() is not None]
+        if not failed:
+            return
+        attached = [host for (host, _, _), result in zip(items, results) if result.exception() is None]
+        try:
+            failed[0].result()
+        except:
+            if not attached:
+                raise
+            raise lb_managers.AttachRealsError(attached, sys.exc_info())
+
+    def detach_reals(self, lb, hosts):
+        items = self._vip_nics(lb, hosts)
+        self._run_parallel(lambda item: self._with_nic(lb, item, lambda nic: self._detach(lb, nic)), items)
+
+    def _attach(self, lb, nic):
+        real_data, network_data = self._association_data(lb, nic)
+        self._add_network(lb, network_data)
+        self._associate_real(lb, real_data, network_data)
+
+    def _detach(self, lb, nic):
+        real_data, _ = self._association_data(lb, nic)
         self.cs_client.disassociateGloboNetworkRealFromVip(real_data)
 
-    def _get_association_data(self, lb, host):
-        real_data = {"vipid": lb.id}
-        network_data = {"vipid": lb.id}
-        list_data = {"id": host.id}
+    def _with_nic(self, lb, item, fn):
+        """Calls fn with the VIP network NIC of a host, from an item returned
+        by _vip_nics. When a NIC stored in the host fails, the VM is looked up
+        and fn is retried if its NIC changed."""
+        host, nic, stored = item
+        try:
+            return fn(nic)
+        except:
+            if not stored:
+                raise
+            exc_info = sys.exc_info()
+            try:
+                live = self._lookup_vip_nics(lb, [host]).get(host.id)
+            except:
+                log.exception("error looking up nics of host {}".format(host.id))
+                live = None
+            if live is None or (live["id"], live["networkid"]) == (nic["id"], nic["networkid"]):
+                raise exc_info[0], exc_info[1], exc_info[2]
+        nics = list(host.nics)
+        nics[self.vip_network_index] = live
+        host.nics = nics
+        return fn(live)
 
+    def _vip_nics(self, lb, hosts):
+        """Returns (host, nic, stored) for each host, with the NIC of its VIP
+        network and whether it was stored in the host. Hosts without stored
+        NICs are looked up in a single call."""
+        stored = [self.stored_nic(h, self.vip_network_index) for h in hosts]
+        missing = [h for h, nic in zip(hosts, stored) if nic is None]
+        live = self._lookup_vip_nics(lb, missing) if missing else {}
+        return [(h, nic, True) if nic is not None else (h, live[h.id], False)
+                for h, nic in zip(hosts, stored)]
+
+    def _lookup_vip_nics(self, lb, hosts):
+        if len(hosts) == 1:
+            list_data = {"id": hosts[0].id}
+        else:
+            list_data = {"ids": ",".join(h.id for h in hosts)}
+        vms = self.cs_client.listVirtualMachines(self._list_data(lb, list_data))["virtualmachine"]
+        return dict((vm["id"], vm["nic"][self.vip_network_index]) for vm in vms)
+
+    def _add_network(self, lb, network_data):
+        """Adds the network of a real to the VIP, unless lb.vip_networks
+        records it was already added."""
+        network_id = network_data["networkid"]
+        if network_id in (getattr(lb, 'vip_networks', None) or []):
+            return
+        self.cs_client.addGloboNetworkVipToAccount(network_data)
+        with self._networks_lock:
+            lb.vip_networks = (getattr(lb, 'vip_networks', None) or []) + [network_id]
+
+    def _associate_real(self, lb, real_data, network_data):
+        try:
+            self.cs_client.associateGloboNetworkRealToVip(real_data)
+        except:
+            # the network may no longer be in the VIP, so it is added again next time
+            with self._networks_lock:
+                networks = getattr(lb, 'vip_networks', None) or []
+                lb.vip_networks = [id for id in networks if id != network_data["networkid"]]
+            raise
+
+    def _run_parallel(self, fn, items):
+        for result in self._submit_parallel(fn, items):
+            result.result()
+
+    def _submit_parallel(self, fn, items):
+        """Calls fn for every item, max_parallel_reals at a time, and returns
+        the futures of the calls once all of them ended."""
+        if not items:
+            return []
+        workers = min(len(items), self.max_parallel_reals)
+        with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            return [executor.submit(fn, item) for item in items]
+
+    def _list_data(self, lb, list_data):
         if getattr(lb, 'project_id', None):
-            list_data["projectid"] = \
-                real_data["projectid"] = \
-                network_data["projectid"] = lb.project_id
-        vms = self.cs_client.listVirtualMachines(list_data)["virtualmachine"]
-        nic = vms[0]["nic"][self.vip_network_index]
+            list_data["projectid"] = lb.project_id
+        return list_data
 
+    def _association_data(self, lb, nic):
+        real_data = {"vipid": lb.id}
+        network_data = {"vipid": lb.id}
+        if getattr(lb, 'project_id', None):
+            real_data["projectid"] = network_data["projectid"] = lb.project_id
         real_data["nicid"] = nic["id"]
         network_data["networkid"] = nic["networkid"]
         return real_data, network_data
 
     def _remove_vip(self, lb):
-        client_vip = Vip.Vip(
-            self.networkapi_endpoint, self.networkapi_user,
-            self.networkapi_password)
-        client_vip.remove_script(lb.id)
-        client_vip.remover(lb.id)
+        self.client_vip.remove_script(lb.id)
+        self.client_vip.remover(lb.id)
         try:
-            client_ip = Ip.Ip(self.networkapi_endpoint, self.networkapi_user,
-                              self.networkapi_password)
-            client_ip.delete_ip4(lb.ip_id)
+            self.client_ip.delete_ip4(lb.ip_id)
         except IpNaoExisteError:
             pass
 
+    def _environment_vip_id(self, vip_config):
+        """Returns the id of the environment VIP of vip_config, cached for
+        NETWORKAPI_ENVIRONMENT_VIP_CACHE_TTL seconds."""
+        key = (vip_config.environment_p44, vip_config.client, vip_config.finality)
+        generation = None
+        if self.environment_vips is not None:
+            evip_id, generation = self.environment_vips.get(key)
+            if evip_id is not None:
+                return evip_id
+        evip = self.client_evip.search(ambiente_p44_txt=vip_config.environment_p44,
+                                       cliente_txt=vip_config.client,
+                                       finalidade_txt=vip_config.finality)
+        evip_id = evip["environment_vip"]["id"]
+        if self.environment_vips is not None:
+            self.environment_vips.set(key, evip_id, generation)
+        return evip_id
+
     def _create_vip(self, name, vip_config):
         vip_id = None
-        client_evip = EnvironmentVIP.EnvironmentVIP(
-            self.networkapi_endpoint,
-            self.networkapi_user,
-            self.networkapi_password)
-        evip = client_evip.search(ambiente_p44_txt=vip_config.environment_p44,
-                                  cliente_txt=vip_config.client,
-                                  finalidade_txt=vip_config.finality)
-        client_ip = Ip.Ip(self.networkapi_endpoint, self.networkapi_user,
-                          self.networkapi_password)
-        vip_ip = client_ip.get_available_ip4_for_vip(evip["environment_vip"]["id"],
-                                                     u"tsuru hm {0}".format(name))
+        client_ip = self.client_ip
+        client_vip = self.client_vip
+        evip_id = self._environment_vip_id(vip_config)
+        try:
+            vip_ip = client_ip.get_available_ip4_for_vip(evip_id, u"tsuru hm {0}".format(name))
+        except:
+            if self.environment_vips is not None:
+                self.environment_vips.invalidate((vip_config.environment_p44, vip_config.client,
+                                                  vip_config.finality))
+            raise
         try:
-            client_vip = Vip.Vip(self.networkapi_endpoint, self.networkapi_user,
-                                 self.networkapi_password)
             request = client_vip.add(id_ipv4=vip_ip["ip"]["id"],
                                      id_ipv6=None,
                                      id_healthcheck_expect=vip_config.healthcheck_expect,
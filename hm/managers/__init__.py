@@ -4,10 +4,11 @@
 
 import requests
 
-from hm import config
+from hm import config, journal
 
 
 _managers = {}
+_instances = config.InstanceCache(int(config.get_config("HM_MANAGERS_CACHE_SIZE", 64)))
 _expected_methods = ['create_host', 'destroy_host']
 
 
@@ -16,18 +17,47 @@ def register(name, cls):
         if not getattr(cls, m, None):
             raise InvalidManager("Expected method '{}' not found in {}".format(m, cls))
     _managers[name] = cls
+    _instances.clear(name)
 
 
 def by_name(name, conf=None):
-    return _managers[name](conf)
+    return _instances.get(name, conf, _managers[name])
+
+
+def clear_cache():
+    _instances.clear()
 
 
 class BaseManager(object):
+    pool_settings = None
+
     def __init__(self, conf):
         self.config = conf or {}
+        self.settings = config.ConfigSnapshot(self.config)
 
     def get_conf(self, name, default=config.undefined):
-        return config.get_config(name, default, self.config)
+        return self.settings.value(name, default)
+
+    def pool_fingerprint(self):
+        """Returns a digest of the settings pooled hosts are provisioned
+        with, so they are only claimed by callers configured alike. Only the
+        settings starting with the prefixes in pool_settings count, or every
+        setting but the pool ones when it is None."""
+        return config.fingerprint(self.settings, self.pool_settings, exclude=("HOST_POOL_", "LB_POOL_"))
+
+    def rollback_operation(self, operation):
+        """Undoes the steps journaled by an interrupted operation. Managers
+        without rollback support raise RollbackNotSupported, so the
+        operation is kept, with the resources it left behind, for an
+        operator to clean up."""
+        raise journal.RollbackNotSupported("{} can not roll back {} {}, steps left: {}".format(
+            type(self).__name__, operation.kind, operation.id, operation.steps))
+
+    def create_pool_host(self, alternative_id=0):
+        raise NotImplementedError("{} does not support host pools".format(type(self).__name__))
+
+    def claim_pool_host(self, host, name=None):
+        raise NotImplementedError("{} does not support host pools".format(type(self).__name__))
 
     def get_user_data(self):
         data = self.get_conf("USER_DATA_TXT", None)
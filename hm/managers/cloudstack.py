@@ -2,31 +2,80 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
-from hm import managers
+from hm import journal, managers
 from hm.model import host
+from hm.iaas import cloudstack_async, job_watcher, polling, transport
 from hm.iaas.cloudstack_client import CloudStack
 
 
 class CloudStackManager(managers.BaseManager):
+    pool_settings = ("CLOUDSTACK_", "USER_DATA_")
 
     def __init__(self, config=None):
         super(CloudStackManager, self).__init__(config)
         url = self.get_conf("CLOUDSTACK_API_URL")
         key = self.get_conf("CLOUDSTACK_API_KEY")
         secret_key = self.get_conf("CLOUDSTACK_SECRET_KEY")
-        self.client = CloudStack(url, key, secret_key)
-        self.max_tries = int(self.get_conf("CLOUDSTACK_MAX_TRIES", 100))
+        self.client = CloudStack(url, key, secret_key, transport.get_transport(self.config))
+        self.async_client = cloudstack_async.AsyncCloudStack(url, key, secret_key, self.client.transport,
+                                                             cloudstack_async.get_executor(self.config))
+        self.client.job_watcher = job_watcher.from_config(self.client, self.config)
+        self.async_client.job_watcher = self.client.job_watcher
+        self.polling = polling.from_config(self.config)
 
     def create_host(self, name=None, alternative_id=0):
+        vm, project_id = self._deploy_vm(name, alternative_id)
+        self._tag_host(vm["id"], project_id)
+        return self._host(vm, alternative_id)
+
+    def create_pool_host(self, alternative_id=0):
+        """Deploys an untagged VM named after CLOUDSTACK_GROUP only, to be kept
+        in the warm pool until claim_pool_host prepares it."""
+        vm, _ = self._deploy_vm(None, alternative_id)
+        return self._host(vm, alternative_id)
+
+    def claim_pool_host(self, h, name=None):
+        display_name = self._display_name(name)
+        if display_name != self._display_name(None):
+            self.client.updateVirtualMachine({"id": h.id, "displayname": display_name})
+        self._tag_host(h.id, self._get_alternate_conf("CLOUDSTACK_PROJECT_ID", h.alternative_id, None))
+        return h
+
+    def _deploy_vm(self, name, alternative_id):
+        data, project_id = self._deploy_data(name, alternative_id, self.get_user_data())
+        vm_job = self.client.deployVirtualMachine(data)
+        self._check_vm_job(data, vm_job)
+        journal.record('deploy_vm', vm_id=vm_job.get("id"), job_id=vm_job["jobid"], project_id=project_id)
+        return self._wait_for_unit(vm_job, project_id), project_id
+
+    def _tag_host(self, vm_id, project_id):
+        tags = self.get_conf("HOST_TAGS", "")
+        if tags:
+            self.tag_vm(tags.split(","), vm_id, project_id)
+
+    @cloudstack_async.coroutine
+    def create_host_async(self, name=None, alternative_id=0):
+        """Same as create_host, issuing every CloudStack request through the
+        async client. Only fetching USER_DATA_URL, which is not a CloudStack
+        request, takes an executor thread of its own."""
+        client = self.async_client
+        user_data = yield client.executor.submit(self.get_user_data)
+        data, project_id = self._deploy_data(name, alternative_id, user_data)
+        vm_job = yield client.deployVirtualMachine(data)
+        self._check_vm_job(data, vm_job)
+        result = yield client.wait_for_job(vm_job["jobid"], self.polling)
+        vms = yield client.listVirtualMachines(self._vm_data(vm_job, result, project_id))
+        vm = vms["virtualmachine"][0]
+        tags = self.get_conf("HOST_TAGS", "")
+        if tags:
+            yield self._tag_vm_async(tags.split(","), vm["id"], project_id)
+        raise cloudstack_async.Return(self._host(vm, alternative_id))
+
+    def _deploy_data(self, name, alternative_id, user_data):
         group = self.get_conf("CLOUDSTACK_GROUP", "")
-        user_data = self.get_user_data()
-        if group and name:
-            name = "{}_{}".format(group, name)
-        elif not name:
-            name = group
         data = {
             "group": group,
-            "displayname": name,
+            "displayname": self._display_name(name),
             "templateid": self._get_alternate_conf("CLOUDSTACK_TEMPLATE_ID", alternative_id),
             "zoneid": self._get_alternate_conf("CLOUDSTACK_ZONE_ID", alternative_id),
             "serviceofferingid": self._get_alternate_conf("CLOUDSTACK_SERVICE_OFFERING_ID", alternative_id),
@@ -39,26 +88,54 @@ class CloudStackManager(managers.BaseManager):
         network_ids = self._get_alternate_conf("CLOUDSTACK_NETWORK_IDS", alternative_id, None)
         if network_ids:
             data["networkids"] = network_ids
-        vm_job = self.client.deployVirtualMachine(data)
+        return data, project_id
+
+    def _display_name(self, name):
+        group = self.get_conf("CLOUDSTACK_GROUP", "")
+        if group and name:
+            return "{}_{}".format(group, name)
+        return name or group
+
+    def _check_vm_job(self, data, vm_job):
         if not vm_job.get("jobid"):
             raise CloudStackException(
                 "unexpected response from deployVirtualMachine({}), expected jobid key, got: {}".format(
                     repr(data), repr(vm_job)))
-        vm = self._wait_for_unit(vm_job, project_id)
-        tags = self.get_conf("HOST_TAGS", "")
-        if tags:
-            self.tag_vm(tags.split(","), vm["id"], project_id)
-        return host.Host(id=vm["id"], dns_name=self._get_dns_name(vm), alternative_id=alternative_id)
 
     def tag_vm(self, tag_list, vm_id, project_id=None):
-        list_tags_params = {"resourcetype": "UserVm", "resourceid": vm_id}
+        machine_tags = self.client.listTags(self._list_tags_params(vm_id, project_id))
+        delete_tags_params, add_tags_params = self._tags_changes(tag_list, vm_id, project_id, machine_tags)
+        if delete_tags_params:
+            job = self.client.deleteTags(delete_tags_params)
+            self.client.wait_for_job(job["jobid"], self.polling)
+        if add_tags_params:
+            self.client.createTags(add_tags_params)
+
+    @cloudstack_async.coroutine
+    def _tag_vm_async(self, tag_list, vm_id, project_id=None):
+        client = self.async_client
+        machine_tags = yield client.listTags(self._list_tags_params(vm_id, project_id))
+        delete_tags_params, add_tags_params = self._tags_changes(tag_list, vm_id, project_id, machine_tags)
+        if delete_tags_params:
+            job = yield client.deleteTags(delete_tags_params)
+            yield client.wait_for_job(job["jobid"], self.polling)
+        if add_tags_params:
+            yield client.createTags(add_tags_params)
+
+    def _list_tags_params(self, vm_id, project_id):
+        params = {"resourcetype": "UserVm", "resourceid": vm_id}
+        if project_id:
+            params['projectid'] = project_id
+        return params
+
+    def _tags_changes(self, tag_list, vm_id, project_id, machine_tags):
+        """Returns the params of the deleteTags and createTags calls setting
+        tag_list on a VM with machine_tags, each None when not needed."""
         delete_tags_params = {"resourcetype": "UserVm", "resourceids": vm_id}
         add_tags_params = {"resourcetype": "UserVm", "resourceids": vm_id}
         if project_id:
-            list_tags_params['projectid'] = project_id
             add_tags_params["projectid"] = project_id
             delete_tags_params['projectid'] = project_id
-        machine_tags = self.client.listTags(list_tags_params)
         tag_add_count = 0
         tag_del_count = 0
         for tag in tag_list:
@@ -79,16 +156,31 @@ class CloudStackManager(managers.BaseManager):
                 add_tags_params["tags[{}].key".format(tag_add_count)] = key
                 add_tags_params["tags[{}].value".format(tag_add_count)] = value
                 tag_add_count += 1
-        if any(item.startswith('tags') for item in delete_tags_params.keys()):
-            job = self.client.deleteTags(delete_tags_params)
-            self.client.wait_for_job(job["jobid"], self.max_tries)
+        if not any(item.startswith('tags') for item in delete_tags_params.keys()):
+            delete_tags_params = None
         if not any(item.startswith('tags') for item in add_tags_params.keys()):
-            return
-        self.client.createTags(add_tags_params)
+            add_tags_params = None
+        return delete_tags_params, add_tags_params
+
+    def rollback_operation(self, operation):
+        for step in reversed(operation.steps):
+            if step['name'] == 'deploy_vm':
+                vm_id = step.get('vm_id')
+                if not vm_id:
+                    result = self.client.wait_for_job(step['job_id'], self.polling)
+                    vm_id = self._vm_data({}, result, None)["id"]
+                self.destroy_host(vm_id)
+                operation.forget('deploy_vm', job_id=step['job_id'])
+            elif step['name'] == 'claim_pool_vm':
+                self.destroy_host(step['vm_id'])
+                operation.forget('claim_pool_vm', vm_id=step['vm_id'])
 
     def destroy_host(self, host_id):
         self.client.destroyVirtualMachine({"id": host_id})
 
+    def destroy_host_async(self, host_id):
+        return self.async_client.destroyVirtualMachine({"id": host_id})
+
     def start_host(self, host_id):
         self.client.startVirtualMachine({"id": host_id})
 
@@ -97,7 +189,7 @@ class CloudStackManager(managers.BaseManager):
         if forced:
             forced_stop = "true"
         job = self.client.stopVirtualMachine({"id": host_id, "forced": forced_stop})
-        self.client.wait_for_job(job["jobid"], self.max_tries)
+        self.client.wait_for_job(job["jobid"], self.polling)
 
     def scale_host(self, host_id):
         service_offering_id = self._get_alternate_conf("CLOUDSTACK_SERVICE_OFFERING_ID", 0)
@@ -114,7 +206,7 @@ class CloudStackManager(managers.BaseManager):
             raise Exception("scale_host: machine {} not found".format(host_id))
         if current_offering != service_offering_id:
             job = self.client.scaleVirtualMachine({"id": host_id, "serviceofferingid": service_offering_id})
-            self.client.wait_for_job(job["jobid"], self.max_tries)
+            self.client.wait_for_job(job["jobid"], self.polling)
 
     def restore_host(self, host_id, reset_template=False, reset_tags=False, alternative_id=0):
         restore_args = {'virtualmachineid': host_id}
@@ -147,30 +239,37 @@ class CloudStackManager(managers.BaseManager):
                 "unexpected response from restoreVirtualMachine({}), expected jobid key, got: {} ({})".format(
                     repr(restore_args), repr(vm_job), repr(e)))
 
+    def _host(self, vm, alternative_id):
+        """Builds the host of vm, keeping its NICs so load balancer managers
+        need not look the VM up again when attaching it."""
+        nics = [dict((key, nic.get(key)) for key in ("id", "networkid", "ipaddress"))
+                for nic in vm.get("nic", [])]
+        return host.Host(id=vm["id"], dns_name=self._get_dns_name(vm), alternative_id=alternative_id,
+                         nics=nics)
+
     def _get_dns_name(self, vm):
         if not vm.get("nic"):
             return ""
-        network_index = int(self.get_conf("CLOUDSTACK_PUBLIC_NETWORK_INDEX", 0))
+        network_index = self.settings.get_int("CLOUDSTACK_PUBLIC_NETWORK_INDEX", 0)
         dns_name = vm["nic"][network_index]["ipaddress"]
         return dns_name
 
     def _wait_for_unit(self, vm_job, project_id):
-        result = self.client.wait_for_job(vm_job["jobid"], self.max_tries)
+        result = self.client.wait_for_job(vm_job["jobid"], self.polling)
+        vms = self.client.listVirtualMachines(self._vm_data(vm_job, result, project_id))
+        return vms["virtualmachine"][0]
+
+    def _vm_data(self, vm_job, result, project_id):
         if vm_job.get("id"):
             data = {"id": vm_job["id"]}
         else:
             data = {"id": result['jobresult']['virtualmachine']['id']}
         if project_id:
             data["projectid"] = project_id
-        vms = self.client.listVirtualMachines(data)
-        return vms["virtualmachine"][0]
+        return data
 
     def _get_alternate_conf(self, name, alternative_id, default=None):
-        env_var = "{}_{}".format(name, alternative_id)
-        val = self.get_conf(env_var, default)
-        if val is not None:
-            return val
-        return self.get_conf(name, default)
+        return self.settings.alternate(name, alternative_id, default)
 
 
 class CloudStackException(Exception):
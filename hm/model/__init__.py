@@ -4,11 +4,71 @@
 
 
 def storage(conf=None):
-    from hm.storage import MongoDBStorage
-    return MongoDBStorage(conf)
+    from hm import storage as storages
+    return storages.from_config(conf)
 
 
 class BaseModel(object):
+    """Models keep their known fields in __slots__ and any other attribute in
+    a single overflow dict, created only when needed."""
+
+    __slots__ = ('config', '_extra')
+
+    # document key -> slot, and slot -> default, used by _from_document
+    _fields = {}
+    _defaults = {}
+
+    @classmethod
+    def _from_document(cls, data, conf=None):
+        """Builds a model from a stored document without changing it. data
+        may be any mapping, such as a RawBSONDocument."""
+        if data is None:
+            return None
+        obj = cls.__new__(cls)
+        set_slot = object.__setattr__
+        for name, value in cls._defaults.items():
+            set_slot(obj, name, value)
+        fields = cls._fields
+        extra = None
+        for key, value in data.items():
+            name = fields.get(key)
+            if name is not None:
+                set_slot(obj, name, value)
+            else:
+                if extra is None:
+                    extra = {}
+                extra[key] = value
+        set_slot(obj, 'config', conf)
+        set_slot(obj, '_extra', extra)
+        return obj
+
+    def __getattr__(self, name):
+        if name != '_extra':
+            extra = self._extra
+            if extra is not None and name in extra:
+                return extra[name]
+        raise AttributeError("'{}' object has no attribute '{}'".format(type(self).__name__, name))
+
+    def __setattr__(self, name, value):
+        try:
+            object.__setattr__(self, name, value)
+        except AttributeError:
+            if self._extra is None:
+                object.__setattr__(self, '_extra', {})
+            self._extra[name] = value
+
+    def __delattr__(self, name):
+        try:
+            object.__delattr__(self, name)
+        except AttributeError:
+            if self._extra is None or name not in self._extra:
+                raise
+            del self._extra[name]
+
+    def _extra_items(self):
+        if self._extra is None:
+            return []
+        return self._extra.items()
 
     def storage(self):
         return storage(self.config)
@@ -3,22 +3,30 @@
 # license that can be found in the LICENSE file.
 
 import collections
+import sys
+import threading
 
-from hm import managers, log, model, config
+from concurrent import futures
+from pymongo.errors import DuplicateKeyError
+
+from hm import journal, managers, log, model, config, pool
 
 
 class Host(model.BaseModel):
 
+    __slots__ = ('id', 'dns_name', 'manager', 'alternative_id', 'group')
+    _fields = {'_id': 'id', 'dns_name': 'dns_name', 'manager': 'manager',
+               'alternative_id': 'alternative_id', 'group': 'group'}
+    _defaults = {'id': None, 'dns_name': None, 'manager': None, 'alternative_id': 0, 'group': None}
+
     def __init__(self, id, dns_name, conf=None, alternative_id=0, **kwargs):
         self.id = id
         self.dns_name = dns_name
-        self.manager = None
-        self.extra_args = set()
+        self.manager = kwargs.pop('manager', None)
         self.config = conf
         self.alternative_id = alternative_id
-        for k, v in kwargs.items():
-            self.extra_args.add(k)
-            setattr(self, k, v)
+        self.group = kwargs.pop('group', None)
+        self._extra = kwargs or None
 
     def to_json(self):
         obj = {
@@ -26,52 +34,99 @@ class Host(model.BaseModel):
             'dns_name': self.dns_name,
             'manager': self.manager,
             'alternative_id': self.alternative_id,
-            'group': getattr(self, 'group', None),
+            'group': self.group,
         }
-        for key in self.extra_args:
-            obj[key] = getattr(self, key)
+        obj.update(self._extra_items())
         return obj
 
     @classmethod
     def from_dict(cls, dict, conf=None):
-        if dict is None:
-            return None
-        dict['id'] = dict['_id']
-        del dict['_id']
-        dict['conf'] = conf
-        return Host(**dict)
+        return cls._from_document(dict, conf)
 
     @classmethod
     def create(cls, manager_name, group, conf=None):
         manager = managers.by_name(manager_name, conf)
+        host_pool = pool.host_pool(manager_name, conf)
+        alterantives_map = cls._group_alternatives_map(group, conf)
         alternative_id_error = []
         last_host_create_exception = None
         while True:
             try:
-                alternative_id = cls._current_group_alternate(group, conf, alternative_id_error)
+                alternative_id = cls._current_group_alternate(alterantives_map, conf, alternative_id_error)
             except Exception as e:
                 if last_host_create_exception:
                     raise last_host_create_exception
                 raise e
+            op = journal.begin('create_host', manager_name, conf, group=group, alternative_id=alternative_id)
             try:
-                host = manager.create_host(name=group, alternative_id=alternative_id)
+                host = None
+                if host_pool is not None:
+                    host = cls._claim_from_pool(host_pool, manager, group, alternative_id, conf)
+                if host is None:
+                    host = manager.create_host(name=group, alternative_id=alternative_id)
                 break
             except Exception as e:
+                journal.end(op, e)
                 alternative_id_error.append(alternative_id)
                 last_host_create_exception = e
         host.manager = manager_name
         host.group = group
         host.config = conf
-        model.storage(conf).store_host(host)
+        try:
+            journal.record('created', document=host.to_json())
+            model.storage(conf).store_host(host)
+        except:
+            exc_info = sys.exc_info()
+            journal.end(op, exc_info[1])
+            raise exc_info[0], exc_info[1], exc_info[2]
+        journal.end(op)
         return host
 
+    @classmethod
+    def create_many(cls, manager_name, group, count, conf=None, max_parallel=10):
+        manager = managers.by_name(manager_name, conf)
+        planner = _AlternativePlanner(
+            cls._alternatives_count(conf), cls._group_alternatives_map(group, conf))
+        plan = [planner.take([]) for _ in range(count)]
+        workers = max(1, min(max_parallel, count))
+        with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(
+                lambda alternative_id: cls._create_with_alternatives(manager, group, planner, alternative_id),
+                plan))
+        hosts = [host for host, _ in results if host is not None]
+        errors = [error for host, error in results if host is None]
+        for host in hosts:
+            host.manager = manager_name
+            host.group = group
+            host.config = conf
+        if hosts:
+            model.storage(conf).store_hosts(hosts)
+        if errors:
+            raise BulkCreateError(hosts, errors)
+        return hosts
+
+    @classmethod
+    def _create_with_alternatives(cls, manager, group, planner, alternative_id):
+        alternative_id_error = []
+        while True:
+            try:
+                return manager.create_host(name=group, alternative_id=alternative_id), None
+            except Exception as e:
+                planner.release(alternative_id)
+                alternative_id_error.append(alternative_id)
+                last_host_create_exception = e
+            try:
+                alternative_id = planner.take(alternative_id_error)
+            except NoMoreHMAlternativesAvailable:
+                return None, last_host_create_exception
+
     @classmethod
     def find(cls, id, conf=None):
         return model.storage(conf).find_host(id)
 
     @classmethod
-    def list(cls, filters=None, conf=None):
-        return model.storage(conf).list_hosts(filters)
+    def list(cls, filters=None, conf=None, fields=None, lazy=False):
+        return model.storage(conf).list_hosts(filters, fields=fields, lazy=lazy)
 
     def destroy(self):
         manager = managers.by_name(self.manager, self.config)
@@ -122,22 +177,99 @@ class Host(model.BaseModel):
             raise e
 
     @classmethod
-    def _current_group_alternate(cls, group, conf, alternative_id_error):
-        alternates_count = range(int(config.get_config("HM_ALTERNATIVE_CONFIG_COUNT", 1, conf)))
-        alternates_valid = list(set(alternates_count) - set(alternative_id_error))
-        if len(alternates_valid) == 0:
-            raise NoMoreHMAlternativesAvailable
-        hosts = model.storage(conf).list_hosts({'group': group})
+    def _current_group_alternate(cls, alterantives_map, conf, alternative_id_error):
+        alternates_valid = _valid_alternatives(cls._alternatives_count(conf), alternative_id_error)
+        return _least_used_alternative(alternates_valid, alterantives_map)
+
+    @classmethod
+    def _alternatives_count(cls, conf):
+        return int(config.get_config("HM_ALTERNATIVE_CONFIG_COUNT", 1, conf))
+
+    @classmethod
+    def _claim_from_pool(cls, host_pool, manager, group, alternative_id, conf):
+        document = host_pool.claim(alternative_id=alternative_id)
+        if document is None:
+            return None
+        host = cls.from_dict(document, conf=conf)
+        journal.record('claim_pool_vm', vm_id=host.id)
+        try:
+            return manager.claim_pool_host(host, name=group)
+        except:
+            exc_info = sys.exc_info()
+            log.exception("error claiming pooled VM {}, deploying a new one".format(host.id))
+            if not host_pool.discard(document, alternative_id=alternative_id):
+                raise exc_info[0], exc_info[1], exc_info[2]
+            journal.forget('claim_pool_vm', vm_id=host.id)
+            return None
+
+    @classmethod
+    def _group_alternatives_map(cls, group, conf):
         alterantives_map = collections.defaultdict(int)
-        for host in hosts:
-            alterantives_map[host.alternative_id] += 1
-        min_alt_count = None
-        for i in alternates_valid:
-            if min_alt_count is None or alterantives_map[i] < min_alt_count:
-                min_alt_id = i
-                min_alt_count = alterantives_map[i]
-        return min_alt_id
+        alterantives_map.update(model.storage(conf).count_hosts_by_alternative(group))
+        return alterantives_map
+
+
+def _recover_create(operation, conf):
+    created = operation.step('created')
+    if created is not None:
+        try:
+            model.storage(conf).store_host(Host.from_dict(created['document'], conf=conf))
+        except DuplicateKeyError:
+            pass
+        return "resumed"
+    managers.by_name(operation.manager, conf).rollback_operation(operation)
+    return "rolled_back"
+
+
+def _valid_alternatives(alternatives_count, alternative_id_error):
+    alternates_valid = list(set(range(alternatives_count)) - set(alternative_id_error))
+    if len(alternates_valid) == 0:
+        raise NoMoreHMAlternativesAvailable
+    return alternates_valid
+
+
+def _least_used_alternative(alternates_valid, alterantives_map):
+    min_alt_count = None
+    for i in alternates_valid:
+        if min_alt_count is None or alterantives_map[i] < min_alt_count:
+            min_alt_id = i
+            min_alt_count = alterantives_map[i]
+    return min_alt_id
+
+
+class _AlternativePlanner(object):
+    """Spreads hosts created together over the alternatives the same way
+    sequential Host.create calls would, counting planned hosts as created."""
+
+    def __init__(self, alternatives_count, alterantives_map):
+        self.alternatives_count = alternatives_count
+        self.alterantives_map = alterantives_map
+        self._lock = threading.Lock()
+
+    def take(self, alternative_id_error):
+        with self._lock:
+            alternates_valid = _valid_alternatives(self.alternatives_count, alternative_id_error)
+            alternative_id = _least_used_alternative(alternates_valid, self.alterantives_map)
+            self.alterantives_map[alternative_id] += 1
+            return alternative_id
+
+    def release(self, alternative_id):
+        with self._lock:
+            self.alterantives_map[alternative_id] -= 1
 
 
 class NoMoreHMAlternativesAvailable(Exception):
     pass
+
+
+class BulkCreateError(Exception):
+
+    def __init__(self, hosts, errors):
+        self.hosts = hosts
+        self.errors = errors
+        msg = "failed to create {} of {} hosts: {}".format(
+            len(errors), len(hosts) + len(errors), errors[-1])
+        super(BulkCreateError, self).__init__(msg)
+
+
+journal.register('create_host', _recover_create)
@@ -2,23 +2,31 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
-from hm import lb_managers, log, model
+import contextlib
+import sys
+
+from pymongo.errors import DuplicateKeyError
+
+from hm import journal, lb_managers, log, model, pool
 from hm.model.host import Host
 
 
 class LoadBalancer(model.BaseModel):
 
+    __slots__ = ('id', 'name', 'address', 'manager', '_hosts', '_hosts_data')
+    _fields = {'_id': 'name', 'id': 'id', 'address': 'address', 'manager': 'manager',
+               'hosts': '_hosts_data'}
+    _defaults = {'id': None, 'name': None, 'address': None, 'manager': None, '_hosts_data': None}
+
     def __init__(self, id, name, address, conf=None, **kwargs):
         self.id = id
         self.name = name
         self.address = address
-        self.manager = None
-        self.extra_args = set()
+        self.manager = kwargs.pop('manager', None)
         self.config = conf
-        self.hosts = []
-        for k, v in kwargs.items():
-            self.extra_args.add(k)
-            setattr(self, k, v)
+        self._hosts_data = None
+        self.hosts = kwargs.pop('hosts', [])
+        self._extra = kwargs or None
 
     def to_json(self):
         obj = {
@@ -27,38 +35,68 @@ class LoadBalancer(model.BaseModel):
             'address': self.address,
             'manager': self.manager,
         }
-        for key in self.extra_args:
-            obj[key] = getattr(self, key)
+        obj.update(self._extra_items())
         return obj
 
     @classmethod
     def from_dict(cls, dict, conf=None):
-        if dict is None:
-            return None
-        dict['name'] = dict['_id']
-        del dict['_id']
-        dict['conf'] = conf
-        hosts_data = dict.get('hosts', None)
-        if hosts_data:
-            dict['hosts'] = [Host.from_dict(h, conf=conf) for h in hosts_data]
-        return cls(**dict)
+        lb = cls._from_document(dict, conf)
+        if lb is not None:
+            lb._hosts = []
+        return lb
+
+    @property
+    def hosts(self):
+        if self._hosts_data is not None:
+            self._hosts = [Host.from_dict(h, conf=self.config) for h in self._hosts_data]
+            self._hosts_data = None
+        return self._hosts
+
+    @hosts.setter
+    def hosts(self, hosts):
+        self._hosts_data = None
+        self._hosts = hosts
 
     @classmethod
     def create(cls, manager_name, name, conf=None):
         manager = lb_managers.by_name(manager_name, conf)
-        lb = manager.create_load_balancer(name)
-        lb.manager = manager_name
-        lb.config = conf
-        model.storage(conf).store_load_balancer(lb)
+        lb_pool = pool.load_balancer_pool(manager_name, conf)
+        with journal.operation('create_load_balancer', manager_name, conf, name=name):
+            lb = None
+            if lb_pool is not None:
+                lb = cls._claim_from_pool(lb_pool, manager, name, conf)
+            if lb is None:
+                lb = manager.create_load_balancer(name)
+            lb.manager = manager_name
+            lb.config = conf
+            journal.record('created', document=lb.to_json())
+            model.storage(conf).store_load_balancer(lb)
         return lb
 
+    @classmethod
+    def _claim_from_pool(cls, lb_pool, manager, name, conf):
+        document = lb_pool.claim()
+        if document is None:
+            return None
+        journal.record('claim_pool_lb', document=document)
+        try:
+            return manager.claim_pool_load_balancer(cls.from_dict(document, conf=conf), name)
+        except:
+            exc_info = sys.exc_info()
+            log.exception("error claiming pooled load balancer {}, creating a new one".format(
+                document['_id']))
+            if not lb_pool.discard(document):
+                raise exc_info[0], exc_info[1], exc_info[2]
+            journal.forget('claim_pool_lb', document=document)
+            return None
+
     @classmethod
     def find(cls, name, conf=None):
         return model.storage(conf).find_load_balancer(name)
 
     @classmethod
-    def list(cls, filters=None, conf=None):
-        return model.storage(conf).list_load_balancers(filters)
+    def list(cls, filters=None, conf=None, fields=None, lazy=False):
+        return model.storage(conf).list_load_balancers(filters, fields=fields, lazy=lazy)
 
     def destroy(self):
         manager = self._manager()
@@ -71,9 +109,10 @@ class LoadBalancer(model.BaseModel):
 
     def add_host(self, host):
         manager = self._manager()
-        manager.attach_real(self, host)
+        with self._tracking_networks():
+            manager.attach_real(self, host)
         self.storage().add_host_to_load_balancer(self.name, host)
-        self.hosts.append(host)
+        self._merge_hosts([host])
 
     def remove_host(self, host):
         manager = self._manager()
@@ -81,5 +120,81 @@ class LoadBalancer(model.BaseModel):
         self.storage().remove_host_from_load_balancer(self.name, host)
         self.hosts = [h for h in self.hosts if h.id != host.id]
 
+    def add_hosts(self, hosts):
+        if not hosts:
+            return
+        manager = self._manager()
+        try:
+            with self._tracking_networks():
+                manager.attach_reals(self, hosts)
+        except lb_managers.AttachRealsError as e:
+            self._store_attached(e.attached)
+            raise e.exc_info[0], e.exc_info[1], e.exc_info[2]
+        self.storage().add_hosts_to_load_balancer(self.name, hosts)
+        self._merge_hosts(hosts)
+
+    def remove_hosts(self, hosts):
+        if not hosts:
+            return
+        manager = self._manager()
+        manager.detach_reals(self, hosts)
+        self.storage().remove_hosts_from_load_balancer(self.name, hosts)
+        ids = set(h.id for h in hosts)
+        self.hosts = [h for h in self.hosts if h.id not in ids]
+
+    @contextlib.contextmanager
+    def _tracking_networks(self):
+        """Stores the changes the manager makes to vip_networks, the networks
+        it already associated with the load balancer, even if attaching
+        fails. They only save calls, so errors storing them are logged."""
+        before = set(getattr(self, 'vip_networks', None) or [])
+        try:
+            yield
+        finally:
+            after = getattr(self, 'vip_networks', None) or []
+            added = [id for id in after if id not in before]
+            removed = [id for id in before if id not in after]
+            try:
+                if added:
+                    self.storage().add_load_balancer_networks(self.name, added)
+                if removed:
+                    self.storage().remove_load_balancer_networks(self.name, removed)
+            except:
+                log.exception("error storing networks of load balancer {}".format(self.name))
+
+    def _store_attached(self, hosts):
+        """Stores the hosts attached before attaching others failed, so
+        storage does not miss reals the load balancer already has."""
+        try:
+            self.storage().add_hosts_to_load_balancer(self.name, hosts)
+        except:
+            log.exception("error storing hosts attached to load balancer {}".format(self.name))
+            return
+        self._merge_hosts(hosts)
+
+    def _merge_hosts(self, hosts):
+        by_id = dict((h.id, h) for h in hosts)
+        ids = set(h.id for h in self.hosts)
+        self.hosts = [by_id.get(h.id, h) for h in self.hosts] + [h for h in hosts if h.id not in ids]
+
     def _manager(self):
         return lb_managers.by_name(self.manager, self.config)
+
+
+def _recover_create(operation, conf):
+    created = operation.step('created')
+    if created is not None:
+        lb = LoadBalancer.from_dict(created['document'], conf=conf)
+        storage = model.storage(conf)
+        try:
+            storage.store_load_balancer(lb)
+            return "resumed"
+        except DuplicateKeyError:
+            stored = storage.find_load_balancer(lb.name)
+            if stored is not None and stored.id == lb.id:
+                return "resumed"
+    lb_managers.by_name(operation.manager, conf).rollback_operation(operation)
+    return "rolled_back"
+
+
+journal.register('create_load_balancer', _recover_create)
@@ -0,0 +1,333 @@
+# Copyright 2016 hm authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import sys
+import threading
+import time
+import uuid
+
+from concurrent import futures
+from pymongo.errors import DuplicateKeyError
+
+from hm import config, journal, lb_managers, log, managers, model
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def host_pool(manager_name, conf=None):
+    """Returns the warm pool of hosts of manager_name, or None when
+    HOST_POOL_SIZE is not set. Pools are shared by every caller with the
+    same config, and the first use starts their background filler."""
+    if int(config.get_config("HOST_POOL_SIZE", 0, conf)) <= 0:
+        return None
+    return _get(HostPool, manager_name, conf)
+
+
+def load_balancer_pool(manager_name, conf=None):
+    """Returns the pool of load balancers of manager_name, or None when
+    LB_POOL_SIZE is not set."""
+    if int(config.get_config("LB_POOL_SIZE", 0, conf)) <= 0:
+        return None
+    return _get(LoadBalancerPool, manager_name, conf)
+
+
+def clear():
+    """Stops the fillers of every pool and forgets them."""
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.stop()
+        _pools.clear()
+
+
+def _get(cls, manager_name, conf):
+    key = (cls.kind, manager_name, config.freeze(conf or {}))
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = cls(manager_name, dict(conf) if conf else None)
+            if pool.interval > 0:
+                pool.start()
+        return pool
+
+
+class Pool(object):
+    """Keeps size ready items per partition in the storage, so callers can
+    claim one instead of waiting for it to be provisioned. Items are
+    claimed atomically, so a pool may be shared by several processes, and
+    carry the fingerprint of the manager settings they were provisioned
+    with, so they are only claimed by pools configured alike. Hits, misses
+    and how long partitions take to be refilled after a claim are kept per
+    process."""
+
+    kind = None
+    prefix = None
+
+    def __init__(self, manager_name, conf=None):
+        self.manager_name = manager_name
+        self.config = conf
+        self.size = int(config.get_config(self.prefix + "_SIZE", 0, conf))
+        self.interval = float(config.get_config(self.prefix + "_FILL_INTERVAL", 30, conf))
+        self.max_parallel = int(config.get_config(self.prefix + "_MAX_PARALLEL", 5, conf))
+        self.fill_timeout = float(config.get_config(self.prefix + "_FILL_TIMEOUT", 3600, conf))
+        self.hits = 0
+        self.misses = 0
+        self.last_refill_lag = None
+        self.max_refill_lag = None
+        self._deficit_since = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self.fingerprint = self._manager().pool_fingerprint()
+
+    def partitions(self):
+        return [{}]
+
+    def create_item(self, partition):
+        """Provisions an item for partition, returning its id and document."""
+        raise NotImplementedError()
+
+    def rollback(self, operation):
+        """Undoes the steps of a fill operation that did not create an item."""
+        raise NotImplementedError()
+
+    def destroy_item(self, document):
+        raise NotImplementedError()
+
+    def _manager(self):
+        raise NotImplementedError()
+
+    def claim(self, **partition):
+        """Removes a ready item of partition from the pool and returns its
+        document, or None when the pool is empty."""
+        item = model.storage(self.config).claim_pool_item(self._filters(partition))
+        with self._lock:
+            if item is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._deficit_since.setdefault(_key(partition), time.time())
+        self._wakeup.set()
+        return item['document'] if item is not None else None
+
+    def discard(self, document, **partition):
+        """Gets rid of an item claimed from partition that could not be
+        prepared for its caller: destroys it, or puts it back in the pool
+        when that fails. Returns whether the item was disposed of."""
+        try:
+            self.destroy_item(document)
+            return True
+        except:
+            log.exception("error destroying item {} of {} pool".format(document["_id"], self.kind))
+        try:
+            model.storage(self.config).store_pool_item(self._item(document["_id"], partition, document))
+            return True
+        except:
+            log.exception("error returning item {} to {} pool".format(document["_id"], self.kind))
+        return False
+
+    def fill(self):
+        """Provisions the items missing in every partition and returns how
+        many were added. Items being provisioned by any process count as
+        present: each fill stores a reservation until its item is ready,
+        forgotten after FILL_TIMEOUT seconds if its process dies."""
+        storage = model.storage(self.config)
+        self._expire_reservations(storage)
+        jobs = []
+        for partition in self.partitions():
+            available = storage.count_pool_items(self._filters(partition))
+            pending = storage.count_pool_items(dict(self._labels(partition), reserved=True))
+            missing = self.size - available - pending
+            if available >= self.size:
+                self._refilled(partition)
+            jobs.extend([partition] * missing)
+        if not jobs:
+            return 0
+        with futures.ThreadPoolExecutor(max_workers=min(len(jobs), self.max_parallel)) as executor:
+            added = sum(executor.map(lambda partition: self._fill_one(storage, partition), jobs))
+        for partition in self.partitions():
+            if storage.count_pool_items(self._filters(partition)) >= self.size:
+                self._refilled(partition)
+        return added
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            requests = self.hits + self.misses
+            oldest = min(self._deficit_since.values()) if self._deficit_since else None
+            return {
+                "size": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": float(self.hits) / requests if requests else None,
+                "last_refill_lag": self.last_refill_lag,
+                "max_refill_lag": self.max_refill_lag,
+                "refill_pending_for": now - oldest if oldest is not None else None,
+            }
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="hm-{}-pool".format(self.kind))
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.fill()
+            except:
+                log.exception("error filling {} pool of {}".format(self.kind, self.manager_name))
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+
+    def _fill_one(self, storage, partition):
+        reservation = dict(self._labels(partition), _id="reservation-" + uuid.uuid4().hex,
+                           reserved=True, created_at=time.time())
+        params = dict(partition, pool=self.kind, fingerprint=self.fingerprint)
+        try:
+            storage.store_pool_item(reservation)
+            with journal.operation("fill_pool", self.manager_name, self.config, **params):
+                id, document = self.create_item(partition)
+                journal.record("created", document=document)
+                self._store_item(storage, self._item(id, partition, document))
+        except:
+            log.exception("error adding item to {} pool of {}".format(self.kind, self.manager_name))
+            return 0
+        finally:
+            self._release(storage, reservation)
+        return 1
+
+    def _store_item(self, storage, item):
+        """Stores a new item, destroying it when that fails. Once destroyed,
+        the steps of the fill operation are forgotten, as there is nothing
+        left to resume or roll back."""
+        try:
+            storage.store_pool_item(item)
+        except:
+            exc_info = sys.exc_info()
+            try:
+                self.destroy_item(item["document"])
+            except:
+                log.exception("error destroying item {} of {} pool".format(item["_id"], self.kind))
+            else:
+                op = journal.current()
+                for step in list(op.steps if op is not None else []):
+                    op.forget(**step)
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    def _item(self, id, partition, document):
+        return dict(self._labels(partition), _id=id, document=document, created_at=time.time())
+
+    def _release(self, storage, reservation):
+        try:
+            storage.claim_pool_item({"_id": reservation["_id"]})
+        except:
+            log.exception("error releasing {} pool reservation {}".format(self.kind, reservation["_id"]))
+
+    def _expire_reservations(self, storage):
+        filters = {"kind": self.kind, "manager": self.manager_name, "reserved": True,
+                   "created_at": {"$lt": time.time() - self.fill_timeout}}
+        while storage.claim_pool_item(filters) is not None:
+            pass
+
+    def _labels(self, partition):
+        return dict(partition, kind=self.kind, manager=self.manager_name, fingerprint=self.fingerprint)
+
+    def _filters(self, partition):
+        return dict(self._labels(partition), reserved={"$exists": False})
+
+    def _refilled(self, partition):
+        with self._lock:
+            since = self._deficit_since.pop(_key(partition), None)
+            if since is not None:
+                self.last_refill_lag = time.time() - since
+                self.max_refill_lag = max(self.max_refill_lag, self.last_refill_lag)
+
+
+class HostPool(Pool):
+    """Pool of deployed, untagged VMs per alternative, sized by
+    HOST_POOL_SIZE and filled every HOST_POOL_FILL_INTERVAL seconds, or
+    right after a claim."""
+
+    kind = "host"
+    prefix = "HOST_POOL"
+
+    def partitions(self):
+        count = int(config.get_config("HM_ALTERNATIVE_CONFIG_COUNT", 1, self.config))
+        return [{"alternative_id": alternative_id} for alternative_id in range(count)]
+
+    def create_item(self, partition):
+        host = self._manager().create_pool_host(alternative_id=partition["alternative_id"])
+        host.manager = self.manager_name
+        return host.id, host.to_json()
+
+    def rollback(self, operation):
+        self._manager().rollback_operation(operation)
+
+    def destroy_item(self, document):
+        self._manager().destroy_host(document["_id"])
+
+    def _manager(self):
+        return managers.by_name(self.manager_name, self.config)
+
+
+class LoadBalancerPool(Pool):
+    """Pool of load balancers created with placeholder names, sized by
+    LB_POOL_SIZE and filled every LB_POOL_FILL_INTERVAL seconds, or right
+    after a claim."""
+
+    kind = "load_balancer"
+    prefix = "LB_POOL"
+
+    def create_item(self, partition):
+        lb = self._manager().create_pool_load_balancer()
+        lb.manager = self.manager_name
+        return lb.name, lb.to_json()
+
+    def rollback(self, operation):
+        self._manager().rollback_operation(operation)
+
+    def destroy_item(self, document):
+        from hm.model.load_balancer import LoadBalancer
+        self._manager().destroy_load_balancer(LoadBalancer.from_dict(document, conf=self.config))
+
+    def _manager(self):
+        return lb_managers.by_name(self.manager_name, self.config)
+
+
+def _key(partition):
+    return tuple(sorted(partition.items()))
+
+
+def _recover_fill(operation, conf):
+    params = dict(operation.params)
+    pool = _pool_classes[params.pop("pool")](operation.manager, conf)
+    pool.fingerprint = params.pop("fingerprint", pool.fingerprint)
+    created = operation.step("created")
+    if created is None:
+        if operation.steps:
+            pool.rollback(operation)
+        return "rolled_back"
+    document = created["document"]
+    try:
+        model.storage(conf).store_pool_item(pool._item(document["_id"], params, document))
+    except DuplicateKeyError:
+        pass
+    return "resumed"
+
+
+_pool_classes = {
+    HostPool.kind: HostPool,
+    LoadBalancerPool.kind: LoadBalancerPool,
+}
+
+journal.register("fill_pool", _recover_fill)
@@ -0,0 +1,576 @@
+# Copyright 2014 hm authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import collections
+import threading
+
+import pymongo
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from pymongo import uri_parser
+
+from hm import cache, config, log, storage_watcher
+from hm.model import host, load_balancer
+
+
+_clients = {}
+_databases = {}
+_indexed = set()
+_caches = {}
+_watchers = {}
+_uncached = set()
+_registry_lock = threading.Lock()
+_raw_codec_options = CodecOptions(document_class=RawBSONDocument)
+
+_storages = {}
+_expected_methods = ['store_host', 'store_hosts', 'remove_host', 'find_host', 'list_hosts',
+                     'remove_hosts', 'count_hosts_by_alternative', 'store_load_balancer',
+                     'upsert_load_balancers', 'remove_load_balancer',
+                     'find_load_balancer', 'list_load_balancers', 'add_host_to_load_balancer',
+                     'add_hosts_to_load_balancer', 'remove_host_from_load_balancer',
+                     'remove_hosts_from_load_balancer', 'add_load_balancer_networks',
+                     'remove_load_balancer_networks', 'store_operation', 'add_operation_step',
+                     'remove_operation_step', 'update_operation', 'list_operations', 'remove_operation',
+                     'store_pool_item', 'claim_pool_item', 'count_pool_items']
+
+
+def register(name, cls):
+    for m in _expected_methods:
+        if not getattr(cls, m, None):
+            raise InvalidStorage("Expected method '{}' not found in {}".format(m, cls))
+    _storages[name] = cls
+
+
+def by_name(name, conf=None):
+    return _storages[name](conf)
+
+
+def from_config(conf=None):
+    """Returns the storage selected by STORAGE_ENGINE, "mongodb" by default."""
+    return by_name(config.get_config('STORAGE_ENGINE', 'mongodb', conf), conf)
+
+
+def get_database(mongo_uri, mongo_database):
+    """Returns the database handle for mongo_uri and mongo_database. Clients
+    are shared by every storage using the same URI, so the process keeps a
+    single connection pool and monitor per MongoDB deployment."""
+    key = (mongo_uri, mongo_database)
+    with _registry_lock:
+        db = _databases.get(key)
+        if db is None:
+            client = _clients.get(mongo_uri)
+            if client is None:
+                client = _clients[mongo_uri] = pymongo.MongoClient(mongo_uri)
+            db = _databases[key] = client[mongo_database]
+        return db
+
+
+def get_cache(db, mongo_uri, mongo_database, conf=None):
+    """Returns the document cache shared by every storage of mongo_uri and
+    mongo_database, or None when MONGO_CACHE_SIZE is not set. The first
+    storage to create it sets its size and MONGO_CACHE_TTL, and starts a
+    watcher keeping it coherent with other processes when MONGO_CACHE_WATCH
+    is enabled. The cache is only shared once its watcher is running, so a
+    failed start is retried by the next storage. Deployments the watcher
+    can't follow, such as standalone servers, are left uncached."""
+    size = int(config.get_config('MONGO_CACHE_SIZE', 0, conf))
+    if size <= 0:
+        return None
+    key = (mongo_uri, mongo_database)
+    with _registry_lock:
+        if key in _uncached:
+            return None
+        documents = _caches.get(key)
+        if documents is None:
+            ttl = float(config.get_config('MONGO_CACHE_TTL', 10, conf))
+            documents = cache.LRUCache(size, ttl)
+            if config.get_config('MONGO_CACHE_WATCH', 'false', conf) in ["true", "True", "1"]:
+                interval = float(config.get_config('MONGO_CACHE_WATCH_INTERVAL', 1, conf))
+                watcher = storage_watcher.CacheWatcher(
+                    db, documents, {MongoDBStorage.hosts_collection: 'host',
+                                    MongoDBStorage.lb_collection: 'lb'}, interval)
+                try:
+                    watcher.start()
+                except storage_watcher.WatcherUnavailable as e:
+                    watcher.stop()
+                    log.error("can't watch {} for changes, disabling the document cache: {}".format(
+                        mongo_database, e))
+                    _uncached.add(key)
+                    return None
+                except:
+                    watcher.stop()
+                    raise
+                _watchers[key] = watcher
+            _caches[key] = documents
+        return documents
+
+
+def close():
+    """Closes every shared client. Storages created afterwards connect again."""
+    with _registry_lock:
+        clients = list(_clients.values())
+        _clients.clear()
+        _databases.clear()
+        _indexed.clear()
+        _caches.clear()
+        _uncached.clear()
+        _stop_watchers()
+    for client in clients:
+        client.close()
+
+
+def reset():
+    """Forgets the shared clients without closing them. Call it in forked
+    children, which must not use the sockets inherited from the parent."""
+    with _registry_lock:
+        _clients.clear()
+        _databases.clear()
+        _indexed.clear()
+        _caches.clear()
+        _uncached.clear()
+        _stop_watchers()
+
+
+def _stop_watchers():
+    for watcher in _watchers.values():
+        watcher.stop()
+    _watchers.clear()
+
+
+class MongoDBStorage(object):
+    hosts_collection = "hosts"
+    lb_collection = "load_balancers"
+    operations_collection = "operations"
+    pool_collection = "pool"
+    host_required_fields = ("dns_name",)
+    lb_required_fields = ("id", "address")
+    hosts_indexes = (
+        [("group", pymongo.ASCENDING)],
+        [("group", pymongo.ASCENDING), ("alternative_id", pymongo.ASCENDING)],
+        [("manager", pymongo.ASCENDING)],
+    )
+    lb_indexes = (
+        [("manager", pymongo.ASCENDING)],
+        [("hosts._id", pymongo.ASCENDING)],
+    )
+    pool_indexes = (
+        [("kind", pymongo.ASCENDING), ("manager", pymongo.ASCENDING), ("created_at", pymongo.ASCENDING)],
+    )
+    lb_references_indexes = (
+        [("manager", pymongo.ASCENDING)],
+        [("hosts", pymongo.ASCENDING)],
+    )
+
+    def __init__(self, conf=None):
+        self.config = conf
+        self.mongo_uri = config.get_config('DBAAS_MONGODB_ENDPOINT', None, conf)
+        if not self.mongo_uri:
+            self.mongo_uri = config.get_config('MONGO_URI', 'mongodb://localhost:27017/', conf)
+        self.mongo_database = uri_parser.parse_uri(self.mongo_uri)['database']
+        if not self.mongo_database:
+            self.mongo_database = config.get_config('MONGO_DATABASE', 'host_manager', conf)
+        self.db = get_database(self.mongo_uri, self.mongo_database)
+        self.raw_documents = config.get_config('MONGO_RAW_DOCUMENTS', 'false', conf) in ["true", "True", "1"]
+        self.host_references = config.get_config('MONGO_LB_HOST_REFERENCES', 'false',
+                                                 conf) in ["true", "True", "1"]
+        self.cache = get_cache(self.db, self.mongo_uri, self.mongo_database, conf)
+        if config.get_config('MONGO_ENSURE_INDEXES', 'false', conf) in ["true", "True", "1"]:
+            key = (self.mongo_uri, self.mongo_database)
+            if key not in _indexed:
+                self.ensure_indexes()
+                _indexed.add(key)
+
+    def ensure_indexes(self):
+        """Creates the indexes used by hm queries. Existing indexes are kept,
+        so it is safe to call on every start."""
+        for keys in self.hosts_indexes:
+            self._hosts_collection().create_index(keys, background=True)
+        for keys in self.lb_references_indexes if self.host_references else self.lb_indexes:
+            self._lb_collection().create_index(keys, background=True)
+        for keys in self.pool_indexes:
+            self._pool_collection().create_index(keys, background=True)
+
+    def store_host(self, h):
+        self._hosts_collection().insert_one(h.to_json())
+        self._invalidate(('host', h.id))
+
+    def store_hosts(self, hosts, ordered=True):
+        """Inserts hosts in a single round trip. Ordered writes stop at the
+        first failure, unordered ones write every host they can. Failures
+        raise BulkStoreError with the error of each host not written."""
+        documents = [h.to_json() for h in hosts]
+        if not documents:
+            return
+        try:
+            self._hosts_collection().insert_many(documents, ordered=ordered)
+        except pymongo.errors.BulkWriteError as e:
+            raise bulk_store_error(e, documents)
+        finally:
+            self._invalidate(*[('host', doc['_id']) for doc in documents])
+
+    def remove_host(self, id):
+        self._hosts_collection().remove({'_id': id})
+        self._invalidate(('host', id))
+
+    def remove_hosts(self, ids):
+        ids = list(ids)
+        if not ids:
+            return 0
+        result = self._hosts_collection().delete_many({'_id': {'$in': ids}})
+        self._invalidate(*[('host', id) for id in ids])
+        return result.deleted_count
+
+    def find_host(self, id):
+        h_data = self._find_one(('host', id), lambda: self._hosts_collection().find_one({'_id': id}))
+        return host.Host.from_dict(h_data, conf=self.config)
+
+    def list_hosts(self, filters, fields=None, lazy=False):
+        projection = self._projection(fields, self.host_required_fields)
+        host_data_list = self._hosts_collection().find(filters, projection) or []
+        hosts = (host.Host.from_dict(h_data, conf=self.config) for h_data in host_data_list)
+        return hosts if lazy else list(hosts)
+
+    def count_hosts_by_alternative(self, group):
+        pipeline = [
+            {'$match': {'group': group}},
+            {'$group': {'_id': '$alternative_id', 'count': {'$sum': 1}}},
+        ]
+        counts = collections.defaultdict(int)
+        for result in self._hosts_collection().aggregate(pipeline):
+            alternative_id = result['_id'] if result['_id'] is not None else 0
+            counts[alternative_id] += result['count']
+        return dict(counts)
+
+    def store_load_balancer(self, lb):
+        self._lb_collection().insert_one(lb.to_json())
+        self._invalidate(('lb', lb.name))
+
+    def upsert_load_balancers(self, lbs, ordered=True):
+        """Inserts or replaces load balancers, hosts included, in a single
+        round trip. Failures raise BulkStoreError like store_hosts."""
+        documents = [load_balancer_document(lb) for lb in lbs]
+        if self.host_references:
+            for doc in documents:
+                doc['hosts'] = [h['_id'] for h in doc['hosts']]
+        if not documents:
+            return
+        requests = [pymongo.ReplaceOne({'_id': doc['_id']}, doc, upsert=True) for doc in documents]
+        try:
+            self._lb_collection().bulk_write(requests, ordered=ordered)
+        except pymongo.errors.BulkWriteError as e:
+            raise bulk_store_error(e, documents)
+        finally:
+            self._invalidate(*[('lb', doc['_id']) for doc in documents])
+
+    def remove_load_balancer(self, name):
+        self._lb_collection().remove({'_id': name})
+        self._invalidate(('lb', name))
+
+    def find_load_balancer(self, name):
+        if self.host_references:
+            lb_data = self._find_one(('lb', name), lambda: next(self._lookup_hosts({'_id': name}), None))
+        else:
+            lb_data = self._find_one(('lb', name), lambda: self._lb_collection().find_one({'_id': name}))
+        return load_balancer.LoadBalancer.from_dict(lb_data, conf=self.config)
+
+    def list_load_balancers(self, filters, fields=None, lazy=False):
+        projection = self._projection(fields, self.lb_required_fields)
+        if self.host_references and (not fields or 'hosts' in fields):
+            lb_data_list = self._lookup_hosts(filters, projection)
+        else:
+            lb_data_list = self._lb_collection().find(filters, projection) or []
+        lbs = (load_balancer.LoadBalancer.from_dict(lb_data, conf=self.config) for lb_data in lb_data_list)
+        return lbs if lazy else list(lbs)
+
+    def add_host_to_load_balancer(self, name, h):
+        self.add_hosts_to_load_balancer(name, [h])
+
+    def add_hosts_to_load_balancer(self, name, hosts):
+        """Adds hosts to the load balancer keyed by their id: hosts already
+        there are updated in place, so retrying an add never duplicates
+        them. With MONGO_LB_HOST_REFERENCES only the host ids are stored."""
+        if not hosts:
+            return
+        if self.host_references:
+            ids = [h.id for h in hosts]
+            self._lb_collection().update_one({'_id': name}, {'$addToSet': {'hosts': {'$each': ids}}})
+        else:
+            requests = []
+            for h in hosts:
+                doc = h.to_json()
+                requests.append(pymongo.UpdateOne({'_id': name, 'hosts._id': h.id},
+                                                  {'$set': {'hosts.$': doc}}))
+                requests.append(pymongo.UpdateOne({'_id': name, 'hosts._id': {'$ne': h.id}},
+                                                  {'$push': {'hosts': doc}}))
+            self._lb_collection().bulk_write(requests)
+        self._invalidate(('lb', name))
+
+    def remove_host_from_load_balancer(self, name, h):
+        self.remove_hosts_from_load_balancer(name, [h])
+
+    def remove_hosts_from_load_balancer(self, name, hosts):
+        ids = [h.id for h in hosts]
+        if self.host_references:
+            pull = {'hosts': {'$in': ids}}
+        else:
+            pull = {'hosts': {'_id': {'$in': ids}}}
+        self._lb_collection().update_one({'_id': name}, {'$pull': pull})
+        self._invalidate(('lb', name))
+
+    def add_load_balancer_networks(self, name, network_ids):
+        """Records network_ids as associated with the load balancer, in its
+        vip_networks field."""
+        self._lb_collection().update_one({'_id': name},
+                                         {'$addToSet': {'vip_networks': {'$each': list(network_ids)}}})
+        self._invalidate(('lb', name))
+
+    def remove_load_balancer_networks(self, name, network_ids):
+        self._lb_collection().update_one({'_id': name},
+                                         {'$pull': {'vip_networks': {'$in': list(network_ids)}}})
+        self._invalidate(('lb', name))
+
+    def store_operation(self, doc):
+        self._operations_collection().insert_one(doc)
+
+    def add_operation_step(self, id, step, fields=None):
+        update = {'$push': {'steps': step}}
+        if fields:
+            update['$set'] = fields
+        self._operations_collection().update_one({'_id': id}, update)
+
+    def remove_operation_step(self, id, query):
+        self._operations_collection().update_one({'_id': id}, {'$pull': {'steps': query}})
+
+    def update_operation(self, id, fields, expected=None):
+        """Sets fields in the operation if it still matches expected, and
+        returns whether it did."""
+        query = dict(expected or {}, _id=id)
+        return self._operations_collection().update_one(query, {'$set': fields}).matched_count == 1
+
+    def list_operations(self, filters):
+        return list(self._operations_collection().find(filters))
+
+    def remove_operation(self, id):
+        self._operations_collection().delete_one({'_id': id})
+
+    def store_pool_item(self, doc):
+        self._pool_collection().insert_one(doc)
+
+    def claim_pool_item(self, filters):
+        """Atomically removes and returns the oldest pool item matching
+        filters, or None when there is none."""
+        return self._pool_collection().find_one_and_delete(filters, sort=[('created_at', pymongo.ASCENDING)])
+
+    def count_pool_items(self, filters):
+        return self._pool_collection().count(filters)
+
+    def _lookup_hosts(self, filters, projection=None):
+        pipeline = [{'$match': filters or {}}]
+        if projection:
+            pipeline.append({'$project': projection})
+        pipeline.append({'$lookup': {'from': self.hosts_collection, 'localField': 'hosts',
+                                     'foreignField': '_id', 'as': '_hosts'}})
+        for lb_data in self.db[self.lb_collection].aggregate(pipeline):
+            hosts = dict((h['_id'], h) for h in lb_data.pop('_hosts'))
+            lb_data['hosts'] = [hosts.get(id, {'_id': id}) for id in lb_data.get('hosts', [])]
+            yield lb_data
+
+    def _find_one(self, key, find):
+        if self.cache is None:
+            return find()
+        data, generation = self.cache.get(key)
+        if data is None:
+            data = find()
+            if data is not None:
+                self.cache.set(key, data, generation)
+        return data
+
+    def _invalidate(self, *keys):
+        if self.cache is not None:
+            self.cache.invalidate(*keys)
+
+    def _projection(self, fields, required_fields):
+        if not fields:
+            return None
+        return dict((field, True) for field in tuple(required_fields) + tuple(fields))
+
+    def _hosts_collection(self):
+        return self._collection(self.hosts_collection)
+
+    def _lb_collection(self):
+        return self._collection(self.lb_collection)
+
+    def _operations_collection(self):
+        return self.db[self.operations_collection]
+
+    def _pool_collection(self):
+        return self.db[self.pool_collection]
+
+    def _collection(self, name):
+        if self.raw_documents:
+            return self.db.get_collection(name, codec_options=_raw_codec_options)
+        return self.db[name]
+
+
+def load_balancer_document(lb):
+    doc = lb.to_json()
+    doc['hosts'] = [h.to_json() for h in lb.hosts]
+    return doc
+
+
+def merge_hosts(current, documents):
+    """Returns the embedded hosts in current with documents added, replacing
+    the ones with the same id in place."""
+    by_id = dict((doc['_id'], doc) for doc in documents)
+    ids = set(doc['_id'] for doc in current)
+    merged = [by_id.get(doc['_id'], doc) for doc in current]
+    for doc in documents:
+        if doc['_id'] not in ids:
+            merged.append(by_id[doc['_id']])
+            ids.add(doc['_id'])
+    return merged
+
+
+def add_to_set(current, values):
+    """Returns current with the values it does not contain yet appended,
+    like $addToSet."""
+    merged = list(current)
+    for value in values:
+        if value not in merged:
+            merged.append(value)
+    return merged
+
+
+def bulk_store_error(error, documents):
+    details = error.details
+    if not details.get('writeErrors'):
+        return error
+    errors = [{'index': e['index'], 'id': documents[e['index']]['_id'],
+               'code': e.get('code'), 'message': e.get('errmsg')}
+              for e in details['writeErrors']]
+    written = details.get('nInserted', 0) + details.get('nUpserted', 0) + details.get('nMatched', 0)
+    return BulkStoreError(errors, written)
+
+
+def duplicate_key_error(index, id):
+    return {'index': index, 'id': id, 'code': 11000, 'message': 'duplicate key: {}'.format(id)}
+
+
+def select(documents, filters):
+    """Returns the documents matching filters, checking them once upfront so
+    unsupported filters fail even when there is nothing to match."""
+    check_filters(filters)
+    return [doc for doc in documents if _matches(doc, filters)]
+
+
+def matches(document, filters):
+    """Tells whether document matches filters, supporting the subset of the
+    MongoDB query language hm uses: equality on top-level or dotted fields,
+    reaching into embedded lists, and the $eq, $ne, $in, $nin, $exists, $gt,
+    $gte, $lt and $lte operators. Anything else raises InvalidStorage."""
+    check_filters(filters)
+    return _matches(document, filters)
+
+
+def check_filters(filters):
+    for key, value in (filters or {}).items():
+        if key.startswith('$'):
+            raise InvalidStorage("unsupported filter operator: {}".format(key))
+        for op in _operators(value):
+            if op not in _filter_operators:
+                raise InvalidStorage("unsupported filter operator: {}".format(op))
+            if op in ('$in', '$nin') and not isinstance(value[op], (list, tuple, set)):
+                raise InvalidStorage("{} needs a list, got {!r}".format(op, value[op]))
+
+
+def _matches(document, filters):
+    for key, value in (filters or {}).items():
+        candidates = _lookup(document, key.split('.'))
+        for op, arg in (_operators(value) or {'$eq': value}).items():
+            if not _filter_operators[op](candidates, arg):
+                return False
+    return True
+
+
+def _operators(value):
+    if isinstance(value, dict) and value and all(k.startswith('$') for k in value):
+        return value
+    return {}
+
+
+def _lookup(value, path):
+    """Returns the values found at path, descending into lists like MongoDB
+    does for dotted fields. A missing field yields no values."""
+    if not path:
+        return [value]
+    if isinstance(value, list):
+        found = []
+        for item in value:
+            if isinstance(item, dict):
+                found.extend(_lookup(item, path))
+        return found
+    if isinstance(value, dict) and path[0] in value:
+        return _lookup(value[path[0]], path[1:])
+    return []
+
+
+def _expand(candidates):
+    expanded = []
+    for value in candidates:
+        expanded.append(value)
+        if isinstance(value, list):
+            expanded.extend(value)
+    return expanded
+
+
+def _eq(candidates, arg):
+    if not candidates:
+        return arg is None
+    return any(value == arg for value in _expand(candidates))
+
+
+def _compare(compare):
+    def op(candidates, arg):
+        return any(value is not None and compare(value, arg) for value in _expand(candidates)
+                   if not isinstance(value, list))
+    return op
+
+
+_filter_operators = {
+    '$eq': _eq,
+    '$ne': lambda candidates, arg: not _eq(candidates, arg),
+    '$in': lambda candidates, arg: any(_eq(candidates, value) for value in arg),
+    '$nin': lambda candidates, arg: not any(_eq(candidates, value) for value in arg),
+    '$exists': lambda candidates, arg: bool(candidates) == bool(arg),
+    '$gt': _compare(lambda a, b: a > b),
+    '$gte': _compare(lambda a, b: a >= b),
+    '$lt': _compare(lambda a, b: a < b),
+    '$lte': _compare(lambda a, b: a <= b),
+}
+
+
+def project(document, fields, required_fields):
+    if not fields:
+        return document
+    keys = set(('_id',) + tuple(required_fields) + tuple(fields))
+    return dict((k, v) for k, v in document.items() if k in keys)
+
+
+class InvalidStorage(Exception):
+    pass
+
+
+class BulkStoreError(Exception):
+
+    def __init__(self, errors, written):
+        self.errors = errors
+        self.written = written
+        msg = "failed to store {} documents, {} stored: {}".format(
+            len(errors), written, errors[0]['message'])
+        super(BulkStoreError, self).__init__(msg)
+
+
+register('mongodb', MongoDBStorage)
+
+from hm.storage import memory, sqlite  # noqa
@@ -0,0 +1,115 @@
+# Copyright 2016 hm authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""Loads a JSONL dump of hosts and load balancers into the configured
+storage. Each line holds one document, as {"host": {...}} or
+{"load_balancer": {...}}, in the format hm stores them.
+
+    python -m hm.storage.importer [--batch-size N] [--ordered] dump.jsonl
+"""
+
+import argparse
+import json
+import sys
+
+from hm import config, log, model
+from hm.model.host import Host
+from hm.model.load_balancer import LoadBalancer
+from hm.storage import BulkStoreError
+
+
+class ImportResult(object):
+
+    def __init__(self):
+        self.hosts = 0
+        self.load_balancers = 0
+        self.errors = []
+
+    def __repr__(self):
+        return "{} hosts, {} load balancers, {} errors".format(
+            self.hosts, self.load_balancers, len(self.errors))
+
+
+def import_jsonl(lines, batch_size=None, ordered=False, conf=None):
+    """Streams documents from lines to the storage, writing them in batches
+    of batch_size (IMPORT_BATCH_SIZE, 500 by default). Hosts are inserted
+    and load balancers upserted. Documents that fail are kept in the
+    errors of the returned result, along with their line number. Ordered
+    imports stop at the first failure."""
+    if batch_size is None:
+        batch_size = int(config.get_config('IMPORT_BATCH_SIZE', 500, conf))
+    storage = model.storage(conf)
+    result = ImportResult()
+    batches = {'host': [], 'load_balancer': []}
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            kind, doc = json.loads(line).items()[0]
+            if kind == 'host':
+                obj = Host.from_dict(doc, conf=conf)
+            elif kind == 'load_balancer':
+                obj = LoadBalancer.from_dict(doc, conf=conf)
+            else:
+                raise ValueError("unknown document kind: {}".format(kind))
+        except Exception as e:
+            result.errors.append({'line': number, 'id': None, 'message': str(e)})
+            if ordered:
+                return result
+            continue
+        batch = batches[kind]
+        batch.append((number, obj))
+        if len(batch) >= batch_size:
+            _flush(storage, kind, batch, ordered, result)
+            if ordered and result.errors:
+                return result
+    for kind, batch in batches.items():
+        if batch:
+            _flush(storage, kind, batch, ordered, result)
+            if ordered and result.errors:
+                break
+    return result
+
+
+def _flush(storage, kind, batch, ordered, result):
+    objs = [obj for _, obj in batch]
+    try:
+        if kind == 'host':
+            storage.store_hosts(objs, ordered=ordered)
+        else:
+            storage.upsert_load_balancers(objs, ordered=ordered)
+        written = len(objs)
+    except BulkStoreError as e:
+        written = e.written
+        for error in e.errors:
+            result.errors.append({'line': batch[error['index']][0], 'id': error['id'],
+                                  'message': error['message']})
+    if kind == 'host':
+        result.hosts += written
+    else:
+        result.load_balancers += written
+    del batch[:]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Import hosts and load balancers from a JSONL dump.")
+    parser.add_argument("path", help="JSONL file, or - for stdin")
+    parser.add_argument("--batch-size", type=int, default=None)
+    parser.add_argument("--ordered", action="store_true", help="stop at the first error")
+    args = parser.parse_args(argv)
+    stream = sys.stdin if args.path == "-" else open(args.path)
+    try:
+        result = import_jsonl(stream, args.batch_size, args.ordered)
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+    for error in result.errors:
+        log.error("line {}: {}".format(error['line'], error['message']))
+    print result
+    return 1 if result.errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
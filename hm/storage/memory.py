@@ -0,0 +1,207 @@
+# Copyright 2016 hm authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import collections
+import copy
+import threading
+
+from pymongo.errors import DuplicateKeyError
+
+from hm.storage import (BulkStoreError, MongoDBStorage, add_to_set, duplicate_key_error,
+                        load_balancer_document, matches, merge_hosts, project, register, select)
+from hm.model import host, load_balancer
+
+
+_hosts = collections.OrderedDict()
+_load_balancers = collections.OrderedDict()
+_operations = collections.OrderedDict()
+_pool = collections.OrderedDict()
+_lock = threading.RLock()
+
+
+def clear():
+    with _lock:
+        _hosts.clear()
+        _load_balancers.clear()
+        _operations.clear()
+        _pool.clear()
+
+
+class MemoryStorage(object):
+    """Dict-backed storage shared by the whole process, for tests and
+    single-node deployments. Documents are copied in and out, so models
+    never share state with the stored data."""
+
+    def __init__(self, conf=None):
+        self.config = conf
+
+    def store_host(self, h):
+        doc = copy.deepcopy(h.to_json())
+        with _lock:
+            if doc['_id'] in _hosts:
+                raise DuplicateKeyError("duplicate host {}".format(doc['_id']))
+            _hosts[doc['_id']] = doc
+
+    def store_hosts(self, hosts, ordered=True):
+        documents = [copy.deepcopy(h.to_json()) for h in hosts]
+        errors = []
+        written = 0
+        with _lock:
+            for index, doc in enumerate(documents):
+                if doc['_id'] in _hosts:
+                    errors.append(duplicate_key_error(index, doc['_id']))
+                    if ordered:
+                        break
+                    continue
+                _hosts[doc['_id']] = doc
+                written += 1
+        if errors:
+            raise BulkStoreError(errors, written)
+
+    def remove_host(self, id):
+        with _lock:
+            _hosts.pop(id, None)
+
+    def remove_hosts(self, ids):
+        with _lock:
+            return len([id for id in ids if _hosts.pop(id, None) is not None])
+
+    def find_host(self, id):
+        with _lock:
+            doc = copy.deepcopy(_hosts.get(id))
+        return host.Host.from_dict(doc, conf=self.config)
+
+    def list_hosts(self, filters, fields=None, lazy=False):
+        with _lock:
+            docs = [project(copy.deepcopy(doc), fields, MongoDBStorage.host_required_fields)
+                    for doc in select(_hosts.values(), filters)]
+        hosts = (host.Host.from_dict(doc, conf=self.config) for doc in docs)
+        return hosts if lazy else list(hosts)
+
+    def count_hosts_by_alternative(self, group):
+        counts = collections.defaultdict(int)
+        with _lock:
+            for doc in _hosts.values():
+                if doc.get('group') == group:
+                    counts[doc.get('alternative_id') or 0] += 1
+        return dict(counts)
+
+    def store_load_balancer(self, lb):
+        doc = copy.deepcopy(lb.to_json())
+        with _lock:
+            if doc['_id'] in _load_balancers:
+                raise DuplicateKeyError("duplicate load balancer {}".format(doc['_id']))
+            _load_balancers[doc['_id']] = doc
+
+    def upsert_load_balancers(self, lbs, ordered=True):
+        documents = [copy.deepcopy(load_balancer_document(lb)) for lb in lbs]
+        with _lock:
+            for doc in documents:
+                _load_balancers[doc['_id']] = doc
+
+    def remove_load_balancer(self, name):
+        with _lock:
+            _load_balancers.pop(name, None)
+
+    def find_load_balancer(self, name):
+        with _lock:
+            doc = copy.deepcopy(_load_balancers.get(name))
+        return load_balancer.LoadBalancer.from_dict(doc, conf=self.config)
+
+    def list_load_balancers(self, filters, fields=None, lazy=False):
+        with _lock:
+            docs = [project(copy.deepcopy(doc), fields, MongoDBStorage.lb_required_fields)
+                    for doc in select(_load_balancers.values(), filters)]
+        lbs = (load_balancer.LoadBalancer.from_dict(doc, conf=self.config) for doc in docs)
+        return lbs if lazy else list(lbs)
+
+    def add_host_to_load_balancer(self, name, h):
+        self.add_hosts_to_load_balancer(name, [h])
+
+    def add_hosts_to_load_balancer(self, name, hosts):
+        documents = [copy.deepcopy(h.to_json()) for h in hosts]
+        with _lock:
+            lb = _load_balancers.get(name)
+            if lb is not None:
+                lb['hosts'] = merge_hosts(lb.get('hosts', []), documents)
+
+    def remove_host_from_load_balancer(self, name, h):
+        self.remove_hosts_from_load_balancer(name, [h])
+
+    def remove_hosts_from_load_balancer(self, name, hosts):
+        ids = set(h.id for h in hosts)
+        with _lock:
+            lb = _load_balancers.get(name)
+            if lb is not None and 'hosts' in lb:
+                lb['hosts'] = [doc for doc in lb['hosts'] if doc['_id'] not in ids]
+
+    def add_load_balancer_networks(self, name, network_ids):
+        with _lock:
+            lb = _load_balancers.get(name)
+            if lb is not None:
+                lb['vip_networks'] = add_to_set(lb.get('vip_networks', []), network_ids)
+
+    def remove_load_balancer_networks(self, name, network_ids):
+        network_ids = set(network_ids)
+        with _lock:
+            lb = _load_balancers.get(name)
+            if lb is not None and 'vip_networks' in lb:
+                lb['vip_networks'] = [id for id in lb['vip_networks'] if id not in network_ids]
+
+    def store_operation(self, doc):
+        doc = copy.deepcopy(doc)
+        with _lock:
+            if doc['_id'] in _operations:
+                raise DuplicateKeyError("duplicate operation {}".format(doc['_id']))
+            _operations[doc['_id']] = doc
+
+    def add_operation_step(self, id, step, fields=None):
+        with _lock:
+            op = _operations.get(id)
+            if op is not None:
+                op.setdefault('steps', []).append(copy.deepcopy(step))
+                op.update(copy.deepcopy(fields or {}))
+
+    def remove_operation_step(self, id, query):
+        with _lock:
+            op = _operations.get(id)
+            if op is not None:
+                op['steps'] = [step for step in op.get('steps', []) if not matches(step, query)]
+
+    def update_operation(self, id, fields, expected=None):
+        with _lock:
+            op = _operations.get(id)
+            if op is None or not matches(op, expected):
+                return False
+            op.update(copy.deepcopy(fields))
+            return True
+
+    def list_operations(self, filters):
+        with _lock:
+            return [copy.deepcopy(op) for op in select(_operations.values(), filters)]
+
+    def remove_operation(self, id):
+        with _lock:
+            _operations.pop(id, None)
+
+    def store_pool_item(self, doc):
+        doc = copy.deepcopy(doc)
+        with _lock:
+            if doc['_id'] in _pool:
+                raise DuplicateKeyError("duplicate pool item {}".format(doc['_id']))
+            _pool[doc['_id']] = doc
+
+    def claim_pool_item(self, filters):
+        with _lock:
+            docs = select(_pool.values(), filters)
+            if not docs:
+                return None
+            return _pool.pop(min(docs, key=lambda doc: doc.get('created_at'))['_id'])
+
+    def count_pool_items(self, filters):
+        with _lock:
+            return len(select(_pool.values(), filters))
+
+
+register('memory', MemoryStorage)
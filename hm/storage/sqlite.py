@@ -0,0 +1,329 @@
+# Copyright 2016 hm authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import collections
+import json
+import sqlite3
+import threading
+
+from pymongo.errors import DuplicateKeyError
+
+from hm import config
+from hm.storage import (BulkStoreError, MongoDBStorage, add_to_set, check_filters, duplicate_key_error,
+                        load_balancer_document, matches, merge_hosts, project, register,
+                        select)
+from hm.model import host, load_balancer
+
+
+_connections = {}
+_connections_lock = threading.Lock()
+
+_schema = """
+CREATE TABLE IF NOT EXISTS hosts (
+    id TEXT PRIMARY KEY,
+    group_name TEXT,
+    manager TEXT,
+    alternative_id INTEGER,
+    document TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS hosts_group ON hosts (group_name, alternative_id);
+CREATE INDEX IF NOT EXISTS hosts_manager ON hosts (manager);
+CREATE TABLE IF NOT EXISTS load_balancers (
+    name TEXT PRIMARY KEY,
+    manager TEXT,
+    document TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS load_balancers_manager ON load_balancers (manager);
+CREATE TABLE IF NOT EXISTS operations (
+    id TEXT PRIMARY KEY,
+    document TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pool (
+    id TEXT PRIMARY KEY,
+    kind TEXT,
+    manager TEXT,
+    created_at REAL,
+    document TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS pool_kind_manager ON pool (kind, manager, created_at);
+"""
+
+
+def get_connection(path):
+    """Returns the connection shared by every storage using path, and the
+    lock serializing its use."""
+    with _connections_lock:
+        entry = _connections.get(path)
+        if entry is None:
+            conn = sqlite3.connect(path, check_same_thread=False)
+            conn.executescript(_schema)
+            entry = _connections[path] = (conn, threading.RLock())
+        return entry
+
+
+def close():
+    with _connections_lock:
+        entries = list(_connections.values())
+        _connections.clear()
+    for conn, _ in entries:
+        conn.close()
+
+
+class SQLiteStorage(object):
+    """Storage keeping each document as JSON in a SQLite database set by
+    SQLITE_PATH, with the fields hm filters on copied to indexed columns."""
+
+    host_columns = {'_id': 'id', 'group': 'group_name', 'manager': 'manager',
+                    'alternative_id': 'alternative_id'}
+    lb_columns = {'_id': 'name', 'manager': 'manager'}
+    pool_columns = {'_id': 'id', 'kind': 'kind', 'manager': 'manager'}
+    insert_host = ("INSERT INTO hosts (id, group_name, manager, alternative_id, document) "
+                   "VALUES (?, ?, ?, ?, ?)")
+    max_variables = 500
+
+    def __init__(self, conf=None):
+        self.config = conf
+        self.path = config.get_config('SQLITE_PATH', 'hm.db', conf)
+        self.conn, self.lock = get_connection(self.path)
+
+    def store_host(self, h):
+        with self.lock:
+            try:
+                with self.conn:
+                    self.conn.execute(self.insert_host, self._host_row(h.to_json()))
+            except sqlite3.IntegrityError as e:
+                raise DuplicateKeyError(str(e))
+
+    def store_hosts(self, hosts, ordered=True):
+        rows = [self._host_row(h.to_json()) for h in hosts]
+        errors = []
+        written = 0
+        with self.lock, self.conn:
+            for index, row in enumerate(rows):
+                try:
+                    self.conn.execute(self.insert_host, row)
+                except sqlite3.IntegrityError:
+                    errors.append(duplicate_key_error(index, row[0]))
+                    if ordered:
+                        break
+                    continue
+                written += 1
+        if errors:
+            raise BulkStoreError(errors, written)
+
+    def remove_host(self, id):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM hosts WHERE id = ?", (id,))
+
+    def remove_hosts(self, ids):
+        ids = list(ids)
+        removed = 0
+        with self.lock, self.conn:
+            for i in range(0, len(ids), self.max_variables):
+                chunk = ids[i:i + self.max_variables]
+                cursor = self.conn.execute(
+                    "DELETE FROM hosts WHERE id IN ({})".format(", ".join("?" * len(chunk))), chunk)
+                removed += cursor.rowcount
+        return removed
+
+    def find_host(self, id):
+        docs = self._select("hosts", self.host_columns, {'_id': id})
+        return host.Host.from_dict(docs[0] if docs else None, conf=self.config)
+
+    def list_hosts(self, filters, fields=None, lazy=False):
+        docs = self._select("hosts", self.host_columns, filters)
+        hosts = (host.Host.from_dict(project(doc, fields, MongoDBStorage.host_required_fields),
+                                     conf=self.config) for doc in docs)
+        return hosts if lazy else list(hosts)
+
+    def count_hosts_by_alternative(self, group):
+        counts = collections.defaultdict(int)
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT COALESCE(alternative_id, 0), COUNT(*) FROM hosts WHERE group_name = ? "
+                "GROUP BY COALESCE(alternative_id, 0)", (group,)).fetchall()
+        for alternative_id, count in rows:
+            counts[alternative_id] += count
+        return dict(counts)
+
+    def store_load_balancer(self, lb):
+        doc = lb.to_json()
+        with self.lock:
+            try:
+                with self.conn:
+                    self.conn.execute("INSERT INTO load_balancers (name, manager, document) VALUES (?, ?, ?)",
+                                      (doc['_id'], doc.get('manager'), json.dumps(doc)))
+            except sqlite3.IntegrityError as e:
+                raise DuplicateKeyError(str(e))
+
+    def upsert_load_balancers(self, lbs, ordered=True):
+        rows = [(doc['_id'], doc.get('manager'), json.dumps(doc)) for doc in map(load_balancer_document, lbs)]
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO load_balancers (name, manager, document) "
+                                  "VALUES (?, ?, ?)", rows)
+
+    def remove_load_balancer(self, name):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM load_balancers WHERE name = ?", (name,))
+
+    def find_load_balancer(self, name):
+        docs = self._select("load_balancers", self.lb_columns, {'_id': name})
+        return load_balancer.LoadBalancer.from_dict(docs[0] if docs else None, conf=self.config)
+
+    def list_load_balancers(self, filters, fields=None, lazy=False):
+        docs = self._select("load_balancers", self.lb_columns, filters)
+        lbs = (load_balancer.LoadBalancer.from_dict(
+            project(doc, fields, MongoDBStorage.lb_required_fields), conf=self.config)
+            for doc in docs)
+        return lbs if lazy else list(lbs)
+
+    def add_host_to_load_balancer(self, name, h):
+        self.add_hosts_to_load_balancer(name, [h])
+
+    def add_hosts_to_load_balancer(self, name, hosts):
+        documents = [h.to_json() for h in hosts]
+        self._update_lb(name, 'hosts', lambda current: merge_hosts(current, documents))
+
+    def remove_host_from_load_balancer(self, name, h):
+        self.remove_hosts_from_load_balancer(name, [h])
+
+    def remove_hosts_from_load_balancer(self, name, hosts):
+        ids = set(h.id for h in hosts)
+        self._update_lb(name, 'hosts', lambda current: [doc for doc in current if doc['_id'] not in ids])
+
+    def add_load_balancer_networks(self, name, network_ids):
+        self._update_lb(name, 'vip_networks', lambda current: add_to_set(current, network_ids))
+
+    def remove_load_balancer_networks(self, name, network_ids):
+        network_ids = set(network_ids)
+        self._update_lb(name, 'vip_networks', lambda current: [id for id in current if id not in network_ids])
+
+    def store_operation(self, doc):
+        with self.lock:
+            try:
+                with self.conn:
+                    self.conn.execute("INSERT INTO operations (id, document) VALUES (?, ?)",
+                                      (doc['_id'], json.dumps(doc)))
+            except sqlite3.IntegrityError as e:
+                raise DuplicateKeyError(str(e))
+
+    def add_operation_step(self, id, step, fields=None):
+        def update(op):
+            op.setdefault('steps', []).append(step)
+            op.update(fields or {})
+        self._update_operation(id, update)
+
+    def remove_operation_step(self, id, query):
+        def update(op):
+            op['steps'] = [step for step in op.get('steps', []) if not matches(step, query)]
+        self._update_operation(id, update)
+
+    def update_operation(self, id, fields, expected=None):
+        def update(op):
+            if not matches(op, expected):
+                return False
+            op.update(fields)
+        return self._update_operation(id, update)
+
+    def list_operations(self, filters):
+        with self.lock:
+            rows = self.conn.execute("SELECT document FROM operations").fetchall()
+        return select([json.loads(row[0]) for row in rows], filters)
+
+    def remove_operation(self, id):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM operations WHERE id = ?", (id,))
+
+    def store_pool_item(self, doc):
+        with self.lock:
+            try:
+                with self.conn:
+                    self.conn.execute("INSERT INTO pool (id, kind, manager, created_at, document) "
+                                      "VALUES (?, ?, ?, ?, ?)",
+                                      (doc['_id'], doc.get('kind'), doc.get('manager'), doc.get('created_at'),
+                                       json.dumps(doc)))
+            except sqlite3.IntegrityError as e:
+                raise DuplicateKeyError(str(e))
+
+    def claim_pool_item(self, filters):
+        """Removes and returns the oldest item matching filters. Deleting the
+        row is what claims it: when another process deletes a candidate
+        first, the next one is tried."""
+        for doc in self._select("pool", self.pool_columns, filters, order="created_at"):
+            with self.lock, self.conn:
+                cursor = self.conn.execute("DELETE FROM pool WHERE id = ?", (doc['_id'],))
+            if cursor.rowcount == 1:
+                return doc
+        return None
+
+    def count_pool_items(self, filters):
+        return len(self._select("pool", self.pool_columns, filters))
+
+    def _update_operation(self, id, update):
+        """Applies update to the stored operation. The write only succeeds
+        if the document is still the one read, so a change made meanwhile by
+        another process is retried against the new version, where update
+        may refuse it."""
+        while True:
+            with self.lock:
+                row = self.conn.execute("SELECT document FROM operations WHERE id = ?", (id,)).fetchone()
+            if row is None:
+                return False
+            op = json.loads(row[0])
+            if update(op) is False:
+                return False
+            with self.lock, self.conn:
+                cursor = self.conn.execute("UPDATE operations SET document = ? WHERE id = ? AND document = ?",
+                                           (json.dumps(op), id, row[0]))
+            if cursor.rowcount == 1:
+                return True
+
+    def _update_lb(self, name, field, update):
+        """Replaces field of the stored load balancer with update applied to
+        its current value, retrying like _update_operation when another
+        process changed the load balancer meanwhile."""
+        while True:
+            with self.lock:
+                row = self.conn.execute("SELECT document FROM load_balancers WHERE name = ?",
+                                        (name,)).fetchone()
+            if row is None:
+                return
+            doc = json.loads(row[0])
+            doc[field] = update(doc.get(field, []))
+            with self.lock, self.conn:
+                cursor = self.conn.execute(
+                    "UPDATE load_balancers SET document = ? WHERE name = ? AND document = ?",
+                    (json.dumps(doc), name, row[0]))
+            if cursor.rowcount == 1:
+                return
+
+    def _select(self, table, columns, filters, order=None):
+        clauses = []
+        params = []
+        remaining = {}
+        check_filters(filters)
+        for key, value in (filters or {}).items():
+            column = columns.get(key)
+            if column is None or isinstance(value, dict):
+                remaining[key] = value
+            elif value is None:
+                clauses.append("{} IS NULL".format(column))
+            else:
+                clauses.append("{} = ?".format(column))
+                params.append(value)
+        query = "SELECT document FROM {}".format(table)
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+        if order:
+            query += " ORDER BY {}".format(order)
+        with self.lock:
+            rows = self.conn.execute(query, params).fetchall()
+        return select([json.loads(row[0]) for row in rows], remaining)
+
+    def _host_row(self, doc):
+        return (doc['_id'], doc.get('group'), doc.get('manager'), doc.get('alternative_id'),
+                json.dumps(doc))
+
+
+register('sqlite', SQLiteStorage)
@@ -0,0 +1,116 @@
+# Copyright 2016 hm authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import threading
+
+import pymongo
+
+from hm import log
+
+
+class CacheWatcher(object):
+    """Invalidates cached documents changed by any process, so a document
+    cache stays coherent within about interval seconds. It follows MongoDB
+    change streams when the driver supports them and polls the replica set
+    oplog otherwise. collections maps collection names to the prefix of
+    their cache keys. When changes may have been missed, the whole cache
+    is cleared. Both need a replica set: start raises WatcherUnavailable
+    on a standalone server."""
+
+    def __init__(self, db, cache, collections, interval=1):
+        self.db = db
+        self.cache = cache
+        self.collections = collections
+        self.interval = interval
+        self.use_change_streams = all(hasattr(db[name], "watch") for name in collections)
+        self.last_ts = None
+        self._stop = threading.Event()
+
+    def start(self):
+        self._check_deployment()
+        if self.use_change_streams:
+            targets = [(self._watch_changes, (name, prefix)) for name, prefix in self.collections.items()]
+        else:
+            self.last_ts = self._latest_ts()
+            targets = [(self._poll_oplog, ())]
+        for target, args in targets:
+            thread = threading.Thread(target=target, args=args, name="hm-cache-watcher")
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def poll(self):
+        namespaces = dict(("{}.{}".format(self.db.name, name), prefix)
+                          for name, prefix in self.collections.items())
+        oplog = self._oplog()
+        query = {"ns": {"$in": list(namespaces)}}
+        if self.last_ts is not None:
+            first = oplog.find_one(sort=[("$natural", pymongo.ASCENDING)])
+            if first is not None and first["ts"] > self.last_ts:
+                self.cache.clear()
+            query["ts"] = {"$gt": self.last_ts}
+        keys = []
+        for entry in oplog.find(query, oplog_replay=True):
+            self.last_ts = entry["ts"]
+            if entry["op"] == "u":
+                doc_id = entry.get("o2", {}).get("_id")
+            elif entry["op"] in ("i", "d"):
+                doc_id = entry["o"].get("_id")
+            else:
+                doc_id = None
+            if doc_id is None:
+                self.cache.clear()
+            else:
+                keys.append((namespaces[entry["ns"]], doc_id))
+        if keys:
+            self.cache.invalidate(*keys)
+
+    def _poll_oplog(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.poll()
+            except Exception:
+                log.exception("error polling the oplog, clearing cache")
+                self.cache.clear()
+
+    def _watch_changes(self, name, prefix):
+        while not self._stop.is_set():
+            try:
+                with self.db[name].watch() as stream:
+                    for change in stream:
+                        doc_id = change.get("documentKey", {}).get("_id")
+                        if doc_id is None:
+                            self.cache.clear()
+                        else:
+                            self.cache.invalidate((prefix, doc_id))
+                        if self._stop.is_set():
+                            return
+            except Exception:
+                log.exception("error watching {} changes, clearing cache".format(name))
+                self.cache.clear()
+                self._stop.wait(self.interval)
+
+    def _check_deployment(self):
+        info = self.db.client.admin.command("ismaster")
+        if info.get("msg") == "isdbgrid":
+            if self.use_change_streams:
+                return
+            raise WatcherUnavailable("mongos has no oplog, changes can't be watched without change streams")
+        if not info.get("setName"):
+            raise WatcherUnavailable("not a replica set member, there is no oplog to watch")
+        if not self.use_change_streams and "oplog.rs" not in self.db.client.local.collection_names():
+            raise WatcherUnavailable("local.oplog.rs not found")
+
+    def _latest_ts(self):
+        last = self._oplog().find_one(sort=[("$natural", pymongo.DESCENDING)])
+        return last["ts"] if last is not None else None
+
+    def _oplog(self):
+        return self.db.client.local["oplog.rs"]
+
+
+class WatcherUnavailable(Exception):
+    pass
@@ -29,6 +29,7 @@ setup(
         "pymongo==3.3.0",
         "requests==2.4.3",
         "GloboNetworkAPI==0.2.2",
+        "futures==3.3.0",
     ],
     extras_require={
         'tests': [
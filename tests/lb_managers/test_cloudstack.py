@@ -2,9 +2,22 @@
 import unittest
 
 import mock
+from concurrent import futures
 
+from hm import journal, model
+from hm.iaas.cloudstack_client import AsyncJobError
 from hm.lb_managers import cloudstack
 from hm.model import load_balancer, host
+from hm.storage import memory
+
+
+def done(result=None, exception=None):
+    future = futures.Future()
+    if exception is not None:
+        future.set_exception(exception)
+    else:
+        future.set_result(result)
+    return future
 
 
 class CloudstackLBTestCase(unittest.TestCase):
@@ -137,6 +150,94 @@ class CloudstackLBTestCase(unittest.TestCase):
             'projectid': 'proj-123',
         })
 
+    @mock.patch("hm.lb_managers.cloudstack.CloudStack")
+    def test_create_load_balancer_journal(self, cs_mock):
+        memory.clear()
+        self.addCleanup(memory.clear)
+        conf = {"STORAGE_ENGINE": "memory", "HM_JOURNAL": "true"}
+        cs_instance = cs_mock.return_value
+        cs_instance.make_request.side_effect = [{'id': 'lb-ip-id', 'jobid': 'j1'},
+                                                Exception("dissociate error")]
+        cs_instance.createLoadBalancerRule.side_effect = Exception("some error")
+        cs_instance.wait_for_job.return_value = {'jobresult': True}
+        manager = cloudstack.CloudstackLB(self.conf)
+        with self.assertRaises(Exception):
+            with journal.operation("create_load_balancer", "cloudstack", conf):
+                manager.create_load_balancer("tsuru")
+        storage = model.storage(conf)
+        ops = storage.list_operations({})
+        self.assertEqual(ops[0]["steps"], [{"name": "associate_ip", "ip_id": "lb-ip-id",
+                                            "project_id": "proj-123"}])
+        cs_instance.make_request.side_effect = None
+        cs_instance.make_request.reset_mock()
+        manager.rollback_operation(journal.Operation(storage, ops[0]))
+        cs_instance.make_request.assert_called_once_with('disassociateIpAddress', {
+            'projectid': 'proj-123',
+            'id': 'lb-ip-id',
+        })
+        self.assertEqual(storage.list_operations({})[0]["steps"], [])
+
+    @mock.patch("hm.lb_managers.cloudstack.CloudStack")
+    def test_create_load_balancer_journal_rolled_back_inline(self, cs_mock):
+        memory.clear()
+        self.addCleanup(memory.clear)
+        conf = {"STORAGE_ENGINE": "memory", "HM_JOURNAL": "true"}
+        cs_instance = cs_mock.return_value
+        cs_instance.make_request.return_value = {'id': 'lb-ip-id', 'jobid': 'j1'}
+        cs_instance.createLoadBalancerRule.side_effect = Exception("some error")
+        cs_instance.wait_for_job.return_value = {'jobresult': True}
+        manager = cloudstack.CloudstackLB(self.conf)
+        with self.assertRaises(Exception):
+            with journal.operation("create_load_balancer", "cloudstack", conf):
+                manager.create_load_balancer("tsuru")
+        self.assertEqual(model.storage(conf).list_operations({}), [])
+
+    @mock.patch("hm.lb_managers.cloudstack.CloudStack")
+    def test_create_pool_load_balancer(self, cs_mock):
+        cs_instance = cs_mock.return_value
+        cs_instance.make_request.return_value = {'id': 'lb-ip-id'}
+        cs_instance.createLoadBalancerRule.return_value = {'id': 'lb-id', 'jobid': 'j2'}
+        cs_instance.wait_for_job.return_value = {'jobresult': {'loadbalancer': {'publicip': '192.168.1.5'}}}
+        manager = cloudstack.CloudstackLB(dict(self.conf, LB_POOL_NAME_PREFIX='pool-'))
+        lb = manager.create_pool_load_balancer()
+        self.assertTrue(lb.name.startswith('pool-'))
+        self.assertEqual(cs_instance.createLoadBalancerRule.call_args[0][0]['name'], lb.name + '.abc.com')
+        self.assertNotEqual(manager.create_pool_load_balancer().name, lb.name)
+
+    @mock.patch("hm.lb_managers.cloudstack.CloudStack")
+    def test_claim_pool_load_balancer(self, cs_mock):
+        cs_instance = cs_mock.return_value
+        cs_instance.updateLoadBalancerRule.return_value = {'jobid': 'j1'}
+        cs_instance.wait_for_job.return_value = {'jobresult': True}
+        lb = load_balancer.LoadBalancer('lb-id', 'hm-pool-abc', '10.0.0.1', ip_id='ip-id',
+                                        project_id='projid')
+        manager = cloudstack.CloudstackLB(self.conf)
+        self.assertIs(manager.claim_pool_load_balancer(lb, 'tsuru'), lb)
+        self.assertEqual(lb.name, 'tsuru')
+        cs_instance.updateLoadBalancerRule.assert_called_once_with({
+            'id': 'lb-id',
+            'name': 'tsuru.abc.com',
+            'projectid': 'projid',
+        })
+        cs_instance.wait_for_job.assert_called_once_with('j1', manager.polling)
+
+    @mock.patch("hm.lb_managers.cloudstack.CloudStack")
+    def test_rollback_claimed_pool_load_balancer(self, cs_mock):
+        cs_instance = cs_mock.return_value
+        cs_instance.deleteLoadBalancerRule.return_value = {}
+        cs_instance.make_request.return_value = {}
+        lb = load_balancer.LoadBalancer('lb-id', 'hm-pool-abc', '10.0.0.1', ip_id='ip-id',
+                                        project_id='projid')
+        op = mock.Mock(steps=[{'name': 'claim_pool_lb', 'document': lb.to_json()}])
+        manager = cloudstack.CloudstackLB(self.conf)
+        manager.rollback_operation(op)
+        cs_instance.deleteLoadBalancerRule.assert_called_once_with({'id': 'lb-id', 'projectid': 'projid'})
+        cs_instance.make_request.assert_called_once_with('disassociateIpAddress', {
+            'id': 'ip-id',
+            'projectid': 'projid',
+        })
+        op.forget.assert_called_once_with('claim_pool_lb')
+
     @mock.patch("hm.lb_managers.cloudstack.CloudStack")
     def test_attach_real(self, cs_mock):
         cs_instance = cs_mock.return_value
@@ -162,6 +263,48 @@ class CloudstackLBTestCase(unittest.TestCase):
             'virtualmachineids': 'hostid',
         })
 
+    @mock.patch("hm.lb_managers.cloudstack.CloudStack")
+    def test_attach_real_stored_nics(self, cs_mock):
+        cs_instance = cs_mock.return_value
+        cs_instance.make_request.return_value = {}
+        cs_instance.assignToLoadBalancerRule.return_value = {}
+        lb = load_balancer.LoadBalancer('lbid', 'lbname', 'lbaddr', ip_id='ip_id', project_id='projid')
+        h = host.Host('hostid', 'hostaddr', nics=[{'id': 'nic1', 'networkid': 'netid1'}])
+        manager = cloudstack.CloudstackLB(self.conf)
+        manager.attach_real(lb, h)
+        self.assertFalse(cs_instance.listVirtualMachines.called)
+        cs_instance.make_request.assert_called_once_with('assignNetwork', {
+            'id': 'lbid',
+            'networkids': 'netid1',
+            'projectid': 'projid',
+        })
+
+    @mock.patch("hm.lb_managers.cloudstack.log")
+    @mock.patch("hm.lb_managers.cloudstack.CloudStack")
+    def test_attach_reals_stale_stored_nics(self, cs_mock, log):
+        cs_instance = cs_mock.return_value
+        cs_instance.make_request.return_value = {'jobid': 'j1'}
+        cs_instance.assignToLoadBalancerRule.return_value = {}
+        cs_instance.wait_for_job.side_effect = [AsyncJobError("no such network"), {'jobresult': True}]
+        vms = {"virtualmachine": [
+            {"id": "h1", "nic": [{"id": "nic1", "networkid": "netid1"}]},
+            {"id": "h2", "nic": [{"id": "nic2", "networkid": "netid3"}]},
+        ]}
+        cs_instance.listVirtualMachines.return_value = vms
+        lb = load_balancer.LoadBalancer('lbid', 'lbname', 'lbaddr', ip_id='ip_id', project_id='projid')
+        hosts = [host.Host('h1', 'h1addr', nics=[{'id': 'nic1', 'networkid': 'netid1'}]),
+                 host.Host('h2', 'h2addr', nics=[{'id': 'nic2', 'networkid': 'netid2'}])]
+        manager = cloudstack.CloudstackLB(self.conf)
+        manager.attach_reals(lb, hosts)
+        cs_instance.listVirtualMachines.assert_called_once_with({'ids': 'h1,h2', 'projectid': 'projid'})
+        self.assertEqual([c[0][1]['networkids'] for c in cs_instance.make_request.call_args_list],
+                         ['netid1,netid2', 'netid1,netid3'])
+        cs_instance.assignToLoadBalancerRule.assert_called_once_with({
+            'id': 'lbid',
+            'projectid': 'projid',
+            'virtualmachineids': 'h1,h2',
+        })
+
     @mock.patch("hm.lb_managers.cloudstack.CloudStack")
     def test_detach_real(self, cs_mock):
         cs_instance = cs_mock.return_value
@@ -175,7 +318,92 @@ class CloudstackLBTestCase(unittest.TestCase):
             'projectid': 'projid',
             'virtualmachineids': 'hostid',
         })
-        cs_instance.wait_for_job.assert_called_with('j1', 100)
+        cs_instance.wait_for_job.assert_called_with('j1', manager.polling)
+
+    @mock.patch("hm.lb_managers.cloudstack.CloudStack")
+    def test_attach_reals(self, cs_mock):
+        cs_instance = cs_mock.return_value
+        cs_instance.make_request.return_value = {'jobid': 'j1'}
+        cs_instance.assignToLoadBalancerRule.return_value = {'jobid': 'j2'}
+        cs_instance.wait_for_job.return_value = {'jobresult': True}
+        vms = {"virtualmachine": [
+            {"id": "h1", "nic": [{"id": "n1", "networkid": "netid2"}]},
+            {"id": "h2", "nic": [{"id": "n2", "networkid": "netid1"}]},
+            {"id": "h3", "nic": [{"id": "n3", "networkid": "netid1"}]},
+        ]}
+        cs_instance.listVirtualMachines.return_value = vms
+        lb = load_balancer.LoadBalancer('lbid', 'lbname', 'lbaddr', ip_id='ip_id', project_id='projid')
+        hosts = [host.Host('h1', 'addr1'), host.Host('h2', 'addr2'), host.Host('h3', 'addr3')]
+        manager = cloudstack.CloudstackLB(self.conf)
+        manager.attach_reals(lb, hosts)
+        cs_instance.listVirtualMachines.assert_called_once_with({'ids': 'h1,h2,h3', 'projectid': 'projid'})
+        cs_instance.make_request.assert_called_once_with('assignNetwork', {
+            'id': 'lbid',
+            'networkids': 'netid1,netid2',
+            'projectid': 'projid',
+        })
+        cs_instance.assignToLoadBalancerRule.assert_called_once_with({
+            'id': 'lbid',
+            'projectid': 'projid',
+            'virtualmachineids': 'h1,h2,h3',
+        })
+        cs_instance.wait_for_job.assert_called_with('j2', manager.polling)
+
+    @mock.patch("hm.lb_managers.cloudstack.CloudStack")
+    def test_detach_reals(self, cs_mock):
+        cs_instance = cs_mock.return_value
+        cs_instance.removeFromLoadBalancerRule.return_value = {'jobid': 'j1'}
+        lb = load_balancer.LoadBalancer('lbid', 'lbname', 'lbaddr', ip_id='ip_id', project_id='projid')
+        hosts = [host.Host('h1', 'addr1'), host.Host('h2', 'addr2')]
+        manager = cloudstack.CloudstackLB(self.conf)
+        manager.detach_reals(lb, hosts)
+        cs_instance.removeFromLoadBalancerRule.assert_called_once_with({
+            'id': 'lbid',
+            'projectid': 'projid',
+            'virtualmachineids': 'h1,h2',
+        })
+        cs_instance.wait_for_job.assert_called_once_with('j1', manager.polling)
+
+    def test_attach_real_async(self):
+        manager = cloudstack.CloudstackLB(self.conf)
+        manager.async_client = client = mock.Mock()
+        vms = {"virtualmachine": [{"id": "abc123", "nic": [{"id": "def456", "networkid": "netid1"}]}]}
+        client.listVirtualMachines.return_value = done(vms)
+        client.make_request.return_value = done({'jobid': 'j1'})
+        client.assignToLoadBalancerRule.return_value = done({'jobid': 'j2'})
+        client.wait_for_job.side_effect = [done(exception=AsyncJobError("net error")),
+                                           done({'jobresult': True})]
+        lb = load_balancer.LoadBalancer('lbid', 'lbname', 'lbaddr', ip_id='ip_id', project_id='projid')
+        h = host.Host('hostid', 'hostaddr')
+        with mock.patch("hm.lb_managers.cloudstack.log") as log:
+            manager.attach_real_async(lb, h).result(5)
+        log.exception.assert_called_with('ignored error assigning network to lb')
+        client.make_request.assert_called_once_with('assignNetwork', {
+            'id': 'lbid',
+            'networkids': 'netid1',
+            'projectid': 'projid',
+        })
+        client.assignToLoadBalancerRule.assert_called_once_with({
+            'id': 'lbid',
+            'projectid': 'projid',
+            'virtualmachineids': 'hostid',
+        })
+        client.wait_for_job.assert_called_with('j2', manager.polling)
+
+    def test_detach_real_async(self):
+        manager = cloudstack.CloudstackLB(self.conf)
+        manager.async_client = client = mock.Mock()
+        client.removeFromLoadBalancerRule.return_value = done({'jobid': 'j1'})
+        client.wait_for_job.return_value = done({'jobresult': True})
+        lb = load_balancer.LoadBalancer('lbid', 'lbname', 'lbaddr', ip_id='ip_id', project_id='projid')
+        h = host.Host('hostid', 'hostaddr')
+        manager.detach_real_async(lb, h).result(5)
+        client.removeFromLoadBalancerRule.assert_called_once_with({
+            'id': 'lbid',
+            'projectid': 'projid',
+            'virtualmachineids': 'hostid',
+        })
+        client.wait_for_job.assert_called_with('j1', manager.polling)
 
     @mock.patch("hm.lb_managers.cloudstack.CloudStack")
     def test_destroy_load_balancer(self, cs_mock):
@@ -193,5 +421,5 @@ class CloudstackLBTestCase(unittest.TestCase):
             'id': 'ipid',
             'projectid': 'projid',
         })
-        cs_instance.wait_for_job.assert_any_call('j1', 100)
-        cs_instance.wait_for_job.assert_any_call('j2', 100)
+        cs_instance.wait_for_job.assert_any_call('j1', manager.polling)
+        cs_instance.wait_for_job.assert_any_call('j2', manager.polling)
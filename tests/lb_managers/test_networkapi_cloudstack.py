@@ -4,6 +4,8 @@ import unittest
 import mock
 from networkapiclient.exception import IpNaoExisteError
 
+from hm import lb_managers
+from hm.iaas import transport
 from hm.lb_managers import networkapi_cloudstack
 from hm.model import load_balancer, host
 
@@ -121,6 +123,41 @@ class NetworkApiCloudstackLBTestCase(unittest.TestCase):
         client_vip.criar.assert_called_with(27)
         logger.debug.assert_called_with(u"VIP request 27 successfully created.")
 
+    @mock.patch("networkapiclient.EnvironmentVIP.EnvironmentVIP")
+    @mock.patch("networkapiclient.Ip.Ip")
+    @mock.patch("networkapiclient.Vip.Vip")
+    def test_create_load_balancer_reuses_clients_and_environment_vip(self, Vip, Ip, EnvironmentVIP):
+        EnvironmentVIP.return_value.search.return_value = {"environment_vip": {"id": 500}}
+        ip = {"id": 303, "oct1": "192", "oct2": "168", "oct3": "1", "oct4": "7"}
+        Ip.return_value.get_available_ip4_for_vip.return_value = {"ip": ip}
+        Vip.return_value.add.return_value = {"requisicao_vip": {"id": 27}}
+        manager = networkapi_cloudstack.NetworkApiCloudstackLB(self.conf)
+        manager.create_load_balancer("tsuru")
+        manager.create_load_balancer("other")
+        self.assertEqual(EnvironmentVIP.return_value.search.call_count, 1)
+        self.assertEqual((EnvironmentVIP.call_count, Ip.call_count, Vip.call_count), (1, 1, 1))
+        Ip.return_value.get_available_ip4_for_vip.assert_called_with(500, u"tsuru hm other")
+        Ip.return_value.get_available_ip4_for_vip.side_effect = Exception("environment vip not found")
+        with self.assertRaises(Exception):
+            manager.create_load_balancer("failed")
+        Ip.return_value.get_available_ip4_for_vip.side_effect = None
+        manager.create_load_balancer("tsuru")
+        self.assertEqual(EnvironmentVIP.return_value.search.call_count, 2)
+
+    @mock.patch("networkapiclient.EnvironmentVIP.EnvironmentVIP")
+    @mock.patch("networkapiclient.Ip.Ip")
+    @mock.patch("networkapiclient.Vip.Vip")
+    def test_create_load_balancer_environment_vip_cache_disabled(self, Vip, Ip, EnvironmentVIP):
+        EnvironmentVIP.return_value.search.return_value = {"environment_vip": {"id": 500}}
+        ip = {"id": 303, "oct1": "192", "oct2": "168", "oct3": "1", "oct4": "7"}
+        Ip.return_value.get_available_ip4_for_vip.return_value = {"ip": ip}
+        Vip.return_value.add.return_value = {"requisicao_vip": {"id": 27}}
+        self.conf["NETWORKAPI_ENVIRONMENT_VIP_CACHE_TTL"] = "0"
+        manager = networkapi_cloudstack.NetworkApiCloudstackLB(self.conf)
+        manager.create_load_balancer("tsuru")
+        manager.create_load_balancer("tsuru")
+        self.assertEqual(EnvironmentVIP.return_value.search.call_count, 2)
+
     @mock.patch("hm.lb_managers.networkapi_cloudstack.CloudStack")
     @mock.patch("networkapiclient.EnvironmentVIP.EnvironmentVIP")
     @mock.patch("networkapiclient.Ip.Ip")
@@ -232,6 +269,30 @@ class NetworkApiCloudstackLBTestCase(unittest.TestCase):
         data = {"projectid": "project_id-x", "vipid": "404"}
         cloudstack_client.removeGloboNetworkVip.assert_called_with(data)
 
+    @mock.patch("networkapiclient.Ip.Ip")
+    def test_claim_pool_load_balancer(self, Ip):
+        client_ip = Ip.return_value
+        lb = load_balancer.LoadBalancer("404", "hm-pool-abc", "192.168.1.1", ip_id=303)
+        manager = networkapi_cloudstack.NetworkApiCloudstackLB(self.conf)
+        self.assertIs(manager.claim_pool_load_balancer(lb, "myapp"), lb)
+        self.assertEqual(lb.name, "myapp")
+        Ip.assert_called_with(self.conf["NETWORKAPI_ENDPOINT"], self.conf["NETWORKAPI_USER"],
+                              self.conf["NETWORKAPI_PASSWORD"])
+        client_ip.edit_ipv4.assert_called_once_with("192.168.1.1", u"tsuru hm myapp", 303)
+
+    @mock.patch("hm.lb_managers.networkapi_cloudstack.CloudStack")
+    @mock.patch("networkapiclient.Vip.Vip")
+    @mock.patch("networkapiclient.Ip.Ip")
+    def test_rollback_claimed_pool_load_balancer(self, Ip, Vip, CloudStack):
+        lb = load_balancer.LoadBalancer("404", "hm-pool-abc", "192.168.1.1", ip_id="303")
+        op = mock.Mock(steps=[{"name": "created"}, {"name": "claim_pool_lb", "document": lb.to_json()}])
+        manager = networkapi_cloudstack.NetworkApiCloudstackLB(self.conf)
+        manager.rollback_operation(op)
+        CloudStack.return_value.removeGloboNetworkVip.assert_called_once_with({"vipid": "404"})
+        Vip.return_value.remover.assert_called_once_with("404")
+        Ip.return_value.delete_ip4.assert_called_once_with("303")
+        op.forget.assert_called_once_with("claim_pool_lb")
+
     @mock.patch("hm.lb_managers.networkapi_cloudstack.CloudStack")
     @mock.patch("networkapiclient.Vip.Vip")
     @mock.patch("networkapiclient.Ip.Ip")
@@ -280,7 +341,8 @@ class NetworkApiCloudstackLBTestCase(unittest.TestCase):
         CloudStack.assert_called_with(
             self.conf["CLOUDSTACK_API_URL"],
             self.conf["CLOUDSTACK_API_KEY"],
-            self.conf["CLOUDSTACK_SECRET_KEY"])
+            self.conf["CLOUDSTACK_SECRET_KEY"],
+            transport.get_transport(self.conf))
 
     @mock.patch("hm.lb_managers.networkapi_cloudstack.CloudStack")
     def test_attach_real_with_project_id(self, CloudStack):
@@ -306,7 +368,8 @@ class NetworkApiCloudstackLBTestCase(unittest.TestCase):
         CloudStack.assert_called_with(
             self.conf["CLOUDSTACK_API_URL"],
             self.conf["CLOUDSTACK_API_KEY"],
-            self.conf["CLOUDSTACK_SECRET_KEY"])
+            self.conf["CLOUDSTACK_SECRET_KEY"],
+            transport.get_transport(self.conf))
 
     @mock.patch("hm.lb_managers.networkapi_cloudstack.CloudStack")
     def test_attach_real_with_network_index(self, CloudStack):
@@ -332,7 +395,8 @@ class NetworkApiCloudstackLBTestCase(unittest.TestCase):
         CloudStack.assert_called_with(
             self.conf["CLOUDSTACK_API_URL"],
             self.conf["CLOUDSTACK_API_KEY"],
-            self.conf["CLOUDSTACK_SECRET_KEY"])
+            self.conf["CLOUDSTACK_SECRET_KEY"],
+            transport.get_transport(self.conf))
 
     @mock.patch("hm.lb_managers.networkapi_cloudstack.CloudStack")
     def test_detach_real(self, CloudStack):
@@ -355,7 +419,8 @@ class NetworkApiCloudstackLBTestCase(unittest.TestCase):
         CloudStack.assert_called_with(
             self.conf["CLOUDSTACK_API_URL"],
             self.conf["CLOUDSTACK_API_KEY"],
-            self.conf["CLOUDSTACK_SECRET_KEY"])
+            self.conf["CLOUDSTACK_SECRET_KEY"],
+            transport.get_transport(self.conf))
 
     @mock.patch("hm.lb_managers.networkapi_cloudstack.CloudStack")
     def test_detach_real_with_project_id(self, CloudStack):
@@ -378,4 +443,202 @@ class NetworkApiCloudstackLBTestCase(unittest.TestCase):
         CloudStack.assert_called_with(
             self.conf["CLOUDSTACK_API_URL"],
             self.conf["CLOUDSTACK_API_KEY"],
-            self.conf["CLOUDSTACK_SECRET_KEY"])
+            self.conf["CLOUDSTACK_SECRET_KEY"],
+            transport.get_transport(self.conf))
+
+    @mock.patch("hm.lb_managers.networkapi_cloudstack.CloudStack")
+    def test_attach_reals(self, CloudStack):
+        self.conf.update({'CLOUDSTACK_VIP_NETWORK_INDEX': '0'})
+        vms = {"virtualmachine": [
+            {"id": "h2", "nic": [{"id": "nic2", "networkid": "netid2"}]},
+            {"id": "h1", "nic": [{"id": "nic1", "networkid": "netid1"}]},
+        ]}
+        CloudStack.return_value = cloudstack_client = mock.Mock()
+        cloudstack_client.listVirtualMachines.return_value = vms
+        # mocked methods are created here, as the calls run in parallel threads
+        cloudstack_client.addGloboNetworkVipToAccount.return_value = None
+        cloudstack_client.associateGloboNetworkRealToVip.return_value = None
+        manager = networkapi_cloudstack.NetworkApiCloudstackLB(self.conf)
+        lb = load_balancer.LoadBalancer("500", "myapp", "192.168.1.1", ip_id="303", project_id="pid")
+        manager.attach_reals(lb, [host.Host('h1', 'name1.host'), host.Host('h2', 'name2.host')])
+        cloudstack_client.listVirtualMachines.assert_called_once_with({"ids": "h1,h2", "projectid": "pid"})
+        self.assertItemsEqual(cloudstack_client.addGloboNetworkVipToAccount.call_args_list, [
+            mock.call({"networkid": "netid1", "vipid": "500", "projectid": "pid"}),
+            mock.call({"networkid": "netid2", "vipid": "500", "projectid": "pid"}),
+        ])
+        self.assertItemsEqual(cloudstack_client.associateGloboNetworkRealToVip.call_args_list, [
+            mock.call({"nicid": "nic1", "vipid": "500", "projectid": "pid"}),
+            mock.call({"nicid": "nic2", "vipid": "500", "projectid": "pid"}),
+        ])
+
+    @mock.patch("hm.lb_managers.networkapi_cloudstack.CloudStack")
+    def test_attach_reals_error(self, CloudStack):
+        self.conf.update({'CLOUDSTACK_VIP_NETWORK_INDEX': '0'})
+        vms = {"virtualmachine": [{"id": "h1", "nic": [{"id": "nic1", "networkid": "netid1"}]}]}
+        CloudStack.return_value = cloudstack_client = mock.Mock()
+        cloudstack_client.listVirtualMachines.return_value = vms
+        cloudstack_client.associateGloboNetworkRealToVip.side_effect = Exception("failed to associate")
+        manager = networkapi_cloudstack.NetworkApiCloudstackLB(self.conf)
+        lb = load_balancer.LoadBalancer("500", "myapp", "192.168.1.1", ip_id="303", project_id=None)
+        with self.assertRaises(Exception) as cm:
+            manager.attach_reals(lb, [host.Host('h1', 'name1.host')])
+        self.assertEqual(str(cm.exception), "failed to associate")
+
+    @mock.patch("hm.lb_managers.networkapi_cloudstack.CloudStack")
+    def test_attach_reals_partial_failure(self, CloudStack):
+        self.conf.update({'CLOUDSTACK_VIP_NETWORK_INDEX': '0'})
+        vms = {"virtualmachine": [
+            {"id": "h1", "nic": [{"id": "nic1", "networkid": "netid1"}]},
+            {"id": "h2", "nic": [{"id": "nic2", "networkid": "netid1"}]},
+        ]}
+        CloudStack.return_value = cloudstack_client = mock.Mock()
+        cloudstack_client.listVirtualMachines.return_value = vms
+        cloudstack_client.addGloboNetworkVipToAccount.return_value = None
+
+        def associate(data):
+            if data["nicid"] == "nic2":
+                raise Exception("failed to associate")
+        cloudstack_client.associateGloboNetworkRealToVip.side_effect = associate
+        manager = networkapi_cloudstack.NetworkApiCloudstackLB(self.conf)
+        lb = load_balancer.LoadBalancer("500", "myapp", "192.168.1.1", ip_id="303", project_id=None)
+        h1 = host.Host('h1', 'name1.host')
+        with self.assertRaises(lb_managers.AttachRealsError) as cm:
+            manager.attach_reals(lb, [h1, host.Host('h2', 'name2.host')])
+        self.assertEqual(cm.exception.attached, [h1])
+        self.assertEqual(str(cm.exception.exc_info[1]), "failed to associate")
+
+    @mock.patch("hm.lb_managers.networkapi_cloudstack.CloudStack")
+    def test_attach_real_skips_associated_network(self, CloudStack):
+        self.conf.update({'CLOUDSTACK_VIP_NETWORK_INDEX': '0'})
+        vms = {"virtualmachine": [{"id": "abc123", "nic": [{"id": "def456", "networkid": "netid1"}]}]}
+        CloudStack.return_value = cloudstack_client = mock.Mock()
+        cloudstack_client.listVirtualMachines.return_value = vms
+        manager = networkapi_cloudstack.NetworkApiCloudstackLB(self.conf)
+        lb = load_balancer.LoadBalancer("500", "myapp", "192.168.1.1", ip_id="303")
+        manager.attach_real(lb, host.Host('abc123', 'name.host'))
+        self.assertEqual(lb.vip_networks, ["netid1"])
+        manager.attach_real(lb, host.Host('abc123', 'name.host'))
+        net_data = {"networkid": "netid1", "vipid": "500"}
+        cloudstack_client.addGloboNetworkVipToAccount.assert_called_once_with(net_data)
+        self.assertEqual(cloudstack_client.associateGloboNetworkRealToVip.call_count, 2)
+
+    @mock.patch("hm.lb_managers.networkapi_cloudstack.CloudStack")
+    def test_attach_real_failure_forgets_network(self, CloudStack):
+        self.conf.update({'CLOUDSTACK_VIP_NETWORK_INDEX': '0'})
+        vms = {"virtualmachine": [{"id": "abc123", "nic": [{"id": "def456", "networkid": "netid1"}]}]}
+        CloudStack.return_value = cloudstack_client = mock.Mock()
+        cloudstack_client.listVirtualMachines.return_value = vms
+        cloudstack_client.associateGloboNetworkRealToVip.side_effect = Exception("network not in vip")
+        manager = networkapi_cloudstack.NetworkApiCloudstackLB(self.conf)
+        lb = load_balancer.LoadBalancer("500", "myapp", "192.168.1.1", ip_id="303",
+                                        vip_networks=["netid1", "x"])
+        with self.assertRaises(Exception):
+            manager.attach_real(lb, host.Host('abc123', 'name.host'))
+        self.assertFalse(cloudstack_client.addGloboNetworkVipToAccount.called)
+        self.assertEqual(lb.vip_networks, ["x"])
+        cloudstack_client.associateGloboNetworkRealToVip.side_effect = None
+        manager.attach_real(lb, host.Host('abc123', 'name.host'))
+        net_data = {"networkid": "netid1", "vipid": "500"}
+        cloudstack_client.addGloboNetworkVipToAccount.assert_called_once_with(net_data)
+        self.assertEqual(lb.vip_networks, ["x", "netid1"])
+
+    @mock.patch("hm.lb_managers.networkapi_cloudstack.CloudStack")
+    def test_attach_reals_adds_each_network_once(self, CloudStack):
+        self.conf.update({'CLOUDSTACK_VIP_NETWORK_INDEX': '0'})
+        vms = {"virtualmachine": [
+            {"id": "h1", "nic": [{"id": "nic1", "networkid": "netid1"}]},
+            {"id": "h2", "nic": [{"id": "nic2", "networkid": "netid1"}]},
+            {"id": "h3", "nic": [{"id": "nic3", "networkid": "netid2"}]},
+        ]}
+        CloudStack.return_value = cloudstack_client = mock.Mock()
+        cloudstack_client.listVirtualMachines.return_value = vms
+        # mocked methods are created here, as the calls run in parallel threads
+        cloudstack_client.addGloboNetworkVipToAccount.return_value = None
+        cloudstack_client.associateGloboNetworkRealToVip.return_value = None
+        manager = networkapi_cloudstack.NetworkApiCloudstackLB(self.conf)
+        lb = load_balancer.LoadBalancer("500", "myapp", "192.168.1.1", ip_id="303", vip_networks=["netid2"])
+        manager.attach_reals(lb, [host.Host(id, id + '.host') for id in ["h1", "h2", "h3"]])
+        net_data = {"networkid": "netid1", "vipid": "500"}
+        cloudstack_client.addGloboNetworkVipToAccount.assert_called_once_with(net_data)
+        self.assertEqual(cloudstack_client.associateGloboNetworkRealToVip.call_count, 3)
+        self.assertItemsEqual(lb.vip_networks, ["netid1", "netid2"])
+
+    @mock.patch("hm.lb_managers.networkapi_cloudstack.CloudStack")
+    def test_attach_reals_stored_nics(self, CloudStack):
+        self.conf.update({'CLOUDSTACK_VIP_NETWORK_INDEX': '0'})
+        CloudStack.return_value = cloudstack_client = mock.Mock()
+        cloudstack_client.listVirtualMachines.return_value = {"virtualmachine": [
+            {"id": "h2", "nic": [{"id": "nic2", "networkid": "netid2"}]},
+        ]}
+        # mocked methods are created here, as the calls run in parallel threads
+        cloudstack_client.addGloboNetworkVipToAccount.return_value = None
+        cloudstack_client.associateGloboNetworkRealToVip.return_value = None
+        manager = networkapi_cloudstack.NetworkApiCloudstackLB(self.conf)
+        lb = load_balancer.LoadBalancer("500", "myapp", "192.168.1.1", ip_id="303")
+        h1 = host.Host('h1', 'name1.host', nics=[{"id": "nic1", "networkid": "netid1"}])
+        manager.attach_reals(lb, [h1, host.Host('h2', 'name2.host')])
+        cloudstack_client.listVirtualMachines.assert_called_once_with({"id": "h2"})
+        self.assertItemsEqual(cloudstack_client.associateGloboNetworkRealToVip.call_args_list, [
+            mock.call({"nicid": "nic1", "vipid": "500"}),
+            mock.call({"nicid": "nic2", "vipid": "500"}),
+        ])
+        cloudstack_client.reset_mock()
+        manager.detach_real(lb, h1)
+        self.assertFalse(cloudstack_client.listVirtualMachines.called)
+        real_data = {"nicid": "nic1", "vipid": "500"}
+        cloudstack_client.disassociateGloboNetworkRealFromVip.assert_called_once_with(real_data)
+
+    @mock.patch("hm.lb_managers.networkapi_cloudstack.CloudStack")
+    def test_attach_real_stale_stored_nic(self, CloudStack):
+        self.conf.update({'CLOUDSTACK_VIP_NETWORK_INDEX': '0'})
+        CloudStack.return_value = cloudstack_client = mock.Mock()
+        cloudstack_client.listVirtualMachines.return_value = {"virtualmachine": [
+            {"id": "h1", "nic": [{"id": "nic9", "networkid": "netid9"}]},
+        ]}
+        cloudstack_client.associateGloboNetworkRealToVip.side_effect = [Exception("no such nic"), None]
+        manager = networkapi_cloudstack.NetworkApiCloudstackLB(self.conf)
+        lb = load_balancer.LoadBalancer("500", "myapp", "192.168.1.1", ip_id="303")
+        h = host.Host('h1', 'name1.host', nics=[{"id": "nic1", "networkid": "netid1"}])
+        manager.attach_real(lb, h)
+        self.assertEqual(cloudstack_client.associateGloboNetworkRealToVip.call_args_list, [
+            mock.call({"nicid": "nic1", "vipid": "500"}),
+            mock.call({"nicid": "nic9", "vipid": "500"}),
+        ])
+        self.assertEqual(h.nics, [{"id": "nic9", "networkid": "netid9"}])
+        self.assertEqual(lb.vip_networks, ["netid9"])
+
+    @mock.patch("hm.lb_managers.networkapi_cloudstack.CloudStack")
+    def test_attach_real_stored_nic_failure(self, CloudStack):
+        self.conf.update({'CLOUDSTACK_VIP_NETWORK_INDEX': '0'})
+        CloudStack.return_value = cloudstack_client = mock.Mock()
+        cloudstack_client.listVirtualMachines.return_value = {"virtualmachine": [
+            {"id": "h1", "nic": [{"id": "nic1", "networkid": "netid1"}]},
+        ]}
+        cloudstack_client.associateGloboNetworkRealToVip.side_effect = Exception("vip busy")
+        manager = networkapi_cloudstack.NetworkApiCloudstackLB(self.conf)
+        lb = load_balancer.LoadBalancer("500", "myapp", "192.168.1.1", ip_id="303")
+        h = host.Host('h1', 'name1.host', nics=[{"id": "nic1", "networkid": "netid1"}])
+        with self.assertRaises(Exception) as cm:
+            manager.attach_real(lb, h)
+        self.assertEqual(str(cm.exception), "vip busy")
+        self.assertEqual(cloudstack_client.associateGloboNetworkRealToVip.call_count, 1)
+
+    @mock.patch("hm.lb_managers.networkapi_cloudstack.CloudStack")
+    def test_detach_reals(self, CloudStack):
+        self.conf.update({'CLOUDSTACK_VIP_NETWORK_INDEX': '0'})
+        vms = {"virtualmachine": [
+            {"id": "h1", "nic": [{"id": "nic1", "networkid": "netid1"}]},
+            {"id": "h2", "nic": [{"id": "nic2", "networkid": "netid2"}]},
+        ]}
+        CloudStack.return_value = cloudstack_client = mock.Mock()
+        cloudstack_client.listVirtualMachines.return_value = vms
+        # mocked methods are created here, as the calls run in parallel threads
+        cloudstack_client.disassociateGloboNetworkRealFromVip.return_value = None
+        manager = networkapi_cloudstack.NetworkApiCloudstackLB(self.conf)
+        lb = load_balancer.LoadBalancer("500", "myapp", "192.168.1.1", ip_id="303", project_id=None)
+        manager.detach_reals(lb, [host.Host('h1', 'name1.host'), host.Host('h2', 'name2.host')])
+        cloudstack_client.listVirtualMachines.assert_called_once_with({"ids": "h1,h2"})
+        self.assertItemsEqual(cloudstack_client.disassociateGloboNetworkRealFromVip.call_args_list, [
+            mock.call({"nicid": "nic1", "vipid": "500"}),
+            mock.call({"nicid": "nic2", "vipid": "500"}),
+        ])
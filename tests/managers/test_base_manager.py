@@ -2,6 +2,7 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import os
 import unittest
 
 import mock
@@ -40,3 +41,24 @@ class BaseManagerTestCase(unittest.TestCase):
             manager.get_user_data()
         self.assertEqual(str(rsp.exception),
                          "invalid user data response from http://localhost/somewhere: 500 - my error")
+
+    def test_by_name_reuses_instances(self):
+        class Manager(managers.BaseManager):
+            create_host = destroy_host = lambda self: None
+        managers.register('cached', Manager)
+        conf = {'A': '1'}
+        manager = managers.by_name('cached', conf)
+        self.assertIs(managers.by_name('cached', {'A': '1'}), manager)
+        conf['A'] = '2'
+        self.assertIsNot(managers.by_name('cached', conf), manager)
+        managers.register('cached', Manager)
+        self.assertIsNot(managers.by_name('cached', {'A': '1'}), manager)
+
+    @mock.patch.dict(os.environ, {'HM_TEST_SETTING': 'old'})
+    def test_by_name_sees_environment_changes(self):
+        class Manager(managers.BaseManager):
+            create_host = destroy_host = lambda self: None
+        managers.register('env', Manager)
+        self.assertEqual(managers.by_name('env', {'A': '1'}).get_conf('HM_TEST_SETTING'), 'old')
+        os.environ['HM_TEST_SETTING'] = 'new'
+        self.assertEqual(managers.by_name('env', {'A': '1'}).get_conf('HM_TEST_SETTING'), 'new')
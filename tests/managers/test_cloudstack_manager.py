@@ -5,10 +5,19 @@
 import unittest
 
 import mock
+from concurrent import futures
 
-from hm import config
+from hm import config, journal, model
 from hm.managers import cloudstack
-from hm.iaas import cloudstack_client
+from hm.model.host import Host
+from hm.iaas import cloudstack_client, transport
+from hm.storage import memory
+
+
+def done(result):
+    future = futures.Future()
+    future.set_result(result)
+    return future
 
 
 class CloudStackManagerTestCase(unittest.TestCase):
@@ -25,6 +34,7 @@ class CloudStackManagerTestCase(unittest.TestCase):
         self.assertEqual(client.client.api_url, self.config["CLOUDSTACK_API_URL"])
         self.assertEqual(client.client.api_key, self.config["CLOUDSTACK_API_KEY"])
         self.assertEqual(client.client.secret, self.config["CLOUDSTACK_SECRET_KEY"])
+        self.assertIs(client.client.transport, transport.get_transport(self.config))
 
     def test_init_no_api_url(self):
         with self.assertRaises(config.MissConfigurationError) as cm:
@@ -81,7 +91,7 @@ class CloudStackManagerTestCase(unittest.TestCase):
             "projectid": "project-123",
         }
         client_mock.deployVirtualMachine.assert_called_with(create_data)
-        client_mock.wait_for_job.assert_called_with('qwe321', 100)
+        client_mock.wait_for_job.assert_called_with('qwe321', manager.polling)
 
     def test_create_with_tags(self):
         self.config.update({
@@ -116,7 +126,7 @@ class CloudStackManagerTestCase(unittest.TestCase):
             "projectid": "project-123",
         }
         client_mock.deployVirtualMachine.assert_called_with(create_data)
-        client_mock.wait_for_job.assert_called_with('qwe321', 100)
+        client_mock.wait_for_job.assert_called_with('qwe321', manager.polling)
         tag_data = {
             "resourcetype": "UserVm",
             "resourceids": "abc123",
@@ -160,7 +170,7 @@ class CloudStackManagerTestCase(unittest.TestCase):
             "projectid": "project-123",
         }
         client_mock.deployVirtualMachine.assert_called_with(create_data)
-        client_mock.wait_for_job.assert_called_with('qwe321', 100)
+        client_mock.wait_for_job.assert_called_with('qwe321', manager.polling)
 
     def test_create_no_project_id(self):
         self.config.update({
@@ -191,7 +201,7 @@ class CloudStackManagerTestCase(unittest.TestCase):
             "networkids": "net-123",
         }
         client_mock.deployVirtualMachine.assert_called_with(create_data)
-        client_mock.wait_for_job.assert_called_with('qwe321', 100)
+        client_mock.wait_for_job.assert_called_with('qwe321', manager.polling)
 
     def test_create_no_network_id(self):
         self.config.update({
@@ -220,7 +230,7 @@ class CloudStackManagerTestCase(unittest.TestCase):
             "serviceofferingid": "qwe123",
         }
         client_mock.deployVirtualMachine.assert_called_with(create_data)
-        client_mock.wait_for_job.assert_called_with('qwe321', 100)
+        client_mock.wait_for_job.assert_called_with('qwe321', manager.polling)
 
     def test_create_invalid_response(self):
         self.config.update({
@@ -282,7 +292,7 @@ class CloudStackManagerTestCase(unittest.TestCase):
             "serviceofferingid": "qwe123",
         }
         client_mock.deployVirtualMachine.assert_called_with(create_data)
-        client_mock.wait_for_job.assert_called_with('qwe321', 100)
+        client_mock.wait_for_job.assert_called_with('qwe321', manager.polling)
 
     def test_create_public_multi_nic_no_network_index(self):
         self.config.update({
@@ -313,7 +323,7 @@ class CloudStackManagerTestCase(unittest.TestCase):
             "serviceofferingid": "qwe123",
         }
         client_mock.deployVirtualMachine.assert_called_with(create_data)
-        client_mock.wait_for_job.assert_called_with('qwe321', 100)
+        client_mock.wait_for_job.assert_called_with('qwe321', manager.polling)
 
     def test_create_timeout(self):
         self.config.update({
@@ -346,9 +356,121 @@ class CloudStackManagerTestCase(unittest.TestCase):
             "zoneid": "zone1",
             "serviceofferingid": "qwe123",
         }
-        client_mock.wait_for_job.assert_called_with('qwe321', 1)
+        client_mock.wait_for_job.assert_called_with('qwe321', manager.polling)
+        self.assertEqual(1, manager.polling.max_tries)
         client_mock.deployVirtualMachine.assert_called_with(create_data)
 
+    def test_create_timeout_journaled_and_rolled_back(self):
+        memory.clear()
+        self.addCleanup(memory.clear)
+        conf = {"STORAGE_ENGINE": "memory", "HM_JOURNAL": "true"}
+        self.config.update({
+            "CLOUDSTACK_TEMPLATE_ID": "abc123",
+            "CLOUDSTACK_SERVICE_OFFERING_ID": "qwe123",
+            "CLOUDSTACK_ZONE_ID": "zone1",
+            "CLOUDSTACK_PROJECT_ID": "proj",
+        })
+        client_mock = mock.Mock()
+        client_mock.deployVirtualMachine.return_value = {"id": "abc123", "jobid": "qwe321"}
+        client_mock.wait_for_job.side_effect = cloudstack_client.MaxTryWaitingForJobError(1, 'qwe321')
+        manager = cloudstack.CloudStackManager(self.config)
+        manager.client = client_mock
+        with self.assertRaises(cloudstack_client.MaxTryWaitingForJobError):
+            with journal.operation("create_host", "cloudstack", conf):
+                manager.create_host()
+        storage = model.storage(conf)
+        ops = storage.list_operations({})
+        self.assertEqual(ops[0]["steps"], [{"name": "deploy_vm", "vm_id": "abc123", "job_id": "qwe321",
+                                            "project_id": "proj"}])
+        op = journal.Operation(storage, ops[0])
+        manager.rollback_operation(op)
+        client_mock.destroyVirtualMachine.assert_called_once_with({"id": "abc123"})
+        self.assertEqual(op.steps, [])
+        self.assertEqual(storage.list_operations({})[0]["steps"], [])
+
+    def test_rollback_operation_without_vm_id(self):
+        client_mock = mock.Mock()
+        client_mock.wait_for_job.return_value = {"jobresult": {"virtualmachine": {"id": "vm-9"}}}
+        manager = cloudstack.CloudStackManager(self.config)
+        manager.client = client_mock
+        op = mock.Mock(steps=[{"name": "deploy_vm", "vm_id": None, "job_id": "job-9"}])
+        manager.rollback_operation(op)
+        client_mock.wait_for_job.assert_called_once_with("job-9", manager.polling)
+        client_mock.destroyVirtualMachine.assert_called_once_with({"id": "vm-9"})
+        op.forget.assert_called_once_with("deploy_vm", job_id="job-9")
+
+    def test_create_stores_nics(self):
+        self.config.update({
+            "CLOUDSTACK_TEMPLATE_ID": "abc123",
+            "CLOUDSTACK_SERVICE_OFFERING_ID": "qwe123",
+            "CLOUDSTACK_ZONE_ID": "zone1",
+            "CLOUDSTACK_PUBLIC_NETWORK_INDEX": "1",
+        })
+        client_mock = mock.Mock()
+        client_mock.deployVirtualMachine.return_value = {"id": "abc123", "jobid": "qwe321"}
+        vm = {"id": "abc123", "nic": [
+            {"id": "nic0", "networkid": "net0", "ipaddress": "10.0.0.1", "macaddress": "x"},
+            {"id": "nic1", "networkid": "net1", "ipaddress": "192.168.0.1"},
+        ]}
+        client_mock.listVirtualMachines.return_value = {"virtualmachine": [vm]}
+        manager = cloudstack.CloudStackManager(self.config)
+        manager.client = client_mock
+        host = manager.create_host('xxx')
+        self.assertEqual(host.dns_name, "192.168.0.1")
+        self.assertEqual(host.to_json()["nics"], [
+            {"id": "nic0", "networkid": "net0", "ipaddress": "10.0.0.1"},
+            {"id": "nic1", "networkid": "net1", "ipaddress": "192.168.0.1"},
+        ])
+
+    def test_create_pool_host(self):
+        self.config.update({
+            "CLOUDSTACK_TEMPLATE_ID": "abc123",
+            "CLOUDSTACK_SERVICE_OFFERING_ID": "qwe123",
+            "CLOUDSTACK_ZONE_ID": "zone1",
+            "CLOUDSTACK_GROUP": "feaas",
+            "HOST_TAGS": "monitor:1",
+        })
+        client_mock = mock.Mock()
+        client_mock.deployVirtualMachine.return_value = {"id": "abc123", "jobid": "qwe321"}
+        vm = {"id": "abc123", "nic": [{"ipaddress": "10.0.0.1"}]}
+        client_mock.listVirtualMachines.return_value = {"virtualmachine": [vm]}
+        manager = cloudstack.CloudStackManager(self.config)
+        manager.client = client_mock
+        host = manager.create_pool_host(alternative_id=0)
+        self.assertEqual(("abc123", "10.0.0.1"), (host.id, host.dns_name))
+        self.assertEqual(client_mock.deployVirtualMachine.call_args[0][0]["displayname"], "feaas")
+        self.assertFalse(client_mock.listTags.called)
+        self.assertFalse(client_mock.createTags.called)
+
+    def test_claim_pool_host(self):
+        self.config.update({
+            "CLOUDSTACK_GROUP": "feaas",
+            "CLOUDSTACK_PROJECT_ID": "proj",
+            "HOST_TAGS": "monitor:1",
+        })
+        client_mock = mock.Mock()
+        client_mock.listTags.return_value = {}
+        manager = cloudstack.CloudStackManager(self.config)
+        manager.client = client_mock
+        h = Host("abc123", "10.0.0.1")
+        self.assertIs(manager.claim_pool_host(h, name="xxx"), h)
+        client_mock.updateVirtualMachine.assert_called_once_with({"id": "abc123", "displayname": "feaas_xxx"})
+        client_mock.listTags.assert_called_once_with({"resourcetype": "UserVm", "resourceid": "abc123",
+                                                      "projectid": "proj"})
+        self.assertTrue(client_mock.createTags.called)
+        client_mock.reset_mock()
+        manager.claim_pool_host(h)
+        self.assertFalse(client_mock.updateVirtualMachine.called)
+
+    def test_rollback_claimed_pool_vm(self):
+        client_mock = mock.Mock()
+        manager = cloudstack.CloudStackManager(self.config)
+        manager.client = client_mock
+        op = mock.Mock(steps=[{"name": "claim_pool_vm", "vm_id": "vm-1"}])
+        manager.rollback_operation(op)
+        client_mock.destroyVirtualMachine.assert_called_once_with({"id": "vm-1"})
+        op.forget.assert_called_once_with("claim_pool_vm", vm_id="vm-1")
+
     def test_create_alternatives(self):
         self.config.update({
             "CLOUDSTACK_GROUP": "feaas",
@@ -386,7 +508,7 @@ class CloudStackManagerTestCase(unittest.TestCase):
             "projectid": "project-base",
         }
         client_mock.deployVirtualMachine.assert_called_with(create_data)
-        client_mock.wait_for_job.assert_called_with('qwe321', 100)
+        client_mock.wait_for_job.assert_called_with('qwe321', manager.polling)
 
         host = manager.create_host('xxx', alternative_id=1)
         create_data = {
@@ -400,12 +522,94 @@ class CloudStackManagerTestCase(unittest.TestCase):
         }
         client_mock.deployVirtualMachine.assert_called_with(create_data)
 
+    def test_create_async(self):
+        self.config.update({
+            "CLOUDSTACK_TEMPLATE_ID": "abc123",
+            "CLOUDSTACK_SERVICE_OFFERING_ID": "qwe123",
+            "CLOUDSTACK_ZONE_ID": "zone1",
+            "CLOUDSTACK_PROJECT_ID": "project-123",
+            "CLOUDSTACK_GROUP": "feaas",
+        })
+        client_mock = mock.Mock()
+        client_mock.executor = futures.ThreadPoolExecutor(max_workers=1)
+        client_mock.deployVirtualMachine.return_value = done({"jobid": "qwe321"})
+        client_mock.wait_for_job.return_value = done({"jobresult": {"virtualmachine": {"id": "abc123"}}})
+        vm = {"id": "abc123", "nic": [{"ipaddress": "10.0.0.1"}]}
+        client_mock.listVirtualMachines.return_value = done({"virtualmachine": [vm]})
+        manager = cloudstack.CloudStackManager(self.config)
+        manager.async_client = client_mock
+        host = manager.create_host_async('xxx').result(5)
+        self.assertEqual("abc123", host.id)
+        self.assertEqual("10.0.0.1", host.dns_name)
+        client_mock.deployVirtualMachine.assert_called_with({
+            "group": "feaas",
+            "displayname": "feaas_xxx",
+            "templateid": "abc123",
+            "zoneid": "zone1",
+            "serviceofferingid": "qwe123",
+            "projectid": "project-123",
+        })
+        client_mock.wait_for_job.assert_called_with('qwe321', manager.polling)
+        client_mock.listVirtualMachines.assert_called_with({"id": "abc123", "projectid": "project-123"})
+
+    def test_create_async_tags_through_async_client(self):
+        self.config.update({
+            "CLOUDSTACK_TEMPLATE_ID": "abc123",
+            "CLOUDSTACK_SERVICE_OFFERING_ID": "qwe123",
+            "CLOUDSTACK_ZONE_ID": "zone1",
+            "HOST_TAGS": "a:1,b:2",
+        })
+        client_mock = mock.Mock()
+        client_mock.executor = futures.ThreadPoolExecutor(max_workers=1)
+        client_mock.deployVirtualMachine.return_value = done({"jobid": "qwe321"})
+        client_mock.wait_for_job.return_value = done({"jobresult": {"virtualmachine": {"id": "abc123"}}})
+        vm = {"id": "abc123", "nic": [{"ipaddress": "10.0.0.1"}]}
+        client_mock.listVirtualMachines.return_value = done({"virtualmachine": [vm]})
+        client_mock.listTags.return_value = done({"tag": [{"key": "a", "value": "0"}]})
+        client_mock.deleteTags.return_value = done({"jobid": "del-job"})
+        client_mock.createTags.return_value = done({"jobid": "add-job"})
+        manager = cloudstack.CloudStackManager(self.config)
+        manager.async_client = client_mock
+        manager.client = mock.Mock()
+        host = manager.create_host_async('xxx').result(5)
+        self.assertEqual("abc123", host.id)
+        client_mock.listTags.assert_called_once_with({"resourcetype": "UserVm", "resourceid": "abc123"})
+        client_mock.deleteTags.assert_called_once_with({"resourcetype": "UserVm", "resourceids": "abc123",
+                                                        "tags[0].key": "a", "tags[0].value": "0"})
+        client_mock.wait_for_job.assert_called_with("del-job", manager.polling)
+        client_mock.createTags.assert_called_once_with({"resourcetype": "UserVm", "resourceids": "abc123",
+                                                        "tags[0].key": "a", "tags[0].value": "1",
+                                                        "tags[1].key": "b", "tags[1].value": "2"})
+        self.assertEqual(manager.client.mock_calls, [])
+
+    def test_create_async_invalid_response(self):
+        self.config.update({
+            "CLOUDSTACK_TEMPLATE_ID": "abc123",
+            "CLOUDSTACK_SERVICE_OFFERING_ID": "qwe123",
+            "CLOUDSTACK_ZONE_ID": "zone1",
+        })
+        client_mock = mock.Mock()
+        client_mock.executor = futures.ThreadPoolExecutor(max_workers=1)
+        client_mock.deployVirtualMachine.return_value = done({"id": "abc123"})
+        manager = cloudstack.CloudStackManager(self.config)
+        manager.async_client = client_mock
+        with self.assertRaises(cloudstack.CloudStackException):
+            manager.create_host_async().result(5)
+        self.assertFalse(client_mock.wait_for_job.called)
+
     def test_destroy_host(self):
         manager = cloudstack.CloudStackManager(self.config)
         manager.client = mock.Mock()
         manager.destroy_host('host-id')
         manager.client.destroyVirtualMachine.assert_called_with({'id': 'host-id'})
 
+    def test_destroy_host_async(self):
+        manager = cloudstack.CloudStackManager(self.config)
+        manager.async_client = mock.Mock()
+        manager.async_client.destroyVirtualMachine.return_value = done({"jobid": "j1"})
+        self.assertEqual(manager.destroy_host_async('host-id').result(), {"jobid": "j1"})
+        manager.async_client.destroyVirtualMachine.assert_called_with({'id': 'host-id'})
+
     def test_restore_host(self):
         client_mock = mock.Mock()
         client_mock.make_request.return_value = {"id": "abc123",
@@ -419,7 +623,7 @@ class CloudStackManagerTestCase(unittest.TestCase):
         manager.client.make_request.assert_called_with('restoreVirtualMachine',
                                                        {'virtualmachineid': 'host-id'},
                                                        response_key='restorevmresponse')
-        manager.client.wait_for_job.assert_called_with('qwe321', 100)
+        manager.client.wait_for_job.assert_called_with('qwe321', manager.polling)
         manager.tag_vm.assert_not_called()
 
     def test_restore_host_with_tags_and_reset_template(self):
@@ -524,7 +728,7 @@ class CloudStackManagerTestCase(unittest.TestCase):
         manager.client.stopVirtualMachine.return_value = {"jobid": "qwe321"}
         manager.stop_host('host-id', True)
         manager.client.stopVirtualMachine.assert_called_with({'id': 'host-id', 'forced': 'true'})
-        manager.client.wait_for_job.assert_called_with('qwe321', 100)
+        manager.client.wait_for_job.assert_called_with('qwe321', manager.polling)
 
     def test_start_host(self):
         manager = cloudstack.CloudStackManager(self.config)
@@ -544,7 +748,7 @@ class CloudStackManagerTestCase(unittest.TestCase):
         manager.scale_host('host-id')
         manager.client.listVirtualMachines.assert_called_with({"id": "host-id", "projectid": "project-id"})
         manager.client.scaleVirtualMachine.assert_called_with({"id": "host-id", "serviceofferingid": "large"})
-        manager.client.wait_for_job.assert_called_with('qwe321', 100)
+        manager.client.wait_for_job.assert_called_with('qwe321', manager.polling)
 
     def test_scale_host_ignore_same_offering(self):
         self.config.update({
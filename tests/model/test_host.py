@@ -2,19 +2,28 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import itertools
 import unittest
 
+import bson
+from bson.raw_bson import RawBSONDocument
+
 from hm import managers, storage
-from hm.model.host import Host
+from hm.model.host import Host, BulkCreateError
 from mock import patch, call
 
 
+_host_ids = itertools.count()
+
+
 class FakeManager(managers.BaseManager):
     def __init__(self, config=None):
         super(FakeManager, self).__init__(config)
 
     def create_host(self, name=None, alternative_id=0):
-        host_id = self.get_conf('HOST_ID')
+        host_id = self.get_conf('HOST_ID', None)
+        if host_id is None:
+            host_id = "{}-{}".format(self.get_conf('HOST_ID_PREFIX'), next(_host_ids))
         alternative_id_failures = self.get_conf('ALTERNATIVE_IDS_FAILURES', '')
         if str(alternative_id) in alternative_id_failures.split(","):
             raise Exception("failure to create on alternative_id {}".format(alternative_id))
@@ -96,6 +105,15 @@ class HostTestCase(unittest.TestCase):
         hosts = Host.list(filters={'alternative_id': 2})
         self.assertEqual(len(hosts), 1)
 
+    def test_create_counts_alternatives_once(self):
+        conf = {"HM_ALTERNATIVE_CONFIG_COUNT": "3", "ALTERNATIVE_IDS_FAILURES": "0,1", "HOST_ID": "fake-1"}
+        count = storage.MongoDBStorage.count_hosts_by_alternative
+        with patch.object(storage.MongoDBStorage, 'count_hosts_by_alternative', autospec=True,
+                          side_effect=count) as count_mock:
+            host = Host.create('fake', 'my-group', conf)
+        self.assertEqual(host.alternative_id, 2)
+        self.assertEqual(count_mock.call_count, 1)
+
     def test_create_alternatives_ignore_failure_and_try_next(self):
         conf = {"HM_ALTERNATIVE_CONFIG_COUNT": "4", "ALTERNATIVE_IDS_FAILURES": "1,2"}
         conf.update({"HOST_ID": "fake-1"})
@@ -159,6 +177,42 @@ class HostTestCase(unittest.TestCase):
             Host.create('fake', 'my-group', conf)
         self.assertEqual(str(create_exception.exception), "failure to create on alternative_id 3")
 
+    def test_create_many(self):
+        conf = {"HM_ALTERNATIVE_CONFIG_COUNT": "3", "HOST_ID": "fake-1"}
+        Host.create('fake', 'my-group', conf)
+        conf = {"HM_ALTERNATIVE_CONFIG_COUNT": "3", "HOST_ID_PREFIX": "bulk"}
+        hosts = Host.create_many('fake', 'my-group', 5, conf, max_parallel=3)
+        self.assertEqual(len(hosts), 5)
+        self.assertEqual(len(set(h.id for h in hosts)), 5)
+        self.assertItemsEqual([h.alternative_id for h in hosts], [0, 1, 1, 2, 2])
+        for host in hosts:
+            self.assertEqual(host.manager, "fake")
+            self.assertEqual(host.group, "my-group")
+            self.assertEqual(host.config, conf)
+        db_hosts = Host.list({'group': 'my-group'})
+        self.assertItemsEqual([h.to_json() for h in db_hosts if h.id != 'fake-1'],
+                              [h.to_json() for h in hosts])
+        for alternative_id in range(3):
+            self.assertEqual(len(Host.list(filters={'alternative_id': alternative_id})), 2)
+
+    def test_create_many_retries_failed_alternatives(self):
+        conf = {"HM_ALTERNATIVE_CONFIG_COUNT": "3", "ALTERNATIVE_IDS_FAILURES": "1",
+                "HOST_ID_PREFIX": "bulk"}
+        hosts = Host.create_many('fake', 'my-group', 4, conf)
+        self.assertItemsEqual([h.alternative_id for h in hosts], [0, 0, 2, 2])
+        self.assertEqual(len(Host.list({'group': 'my-group'})), 4)
+
+    def test_create_many_raises_after_storing_created_hosts(self):
+        conf = {"HM_ALTERNATIVE_CONFIG_COUNT": "2", "ALTERNATIVE_IDS_FAILURES": "0,1",
+                "HOST_ID_PREFIX": "bulk"}
+        with self.assertRaises(BulkCreateError) as cm:
+            Host.create_many('fake', 'my-group', 3, conf)
+        exc = cm.exception
+        self.assertEqual(exc.hosts, [])
+        self.assertEqual(len(exc.errors), 3)
+        self.assertEqual(str(exc), "failed to create 3 of 3 hosts: failure to create on alternative_id 1")
+        self.assertEqual(Host.list({'group': 'my-group'}), [])
+
     def test_destroy(self):
         host = Host.create('fake', 'my-group', {"HOST_ID": "fake-id"})
         self.assertEqual(host.id, "fake-id")
@@ -255,6 +309,57 @@ class HostTestCase(unittest.TestCase):
         hosts = Host.list({'group': 'my-group1'})
         self.assertItemsEqual([h.to_json() for h in hosts], [h1.to_json(), h2.to_json()])
 
+    def test_extra_fields_round_trip(self):
+        host = Host('fake-id', 'fake.host', alternative_id=1, group='my-group', project_id='p1')
+        self.assertFalse(hasattr(host, '__dict__'))
+        self.assertEqual(host.project_id, 'p1')
+        host.nics = ['nic-1']
+        data = host.to_json()
+        self.assertEqual(data, {'_id': 'fake-id', 'dns_name': 'fake.host', 'manager': None,
+                                'alternative_id': 1, 'group': 'my-group', 'project_id': 'p1',
+                                'nics': ['nic-1']})
+        self.assertEqual(Host.from_dict(dict(data)).to_json(), data)
+        del host.nics
+        self.assertFalse(hasattr(host, 'nics'))
+        self.assertNotIn('nics', host.to_json())
+
+    def test_from_dict_does_not_change_document(self):
+        data = {'_id': 'fake-id', 'dns_name': 'fake.host', 'group': 'g1', 'project_id': 'p1'}
+        host = Host.from_dict(data, conf={'MY_CONF': 1})
+        self.assertEqual(data, {'_id': 'fake-id', 'dns_name': 'fake.host', 'group': 'g1',
+                                'project_id': 'p1'})
+        self.assertEqual((host.id, host.dns_name, host.group, host.project_id),
+                         ('fake-id', 'fake.host', 'g1', 'p1'))
+        self.assertEqual(host.alternative_id, 0)
+        self.assertIsNone(host.manager)
+        self.assertEqual(host.config, {'MY_CONF': 1})
+
+    def test_from_raw_bson_document(self):
+        data = RawBSONDocument(bson.BSON.encode({'_id': 'fake-id', 'dns_name': 'fake.host',
+                                                 'alternative_id': 2, 'extra': 'x'}))
+        host = Host.from_dict(data)
+        self.assertEqual(host.to_json(), {'_id': 'fake-id', 'dns_name': 'fake.host', 'alternative_id': 2,
+                                          'manager': None, 'group': None, 'extra': 'x'})
+
+    def test_list_fields(self):
+        Host.create('fake', 'my-group1', {"HOST_ID": "fake-id-1"})
+        hosts = Host.list({'group': 'my-group1'}, fields=['group'])
+        self.assertEqual(len(hosts), 1)
+        self.assertEqual(hosts[0].id, 'fake-id-1')
+        self.assertEqual(hosts[0].dns_name, 'fake-id-1.my-group1.com')
+        self.assertEqual(hosts[0].group, 'my-group1')
+        self.assertIsNone(hosts[0].manager)
+
+    def test_list_lazy(self):
+        h1 = Host.create('fake', 'my-group1', {"HOST_ID": "fake-id-1"})
+        h2 = Host.create('fake', 'my-group1', {"HOST_ID": "fake-id-2"})
+        conf = {'MY_CONF': 1}
+        hosts = Host.list({'group': 'my-group1'}, conf=conf, lazy=True)
+        self.assertNotIsInstance(hosts, list)
+        hosts = list(hosts)
+        self.assertDictEqual(hosts[0].config, conf)
+        self.assertItemsEqual([h.to_json() for h in hosts], [h1.to_json(), h2.to_json()])
+
     def test_storage_use_database_conf(self):
         storage.MongoDBStorage({"MONGO_DATABASE": "alternative_host_manager"})._hosts_collection().remove()
         h1 = Host.create('fake', 'my-group1', {
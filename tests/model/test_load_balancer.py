@@ -4,7 +4,9 @@
 
 import unittest
 
+import bson
 import pymongo.errors
+from bson.raw_bson import RawBSONDocument
 
 from hm import lb_managers, storage
 from hm.model.host import Host
@@ -25,7 +27,11 @@ class FakeManager(lb_managers.BaseLBManager):
             raise Exception("failure to destroy")
 
     def attach_real(self, lb, host):
-        pass
+        networks = getattr(lb, 'vip_networks', None) or []
+        if host.dns_name == 'unreachable':
+            lb.vip_networks = networks[1:]
+            raise Exception("failure to attach")
+        lb.vip_networks = networks + ['net-' + host.id]
 
     def detach_real(self, lb, host):
         pass
@@ -93,6 +99,27 @@ class LoadBalancerTestCase(unittest.TestCase):
         self.assertEqual(db_lb.hosts[1].config, conf)
         self.assertItemsEqual([h.to_json() for h in db_lb.hosts], [h1.to_json(), h2.to_json()])
 
+    def test_add_host_stores_networks(self):
+        lb = LoadBalancer.create('fake', 'my-lb', {'LB_ID': 'explode'})
+        lb.add_host(Host('x', 'x.me.com'))
+        lb.add_hosts([Host('y', 'y.me.com')])
+        self.assertEqual(LoadBalancer.find('my-lb').vip_networks, ['net-x', 'net-y'])
+        with self.assertRaises(Exception):
+            lb.add_host(Host('z', 'unreachable'))
+        self.assertEqual(LoadBalancer.find('my-lb').vip_networks, ['net-y'])
+
+    def test_add_host_retry_does_not_duplicate(self):
+        h1 = Host('x', 'x.me.com')
+        h2 = Host('y', 'y.me.com')
+        lb = LoadBalancer.create('fake', 'my-lb', {'LB_ID': 'explode'})
+        lb.add_hosts([h1, h2])
+        retried = Host('x', 'x2.me.com')
+        lb.add_host(retried)
+        lb.add_hosts([retried, h2])
+        self.assertEqual(lb.hosts, [retried, h2])
+        db_lb = LoadBalancer.find('my-lb')
+        self.assertEqual([h.to_json() for h in db_lb.hosts], [retried.to_json(), h2.to_json()])
+
     def test_remove_host(self):
         h1 = Host('x', 'x.me.com')
         h2 = Host('y', 'y.me.com')
@@ -103,3 +130,97 @@ class LoadBalancerTestCase(unittest.TestCase):
         self.assertItemsEqual(lb.hosts, [h2])
         db_lb = LoadBalancer.find('my-lb')
         self.assertItemsEqual([h.to_json() for h in db_lb.hosts], [h2.to_json()])
+
+    def test_add_hosts(self):
+        h1 = Host('x', 'x.me.com')
+        h2 = Host('y', 'y.me.com')
+        h3 = Host('z', 'z.me.com')
+        conf = {'LB_ID': 'explode'}
+        lb = LoadBalancer.create('fake', 'my-lb', conf)
+        lb.add_host(h1)
+        with patch.object(FakeManager, 'attach_real') as attach_real:
+            lb.add_hosts([h2, h3])
+        self.assertEqual(attach_real.call_args_list, [call(lb, h2), call(lb, h3)])
+        self.assertItemsEqual(lb.hosts, [h1, h2, h3])
+        db_lb = LoadBalancer.find('my-lb', conf)
+        self.assertEqual([h.to_json() for h in db_lb.hosts], [h1.to_json(), h2.to_json(), h3.to_json()])
+
+    def test_add_hosts_stores_hosts_attached_before_failure(self):
+        h1 = Host('x', 'x.me.com')
+        h2 = Host('y', 'unreachable')
+        h3 = Host('z', 'z.me.com')
+        lb = LoadBalancer.create('fake', 'my-lb', {'LB_ID': 'explode'})
+        with self.assertRaises(Exception) as cm:
+            lb.add_hosts([h1, h2, h3])
+        self.assertEqual(str(cm.exception), "failure to attach")
+        self.assertEqual(lb.hosts, [h1])
+        db_lb = LoadBalancer.find('my-lb')
+        self.assertEqual([h.to_json() for h in db_lb.hosts], [h1.to_json()])
+
+    def test_remove_hosts(self):
+        h1 = Host('x', 'x.me.com')
+        h2 = Host('y', 'y.me.com')
+        h3 = Host('z', 'z.me.com')
+        lb = LoadBalancer.create('fake', 'my-lb', {'LB_ID': 'explode'})
+        lb.add_hosts([h1, h2, h3])
+        with patch.object(FakeManager, 'detach_reals') as detach_reals:
+            lb.remove_hosts([h1, h3])
+        detach_reals.assert_called_once_with(lb, [h1, h3])
+        self.assertItemsEqual(lb.hosts, [h2])
+        db_lb = LoadBalancer.find('my-lb')
+        self.assertItemsEqual([h.to_json() for h in db_lb.hosts], [h2.to_json()])
+
+    def test_list(self):
+        LoadBalancer.create('fake', 'my-lb', {'LB_ID': 'lb-1'})
+        LoadBalancer.create('fake', 'other-lb', {'LB_ID': 'lb-2'})
+        conf = {'MY_CONF': 1}
+        lbs = LoadBalancer.list(conf=conf)
+        self.assertItemsEqual([lb.id for lb in lbs], ['lb-1', 'lb-2'])
+        self.assertDictEqual(lbs[0].config, conf)
+        lbs = LoadBalancer.list({'id': 'lb-2'})
+        self.assertEqual([lb.name for lb in lbs], ['other-lb'])
+
+    def test_list_fields(self):
+        lb = LoadBalancer.create('fake', 'my-lb', {'LB_ID': 'lb-1'})
+        lb.add_hosts([Host('x', 'x.me.com'), Host('y', 'y.me.com')])
+        lbs = LoadBalancer.list(fields=['manager'])
+        self.assertEqual(len(lbs), 1)
+        self.assertEqual(lbs[0].name, 'my-lb')
+        self.assertEqual(lbs[0].address, 'xxx.host')
+        self.assertEqual(lbs[0].manager, 'fake')
+        self.assertEqual(lbs[0].hosts, [])
+        self.assertFalse(hasattr(lbs[0], 'extra'))
+
+    def test_list_lazy(self):
+        lb = LoadBalancer.create('fake', 'my-lb', {'LB_ID': 'lb-1'})
+        h1 = Host('x', 'x.me.com')
+        lb.add_host(h1)
+        lbs = LoadBalancer.list(lazy=True)
+        self.assertNotIsInstance(lbs, list)
+        db_lb = next(lbs)
+        self.assertEqual(db_lb.address, 'xxx.host')
+        with patch.object(Host, 'from_dict') as from_dict:
+            self.assertEqual(db_lb.address, 'xxx.host')
+        self.assertFalse(from_dict.called)
+        self.assertEqual([h.to_json() for h in db_lb.hosts], [h1.to_json()])
+        self.assertIs(db_lb.hosts, db_lb.hosts)
+
+    def test_extra_fields_round_trip(self):
+        lb = LoadBalancer('lb-1', 'my-lb', 'xxx.host', project_id='p1', dsr=True)
+        self.assertFalse(hasattr(lb, '__dict__'))
+        lb.manager = 'fake'
+        data = lb.to_json()
+        self.assertEqual(data, {'_id': 'my-lb', 'id': 'lb-1', 'address': 'xxx.host', 'manager': 'fake',
+                                'project_id': 'p1', 'dsr': True})
+        db_lb = LoadBalancer.from_dict(dict(data, hosts=[{'_id': 'x', 'dns_name': 'x.me.com'}]))
+        self.assertEqual(db_lb.to_json(), data)
+        self.assertEqual([h.id for h in db_lb.hosts], ['x'])
+
+    def test_from_raw_bson_document(self):
+        data = {'_id': 'my-lb', 'id': 'lb-1', 'address': 'xxx.host', 'manager': 'fake',
+                'hosts': [{'_id': 'x', 'dns_name': 'x.me.com'}]}
+        lb = LoadBalancer.from_dict(RawBSONDocument(bson.BSON.encode(data)), conf={'MY_CONF': 1})
+        self.assertEqual((lb.name, lb.id, lb.address, lb.manager), ('my-lb', 'lb-1', 'xxx.host', 'fake'))
+        self.assertEqual([h.to_json() for h in lb.hosts], [Host('x', 'x.me.com').to_json()])
+        self.assertEqual(lb.hosts[0].config, {'MY_CONF': 1})
+        self.assertEqual(data['_id'], 'my-lb')
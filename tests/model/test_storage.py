@@ -0,0 +1,153 @@
+# Copyright 2016 hm authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import unittest
+
+from hm import storage
+from hm.model.host import Host
+from hm.model.load_balancer import LoadBalancer
+from tests.test_storage_engines import StorageContractMixin
+
+
+def index_names(plan):
+    names = []
+    if plan.get("stage") == "IXSCAN":
+        names.append(plan["indexName"])
+    for child in [plan.get("inputStage")] + plan.get("inputStages", []):
+        if child:
+            names.extend(index_names(child))
+    return names
+
+
+class MongoDBStorageIndexesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = storage.MongoDBStorage()
+        self.storage._hosts_collection().drop()
+        self.storage._lb_collection().drop()
+        self.storage.ensure_indexes()
+
+    def winning_plan_indexes(self, collection, filters):
+        explain = collection.find(filters).explain()
+        return index_names(explain["queryPlanner"]["winningPlan"])
+
+    def test_ensure_indexes_idempotent(self):
+        self.storage.ensure_indexes()
+        self.assertItemsEqual(self.storage._hosts_collection().index_information().keys(),
+                              ["_id_", "group_1", "group_1_alternative_id_1", "manager_1"])
+        self.assertItemsEqual(self.storage._lb_collection().index_information().keys(),
+                              ["_id_", "manager_1", "hosts._id_1"])
+
+    def test_hosts_query_plans(self):
+        hosts = self.storage._hosts_collection()
+        indexes = self.winning_plan_indexes(hosts, {"group": "my-group"})
+        self.assertEqual(len(indexes), 1)
+        self.assertTrue(indexes[0].startswith("group_1"))
+        indexes = self.winning_plan_indexes(hosts, {"group": "my-group", "alternative_id": 1})
+        self.assertEqual(indexes, ["group_1_alternative_id_1"])
+        self.assertEqual(self.winning_plan_indexes(hosts, {"manager": "cloudstack"}), ["manager_1"])
+
+    def test_load_balancers_query_plans(self):
+        lbs = self.storage._lb_collection()
+        self.assertEqual(self.winning_plan_indexes(lbs, {"manager": "cloudstack"}), ["manager_1"])
+        self.assertEqual(self.winning_plan_indexes(lbs, {"hosts._id": "host-1"}), ["hosts._id_1"])
+
+    def test_count_hosts_by_alternative(self):
+        hosts = self.storage._hosts_collection()
+        hosts.insert_many([
+            {"_id": "h1", "group": "g1", "alternative_id": 0},
+            {"_id": "h2", "group": "g1", "alternative_id": 1},
+            {"_id": "h3", "group": "g1", "alternative_id": 1},
+            {"_id": "h4", "group": "g1"},
+            {"_id": "h5", "group": "g2", "alternative_id": 2},
+        ])
+        self.assertEqual(self.storage.count_hosts_by_alternative("g1"), {0: 2, 1: 2})
+        self.assertEqual(self.storage.count_hosts_by_alternative("g3"), {})
+
+
+class MongoDBStorageContractTestCase(StorageContractMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.storage = storage.MongoDBStorage()
+        self.storage._hosts_collection().remove()
+        self.storage._lb_collection().remove()
+        self.storage._operations_collection().remove()
+        self.storage._pool_collection().remove()
+
+
+class MongoDBStorageHostReferencesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = storage.MongoDBStorage({"MONGO_LB_HOST_REFERENCES": "true"})
+        self.storage._hosts_collection().remove()
+        self.storage._lb_collection().remove()
+
+    def test_add_hosts_stores_references(self):
+        self.storage.store_hosts([Host("h1", "h1.host", group="g1"), Host("h2", "h2.host")])
+        self.storage.store_load_balancer(LoadBalancer("lb-1", "my-lb", "xxx.host", manager="fake"))
+        self.storage.add_hosts_to_load_balancer("my-lb", [Host("h1", "h1.host"), Host("h2", "h2.host")])
+        self.storage.add_host_to_load_balancer("my-lb", Host("h1", "h1.host"))
+        self.assertEqual(self.storage._lb_collection().find_one({"_id": "my-lb"})["hosts"], ["h1", "h2"])
+        lb = self.storage.find_load_balancer("my-lb")
+        self.assertEqual([(h.id, h.dns_name, h.group) for h in lb.hosts],
+                         [("h1", "h1.host", "g1"), ("h2", "h2.host", None)])
+        self.storage.remove_host_from_load_balancer("my-lb", Host("h1", "h1.host"))
+        lbs = self.storage.list_load_balancers({"manager": "fake"}, fields=["hosts"])
+        self.assertEqual([[h.dns_name for h in l.hosts] for l in lbs], [["h2.host"]])
+        lbs = self.storage.list_load_balancers({"manager": "fake"}, fields=["manager"])
+        self.assertEqual(lbs[0].hosts, [])
+
+    def test_missing_host_keeps_reference(self):
+        lb = LoadBalancer("lb-1", "my-lb", "xxx.host")
+        lb.hosts = [Host("gone", "gone.host")]
+        self.storage.upsert_load_balancers([lb])
+        self.assertEqual(self.storage._lb_collection().find_one({"_id": "my-lb"})["hosts"], ["gone"])
+        self.assertEqual([h.id for h in self.storage.find_load_balancer("my-lb").hosts], ["gone"])
+
+
+class MongoDBStorageCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        storage.reset()
+        self.conf = {"MONGO_CACHE_SIZE": "10"}
+        self.storage = storage.MongoDBStorage(self.conf)
+        self.storage._hosts_collection().remove()
+        self.storage._lb_collection().remove()
+
+    def tearDown(self):
+        storage.reset()
+
+    def test_cache_disabled_by_default(self):
+        self.assertIsNone(storage.MongoDBStorage().cache)
+
+    def test_find_host_read_through(self):
+        self.storage.store_host(Host("h1", "h1.host"))
+        self.assertEqual(self.storage.find_host("h1").dns_name, "h1.host")
+        self.storage._hosts_collection().update({"_id": "h1"}, {"$set": {"dns_name": "changed"}})
+        self.assertEqual(storage.MongoDBStorage(self.conf).find_host("h1").dns_name, "h1.host")
+        self.assertIsNone(self.storage.find_host("missing"))
+        stats = self.storage.cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["size"]), (1, 2, 1))
+        self.storage.remove_host("h1")
+        self.assertIsNone(self.storage.find_host("h1"))
+
+    def test_find_load_balancer_invalidated_by_writes(self):
+        self.storage.store_load_balancer(LoadBalancer("lb-1", "my-lb", "xxx.host"))
+        self.assertEqual(self.storage.find_load_balancer("my-lb").hosts, [])
+        self.storage.add_host_to_load_balancer("my-lb", Host("h1", "h1.host"))
+        self.assertEqual([h.id for h in self.storage.find_load_balancer("my-lb").hosts], ["h1"])
+        self.storage.add_hosts_to_load_balancer("my-lb", [Host("h2", "h2.host")])
+        self.assertEqual([h.id for h in self.storage.find_load_balancer("my-lb").hosts], ["h1", "h2"])
+        self.storage.remove_hosts_from_load_balancer("my-lb", [Host("h1", "h1.host")])
+        self.assertEqual([h.id for h in self.storage.find_load_balancer("my-lb").hosts], ["h2"])
+        self.storage.remove_host_from_load_balancer("my-lb", Host("h2", "h2.host"))
+        self.assertEqual(self.storage.find_load_balancer("my-lb").hosts, [])
+        self.storage.remove_load_balancer("my-lb")
+        self.assertIsNone(self.storage.find_load_balancer("my-lb"))
+
+    def test_cached_models_get_caller_config(self):
+        self.storage.store_host(Host("h1", "h1.host"))
+        self.storage.find_host("h1")
+        conf = dict(self.conf, MY_CONF=1)
+        self.assertEqual(storage.MongoDBStorage(conf).find_host("h1").config, conf)
@@ -0,0 +1,63 @@
+# Copyright 2016 hm authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import unittest
+
+import mock
+
+from hm import cache
+
+
+class LRUCacheTestCase(unittest.TestCase):
+
+    def test_get_and_set(self):
+        documents = cache.LRUCache(10, 5)
+        self.assertEqual(documents.get("a")[0], None)
+        documents.set("a", {"_id": "a"})
+        self.assertEqual(documents.get("a")[0], {"_id": "a"})
+        self.assertEqual(documents.stats(),
+                         {"size": 1, "hits": 1, "misses": 1, "evictions": 0, "expirations": 0})
+
+    def test_evicts_least_recently_used(self):
+        documents = cache.LRUCache(2, 5)
+        documents.set("a", 1)
+        documents.set("b", 2)
+        documents.get("a")
+        documents.set("c", 3)
+        self.assertEqual(documents.get("b")[0], None)
+        self.assertEqual(documents.get("a")[0], 1)
+        self.assertEqual(documents.get("c")[0], 3)
+        self.assertEqual(documents.stats()["evictions"], 1)
+
+    @mock.patch("hm.cache.time")
+    def test_expires_entries(self, time):
+        time.time.return_value = 100
+        documents = cache.LRUCache(10, 5)
+        documents.set("a", 1)
+        time.time.return_value = 104.9
+        self.assertEqual(documents.get("a")[0], 1)
+        time.time.return_value = 105
+        self.assertEqual(documents.get("a")[0], None)
+        self.assertEqual(documents.stats(),
+                         {"size": 0, "hits": 1, "misses": 1, "evictions": 0, "expirations": 1})
+
+    def test_invalidate(self):
+        documents = cache.LRUCache(10, 5)
+        documents.set("a", 1)
+        documents.set("b", 2)
+        documents.invalidate("a")
+        self.assertEqual(documents.get("a")[0], None)
+        self.assertEqual(documents.get("b")[0], 2)
+        documents.clear()
+        self.assertEqual(documents.get("b")[0], None)
+
+    def test_set_discards_values_read_before_invalidation(self):
+        documents = cache.LRUCache(10, 5)
+        _, generation = documents.get("a")
+        documents.invalidate("a")
+        documents.set("a", "stale", generation)
+        self.assertEqual(documents.get("a")[0], None)
+        _, generation = documents.get("a")
+        documents.set("a", "fresh", generation)
+        self.assertEqual(documents.get("a")[0], "fresh")
@@ -0,0 +1,106 @@
+# Copyright 2016 hm authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import unittest
+
+import mock
+from concurrent import futures
+
+from hm.iaas import cloudstack_async, cloudstack_client, polling
+
+
+def done(result=None, exception=None):
+    future = futures.Future()
+    if exception is not None:
+        future.set_exception(exception)
+    else:
+        future.set_result(result)
+    return future
+
+
+class CoroutineTestCase(unittest.TestCase):
+
+    def test_coroutine_result(self):
+        @cloudstack_async.coroutine
+        def add(a, b):
+            x = yield done(a)
+            y = yield done(b)
+            raise cloudstack_async.Return(x + y)
+        self.assertEqual(add(1, 2).result(1), 3)
+
+    def test_coroutine_exception(self):
+        @cloudstack_async.coroutine
+        def fail():
+            try:
+                yield done(exception=ValueError("inner"))
+            except ValueError as e:
+                raise Exception("caught {}".format(e))
+        with self.assertRaises(Exception) as cm:
+            fail().result(1)
+        self.assertEqual(str(cm.exception), "caught inner")
+
+    def test_coroutine_yield_list(self):
+        @cloudstack_async.coroutine
+        def both():
+            results = yield [done(1), done(2)]
+            raise cloudstack_async.Return(results)
+        self.assertEqual(both().result(1), [1, 2])
+
+    def test_gather_exception(self):
+        future = cloudstack_async.gather([done(1), done(exception=ValueError("x"))])
+        with self.assertRaises(ValueError):
+            future.result(1)
+
+
+class AsyncCloudStackTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = cloudstack_async.AsyncCloudStack("http://localhost", "api_key", "secret!")
+
+    @mock.patch('hm.iaas.cloudstack_client.urllib')
+    def test_make_request(self, urllib):
+        urllib.quote_plus.side_effect = lambda x: x
+        urllib.urlopen.return_value.read.return_value = '{"listvirtualmachinesresponse":{"count":1}}'
+        future = self.client.listVirtualMachines({"id": "x"})
+        self.assertEqual(future.result(1), {"count": 1})
+
+    @mock.patch('hm.iaas.cloudstack_client.urllib')
+    def test_wait_for_job(self, urllib):
+        urllib.quote_plus.side_effect = lambda x: x
+        urllib.urlopen.return_value.read.side_effect = [
+            '{"queryasyncjobresultresponse":{"jobstatus":0}}',
+            '{"queryasyncjobresultresponse":{"jobstatus":1}}',
+        ]
+        result = self.client.wait_for_job('x', polling.MaxTriesPolicy(3, interval=0)).result(5)
+        self.assertEqual(result, {"jobstatus": 1})
+        self.assertEqual(urllib.urlopen.call_count, 2)
+        urllib.urlopen.assert_called_with(
+            'http://localhost?apiKey=api_key&command=queryAsyncJobResult'
+            '&jobid=x&response=json&signature=glJwmvjkOcgmqZljJdlruU89Q0o=')
+
+    @mock.patch('hm.iaas.cloudstack_client.urllib')
+    def test_wait_for_job_timeout(self, urllib):
+        urllib.quote_plus.side_effect = lambda x: x
+        urllib.urlopen.return_value.read.return_value = '{"queryasyncjobresultresponse":{"jobstatus":0}}'
+        with self.assertRaises(cloudstack_client.MaxTryWaitingForJobError) as cm:
+            self.client.wait_for_job('x', polling.MaxTriesPolicy(2, interval=0)).result(5)
+        self.assertEqual("exceeded 2 tries waiting for job x", str(cm.exception))
+        self.assertEqual(urllib.urlopen.call_count, 2)
+
+    @mock.patch('hm.iaas.cloudstack_client.urllib')
+    def test_wait_for_job_error_result(self, urllib):
+        urllib.quote_plus.side_effect = lambda x: x
+        urllib.urlopen.return_value.read.return_value = '{"queryasyncjobresultresponse":{"jobstatus":2}}'
+        with self.assertRaises(cloudstack_client.AsyncJobError) as cm:
+            self.client.wait_for_job('x', polling.MaxTriesPolicy(3, interval=0)).result(5)
+        self.assertEqual("async job error: {u'jobstatus': 2}", str(cm.exception))
+        self.assertEqual(urllib.urlopen.call_count, 1)
+
+    @mock.patch('hm.iaas.cloudstack_client.urllib')
+    def test_wait_for_many_jobs(self, urllib):
+        urllib.quote_plus.side_effect = lambda x: x
+        urllib.urlopen.return_value.read.return_value = '{"queryasyncjobresultresponse":{"jobstatus":1}}'
+        jobs = [self.client.wait_for_job(str(i), polling.MaxTriesPolicy(3, interval=0)) for i in range(200)]
+        results = cloudstack_async.gather(jobs).result(10)
+        self.assertEqual(len(results), 200)
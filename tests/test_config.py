@@ -0,0 +1,139 @@
+# Copyright 2016 hm authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import os
+import unittest
+
+import mock
+
+from hm import config
+
+
+class Built(object):
+
+    def __init__(self, conf):
+        self.config = conf
+
+
+class ConfigSnapshotTestCase(unittest.TestCase):
+
+    @mock.patch.dict(os.environ, {"FROM_ENV": "env", "OVERRIDDEN": "env"})
+    def test_values(self):
+        snapshot = config.ConfigSnapshot({"OVERRIDDEN": "conf", "NONE": None, "A": "1"})
+        self.assertEqual(snapshot.value("FROM_ENV"), "env")
+        self.assertEqual(snapshot.value("OVERRIDDEN"), "conf")
+        self.assertEqual(snapshot.value("NONE", "default"), "default")
+        self.assertEqual(snapshot.A, "1")
+        self.assertEqual(snapshot["A"], "1")
+        self.assertEqual(snapshot.get("MISSING"), None)
+        with self.assertRaises(config.MissConfigurationError):
+            snapshot.value("MISSING")
+        with self.assertRaises(AttributeError):
+            snapshot.MISSING
+        os.environ["FROM_ENV"] = "changed"
+        self.assertEqual(snapshot.value("FROM_ENV"), "env")
+
+    def test_get_config_compatibility(self):
+        snapshot = config.ConfigSnapshot({"A": "1"}, environ={})
+        self.assertEqual(config.get_config("A", None, snapshot), "1")
+        self.assertEqual(config.get_config("B", "2", snapshot), "2")
+        with self.assertRaises(config.MissConfigurationError):
+            config.get_config("B", config=snapshot)
+
+    def test_immutable_and_hashable(self):
+        snapshot = config.ConfigSnapshot({"A": "1"}, environ={})
+        with self.assertRaises(AttributeError):
+            snapshot.A = "2"
+        self.assertEqual(snapshot, config.ConfigSnapshot({"A": "1"}, environ={}))
+        self.assertEqual(hash(snapshot), hash(config.ConfigSnapshot({"A": "1"}, environ={})))
+
+    def test_alternate(self):
+        snapshot = config.ConfigSnapshot({"ZONE": "z", "ZONE_1": "z1", "ZONE_2": None}, environ={})
+        self.assertEqual(snapshot.alternate("ZONE", 0), "z")
+        self.assertEqual(snapshot.alternate("ZONE", 1), "z1")
+        self.assertEqual(snapshot.alternate("ZONE", 2), "z")
+        self.assertEqual(snapshot.alternate("OTHER", 1), None)
+
+    def test_indexed_list(self):
+        snapshot = config.ConfigSnapshot({"NET_0": "a", "NET_1": "b", "NET_2": "", "NET_3": "d",
+                                          "GAP_1": "x"}, environ={})
+        self.assertEqual(snapshot.indexed_list("NET"), ("a", "b"))
+        self.assertEqual(snapshot.indexed_list("GAP"), ())
+
+    def test_typed_values(self):
+        snapshot = config.ConfigSnapshot({"N": "3", "F": "0.5", "B": "True", "L": "a,b"}, environ={})
+        self.assertEqual(snapshot.get_int("N"), 3)
+        self.assertEqual(snapshot.get_int("MISSING", 7), 7)
+        self.assertEqual(snapshot.get_float("F"), 0.5)
+        self.assertTrue(snapshot.get_bool("B"))
+        self.assertFalse(snapshot.get_bool("MISSING", "false"))
+        self.assertEqual(snapshot.get_list("L"), ["a", "b"])
+        self.assertEqual(snapshot.get_list("MISSING", ""), [])
+
+
+class InstanceCacheTestCase(unittest.TestCase):
+
+    def test_same_contents_share_instance(self):
+        cache = config.InstanceCache()
+        conf = {"A": "1", "PORTS": ["80", "443"]}
+        instance = cache.get("x", conf, Built)
+        self.assertIs(cache.get("x", {"A": "1", "PORTS": ["80", "443"]}, Built), instance)
+        self.assertIsNot(cache.get("y", conf, Built), instance)
+        self.assertEqual(instance.config, conf)
+        self.assertIsNot(instance.config, conf)
+
+    def test_changed_config_builds_new_instance(self):
+        cache = config.InstanceCache()
+        conf = {"A": "1"}
+        instance = cache.get("x", conf, Built)
+        conf["A"] = "2"
+        other = cache.get("x", conf, Built)
+        self.assertIsNot(other, instance)
+        self.assertEqual(instance.config, {"A": "1"})
+        self.assertEqual(other.config, {"A": "2"})
+        self.assertIs(cache.get("x", None, Built), cache.get("x", {}, Built))
+
+    @mock.patch.dict(os.environ, {"HM_TEST_SETTING": "1"})
+    def test_changed_environment_builds_new_instance(self):
+        cache = config.InstanceCache()
+        instance = cache.get("x", {"A": "1"}, Built)
+        self.assertIs(cache.get("x", {"A": "1"}, Built), instance)
+        os.environ["HM_TEST_SETTING"] = "2"
+        self.assertIsNot(cache.get("x", {"A": "1"}, Built), instance)
+        os.environ["HM_TEST_SETTING"] = "1"
+        self.assertIs(cache.get("x", {"A": "1"}, Built), instance)
+
+    def test_bounded_lru(self):
+        cache = config.InstanceCache(max_size=2)
+        first = cache.get("x", {"A": "1"}, Built)
+        second = cache.get("x", {"A": "2"}, Built)
+        self.assertIs(cache.get("x", {"A": "1"}, Built), first)
+        cache.get("x", {"A": "3"}, Built)
+        self.assertIs(cache.get("x", {"A": "1"}, Built), first)
+        self.assertIsNot(cache.get("x", {"A": "2"}, Built), second)
+
+    def test_clear(self):
+        cache = config.InstanceCache()
+        x = cache.get("x", None, Built)
+        y = cache.get("y", None, Built)
+        cache.clear("x")
+        self.assertIsNot(cache.get("x", None, Built), x)
+        self.assertIs(cache.get("y", None, Built), y)
+        cache.clear()
+        self.assertIsNot(cache.get("y", None, Built), y)
+
+    def test_freeze_unhashable_values(self):
+        self.assertEqual(config.freeze({"B": {"c": [1]}, "A": set([2, 1])}),
+                         (("A", ("set", (1, 2))), ("B", (("c", ("list", (1,))),))))
+
+    def test_fingerprint(self):
+        settings = {"CLOUDSTACK_TEMPLATE_ID": "t1", "HOST_POOL_SIZE": "2", "PATH": "/bin"}
+        fingerprint = config.fingerprint(settings, ("CLOUDSTACK_",))
+        self.assertEqual(config.fingerprint(dict(settings, PATH="/usr/bin"), ("CLOUDSTACK_",)), fingerprint)
+        self.assertNotEqual(config.fingerprint(dict(settings, CLOUDSTACK_TEMPLATE_ID="t2"), ("CLOUDSTACK_",)),
+                            fingerprint)
+        everything = config.fingerprint(settings, exclude=("HOST_POOL_",))
+        self.assertEqual(config.fingerprint(dict(settings, HOST_POOL_SIZE="5"), exclude=("HOST_POOL_",)),
+                         everything)
+        self.assertNotEqual(config.fingerprint(dict(settings, PATH="/usr/bin")), everything)
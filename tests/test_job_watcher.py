@@ -0,0 +1,139 @@
+# Copyright 2016 hm authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import unittest
+
+import mock
+
+from hm.iaas import cloudstack_client, job_watcher, polling
+
+
+class JobWatcherTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = mock.Mock()
+        self.watcher = job_watcher.JobWatcher(self.client)
+
+    def test_poll_uses_single_list_call(self):
+        self.client.listAsyncJobs.return_value = {"asyncjobs": [
+            {"jobid": "j1", "jobstatus": 1},
+            {"jobid": "j2", "jobstatus": 0},
+            {"jobid": "other", "jobstatus": 1},
+        ]}
+        f1 = self.watcher.watch("j1", polling.MaxTriesPolicy(3, interval=0))
+        f2 = self.watcher.watch("j2", polling.MaxTriesPolicy(3, interval=0))
+        self.watcher.poll()
+        self.assertEqual(f1.result(0), {"jobid": "j1", "jobstatus": 1})
+        self.assertFalse(f2.done())
+        self.client.listAsyncJobs.assert_called_once_with({"listall": "true"})
+        self.assertFalse(self.client.queryAsyncJobResult.called)
+        self.client.listAsyncJobs.return_value = {"asyncjobs": [{"jobid": "j2", "jobstatus": 1}]}
+        self.watcher.poll()
+        self.assertEqual(f2.result(0), {"jobid": "j2", "jobstatus": 1})
+        self.assertEqual(self.client.listAsyncJobs.call_count, 2)
+
+    def test_poll_queries_jobs_missing_from_list(self):
+        self.client.listAsyncJobs.return_value = {"asyncjobs": []}
+        self.client.queryAsyncJobResult.return_value = {"jobstatus": 1}
+        future = self.watcher.watch("j1", polling.MaxTriesPolicy(3, interval=0))
+        self.watcher.poll()
+        self.assertEqual(future.result(0), {"jobstatus": 1})
+        self.client.queryAsyncJobResult.assert_called_once_with({"jobid": "j1"})
+
+    @mock.patch("hm.iaas.job_watcher.log")
+    def test_poll_falls_back_when_list_unavailable(self, log):
+        self.client.listAsyncJobs.side_effect = cloudstack_client.InvalidResponse("unknown command")
+        self.client.queryAsyncJobResult.return_value = {"jobstatus": 1}
+        future = self.watcher.watch("j1", polling.MaxTriesPolicy(3, interval=0))
+        self.watcher.poll()
+        self.assertEqual(future.result(0), {"jobstatus": 1})
+        self.assertTrue(self.watcher.use_list_jobs)
+        for i in range(3):
+            self.watcher.watch("j2", polling.MaxTriesPolicy(3, interval=0))
+            self.watcher.poll()
+        self.assertFalse(self.watcher.use_list_jobs)
+        self.assertEqual(self.client.listAsyncJobs.call_count, 3)
+
+    @mock.patch("hm.iaas.job_watcher.log")
+    def test_poll_keeps_list_after_transient_invalid_response(self, log):
+        self.client.listAsyncJobs.side_effect = [
+            cloudstack_client.InvalidResponse("bad gateway"), {"asyncjobs": []},
+            cloudstack_client.InvalidResponse("bad gateway"), {"asyncjobs": []},
+            cloudstack_client.InvalidResponse("bad gateway"), {"asyncjobs": []},
+        ]
+        self.client.queryAsyncJobResult.return_value = {"jobstatus": 1}
+        for i in range(6):
+            self.watcher.watch("j1", polling.MaxTriesPolicy(3, interval=0))
+            self.watcher.poll()
+        self.assertTrue(self.watcher.use_list_jobs)
+        self.assertEqual(self.client.listAsyncJobs.call_count, 6)
+
+    @mock.patch("hm.iaas.job_watcher.log")
+    def test_poll_falls_back_when_list_fails(self, log):
+        self.client.listAsyncJobs.side_effect = IOError("connection refused")
+        self.client.queryAsyncJobResult.return_value = {"jobstatus": 1}
+        future = self.watcher.watch("j1", polling.MaxTriesPolicy(3, interval=0))
+        self.watcher.poll()
+        self.assertEqual(future.result(0), {"jobstatus": 1})
+        self.assertTrue(self.watcher.use_list_jobs)
+        log.exception.assert_called_once_with("error listing async jobs, polling jobs one by one")
+
+    @mock.patch("hm.iaas.job_watcher.log")
+    def test_poll_max_tries_when_everything_fails(self, log):
+        self.client.listAsyncJobs.side_effect = IOError("connection refused")
+        self.client.queryAsyncJobResult.side_effect = IOError("connection refused")
+        future = self.watcher.watch("x", polling.MaxTriesPolicy(2, interval=0))
+        self.watcher.poll()
+        self.assertFalse(future.done())
+        self.watcher.poll()
+        with self.assertRaises(IOError):
+            future.result(0)
+        self.watcher.poll()
+        self.assertEqual(self.client.queryAsyncJobResult.call_count, 2)
+
+    def test_poll_max_tries(self):
+        self.client.listAsyncJobs.return_value = {"asyncjobs": [{"jobid": "x", "jobstatus": 0}]}
+        future = self.watcher.watch("x", polling.MaxTriesPolicy(2, interval=0))
+        self.watcher.poll()
+        self.assertFalse(future.done())
+        self.watcher.poll()
+        with self.assertRaises(cloudstack_client.MaxTryWaitingForJobError) as cm:
+            future.result(0)
+        self.assertEqual("exceeded 2 tries waiting for job x", str(cm.exception))
+        self.watcher.poll()
+        self.assertEqual(self.client.listAsyncJobs.call_count, 2)
+
+    def test_poll_job_error(self):
+        self.client.listAsyncJobs.return_value = {"asyncjobs": []}
+        self.client.queryAsyncJobResult.return_value = {"jobstatus": 2}
+        future = self.watcher.watch("x", polling.MaxTriesPolicy(2, interval=0))
+        self.watcher.poll()
+        with self.assertRaises(cloudstack_client.AsyncJobError) as cm:
+            future.result(0)
+        self.assertEqual("async job error: {'jobstatus': 2}", str(cm.exception))
+
+    def test_poll_query_error(self):
+        self.client.listAsyncJobs.return_value = {"asyncjobs": []}
+        self.client.queryAsyncJobResult.side_effect = cloudstack_client.InvalidResponse("boom")
+        future = self.watcher.watch("x", polling.MaxTriesPolicy(2, interval=0))
+        self.watcher.poll()
+        self.assertFalse(future.done())
+        self.watcher.poll()
+        with self.assertRaises(cloudstack_client.InvalidResponse):
+            future.result(0)
+
+    def test_client_wait_for_job_uses_watcher(self):
+        client = cloudstack_client.CloudStack("http://localhost", "api_key", "secret!")
+        client.job_watcher = mock.Mock()
+        client.job_watcher.wait_for_job.return_value = {"jobstatus": 1}
+        policy = polling.MaxTriesPolicy(3)
+        self.assertEqual(client.wait_for_job("x", policy), {"jobstatus": 1})
+        client.job_watcher.wait_for_job.assert_called_once_with("x", policy, None)
+
+    def test_from_config(self):
+        client = cloudstack_client.CloudStack("http://localhost", "api_key", "secret!")
+        self.assertIsNone(job_watcher.from_config(client, {}))
+        watcher = job_watcher.from_config(client, {"CLOUDSTACK_JOB_WATCHER": "true"})
+        self.assertIs(watcher, job_watcher.from_config(client, {"CLOUDSTACK_JOB_WATCHER": "1"}))
+        self.assertEqual(watcher.client.api_url, "http://localhost")
@@ -0,0 +1,195 @@
+# Copyright 2016 hm authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import time
+import unittest
+
+import mock
+
+from hm import journal, lb_managers, managers, model
+from hm.model.host import Host
+from hm.model.load_balancer import LoadBalancer
+from hm.storage import memory
+
+
+class JournalManager(managers.BaseManager):
+
+    def create_host(self, name=None, alternative_id=0):
+        journal.record('deploy_vm', vm_id='vm-1')
+        return Host('vm-1', 'vm-1.host', alternative_id=alternative_id)
+
+    def destroy_host(self, id):
+        pass
+
+    def rollback_operation(self, operation):
+        for step in reversed(operation.steps):
+            self.destroy_host(step['vm_id'])
+            operation.forget(**step)
+
+
+class JournalLBManager(lb_managers.BaseLBManager):
+
+    def create_load_balancer(self, name):
+        journal.record('associate_ip', ip_id='ip-1')
+        return LoadBalancer('lb-1', name, '10.0.0.1')
+
+    def destroy_load_balancer(self, lb):
+        pass
+
+    def attach_real(self, lb, host):
+        pass
+
+    def detach_real(self, lb, host):
+        pass
+
+    def rollback_operation(self, operation):
+        operation.forget('associate_ip')
+
+
+class NoRollbackManager(managers.BaseManager):
+
+    def create_host(self, name=None, alternative_id=0):
+        journal.record('deploy_vm', vm_id='vm-1')
+        raise Exception("timeout")
+
+    def destroy_host(self, id):
+        pass
+
+
+managers.register('journal', JournalManager)
+managers.register('no-rollback', NoRollbackManager)
+lb_managers.register('journal', JournalLBManager)
+
+
+class JournalTestCase(unittest.TestCase):
+
+    def setUp(self):
+        memory.clear()
+        self.conf = {"STORAGE_ENGINE": "memory", "HM_JOURNAL": "true"}
+        self.storage = model.storage(self.conf)
+
+    def tearDown(self):
+        memory.clear()
+
+    def test_operation_succeeded(self):
+        with journal.operation('create_host', 'journal', self.conf, group='g1') as op:
+            self.assertEqual(self.storage.list_operations({})[0]['params'], {'group': 'g1'})
+            journal.record('deploy_vm', vm_id='vm-1')
+            self.assertIs(journal.current(), op)
+        self.assertIsNone(journal.current())
+        self.assertEqual(self.storage.list_operations({}), [])
+
+    def test_operation_failed_without_steps(self):
+        with self.assertRaises(ValueError):
+            with journal.operation('create_host', 'journal', self.conf):
+                journal.record('deploy_vm', vm_id='vm-1')
+                journal.forget('deploy_vm')
+                raise ValueError("boom")
+        self.assertEqual(self.storage.list_operations({}), [])
+
+    def test_operation_failed_keeps_steps(self):
+        with self.assertRaises(ValueError):
+            with journal.operation('create_host', 'journal', self.conf):
+                journal.record('deploy_vm', vm_id='vm-1', job_id='job-1')
+                raise ValueError("boom")
+        ops = self.storage.list_operations({})
+        self.assertEqual(len(ops), 1)
+        self.assertEqual((ops[0]['status'], ops[0]['error']), (journal.FAILED, "boom"))
+        self.assertEqual(ops[0]['steps'], [{'name': 'deploy_vm', 'vm_id': 'vm-1', 'job_id': 'job-1'}])
+
+    def test_operation_disabled(self):
+        conf = {"STORAGE_ENGINE": "memory"}
+        with journal.operation('create_host', 'journal', conf) as op:
+            journal.record('deploy_vm', vm_id='vm-1')
+        self.assertIsNone(op)
+        self.assertEqual(self.storage.list_operations({}), [])
+
+    def test_record_without_operation(self):
+        journal.record('deploy_vm', vm_id='vm-1')
+        journal.forget('deploy_vm')
+        self.assertEqual(self.storage.list_operations({}), [])
+
+    def test_host_create_store_failure_is_resumed(self):
+        with mock.patch.object(memory.MemoryStorage, 'store_host', side_effect=Exception("db down")):
+            with self.assertRaises(Exception):
+                Host.create('journal', 'g1', self.conf)
+        self.assertEqual([op['status'] for op in self.storage.list_operations({})], [journal.FAILED])
+        result = journal.resume_or_rollback(self.conf)
+        self.assertEqual(len(result['resumed']), 1)
+        h = self.storage.find_host('vm-1')
+        self.assertEqual((h.manager, h.group), ('journal', 'g1'))
+        self.assertEqual(self.storage.list_operations({}), [])
+
+    def test_host_create_failure_is_rolled_back(self):
+        with mock.patch.object(JournalManager, 'create_host', side_effect=Exception("timeout")):
+            with self.assertRaises(Exception):
+                Host.create('journal', 'g1', self.conf)
+        self.assertEqual(self.storage.list_operations({}), [])
+        op = journal.begin('create_host', 'journal', self.conf)
+        journal.record('deploy_vm', vm_id='vm-2')
+        journal.end(op, Exception("timeout"))
+        with mock.patch.object(JournalManager, 'destroy_host') as destroy_host:
+            result = journal.resume_or_rollback(self.conf)
+        destroy_host.assert_called_once_with('vm-2')
+        self.assertEqual(result['rolled_back'], [op.id])
+        self.assertIsNone(self.storage.find_host('vm-2'))
+
+    def test_manager_without_rollback(self):
+        with self.assertRaises(Exception):
+            Host.create('no-rollback', 'g1', self.conf)
+        op_id = self.storage.list_operations({})[0]['_id']
+        with mock.patch('hm.log.error') as log_error:
+            result = journal.resume_or_rollback(self.conf)
+        self.assertEqual(result['unrecovered'], [op_id])
+        self.assertEqual(result['rolled_back'], [])
+        self.assertIn('vm-1', log_error.call_args[0][0])
+        ops = self.storage.list_operations({})
+        self.assertEqual([(op['_id'], op['status']) for op in ops], [(op_id, journal.UNRECOVERABLE)])
+        self.assertEqual(ops[0]['steps'], [{'name': 'deploy_vm', 'vm_id': 'vm-1'}])
+        self.assertIn('vm-1', ops[0]['error'])
+        result = journal.resume_or_rollback(self.conf, older_than=0)
+        self.assertEqual(result['unrecovered'], [])
+        self.assertEqual(len(self.storage.list_operations({})), 1)
+
+    def test_load_balancer_create_store_failure_is_resumed(self):
+        with mock.patch.object(memory.MemoryStorage, 'store_load_balancer', side_effect=Exception("db down")):
+            with self.assertRaises(Exception):
+                LoadBalancer.create('journal', 'my-lb', self.conf)
+        op_id = self.storage.list_operations({})[0]['_id']
+        self.assertEqual(journal.resume_or_rollback(self.conf)['resumed'], [op_id])
+        self.assertEqual(self.storage.find_load_balancer('my-lb').id, 'lb-1')
+
+    def test_load_balancer_name_taken_is_rolled_back(self):
+        self.storage.store_load_balancer(LoadBalancer('other', 'my-lb', '10.0.0.2'))
+        with self.assertRaises(Exception):
+            LoadBalancer.create('journal', 'my-lb', self.conf)
+        with mock.patch.object(JournalLBManager, 'rollback_operation') as rollback:
+            result = journal.resume_or_rollback(self.conf)
+        self.assertEqual(len(result['rolled_back']), 1)
+        self.assertEqual(rollback.call_args[0][0].step('associate_ip')['ip_id'], 'ip-1')
+        self.assertEqual(self.storage.find_load_balancer('my-lb').id, 'other')
+
+    def test_resume_or_rollback_selects_operations(self):
+        now = time.time()
+        self.storage.store_operation({'_id': 'recent', 'kind': 'create_host', 'manager': 'journal',
+                                      'status': journal.RUNNING, 'steps': [], 'updated_at': now})
+        self.storage.store_operation({'_id': 'stale', 'kind': 'create_host', 'manager': 'journal',
+                                      'status': journal.RUNNING, 'steps': [], 'updated_at': now - 100})
+        self.storage.store_operation({'_id': 'unknown', 'kind': 'other', 'status': journal.FAILED,
+                                      'steps': [], 'updated_at': now})
+        result = journal.resume_or_rollback(self.conf, older_than=50)
+        self.assertEqual(result, {'resumed': [], 'rolled_back': ['stale'], 'failed': ['unknown'],
+                                  'unrecovered': []})
+        ops = self.storage.list_operations({})
+        self.assertEqual([(op['_id'], op['status']) for op in ops],
+                         [('recent', journal.RUNNING), ('unknown', journal.FAILED)])
+        self.assertEqual(ops[1]['error'], "no recovery handler for operation kind other")
+
+    def test_resume_or_rollback_skips_claimed_operations(self):
+        doc = {'_id': 'op', 'kind': 'create_host', 'manager': 'journal', 'status': journal.FAILED,
+               'steps': [], 'updated_at': time.time()}
+        self.storage.store_operation(doc)
+        self.storage.update_operation('op', {'status': journal.RECOVERING})
+        self.assertEqual(journal._recover(self.storage, doc, self.conf), ('op', None))
+        self.assertEqual(self.storage.list_operations({})[0]['status'], journal.RECOVERING)
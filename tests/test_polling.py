@@ -0,0 +1,123 @@
+# Copyright 2016 hm authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import unittest
+
+import mock
+
+from hm import config
+from hm.iaas import cloudstack_client, polling
+
+
+class PollingPolicyTestCase(unittest.TestCase):
+
+    def test_from_config_default(self):
+        policy = polling.from_config({})
+        self.assertIsInstance(policy, polling.MaxTriesPolicy)
+        self.assertEqual((policy.max_tries, policy.interval), (100, 1))
+        self.assertIs(policy, polling.from_config({}))
+
+    def test_from_config_max_tries(self):
+        policy = polling.from_config({"CLOUDSTACK_MAX_TRIES": "20"})
+        self.assertIsInstance(policy, polling.MaxTriesPolicy)
+        self.assertEqual(policy.max_tries, 20)
+        policy = polling.from_config({"CLOUDSTACK_POLLING_POLICY": "max_tries", "CLOUDSTACK_MAX_TRIES": "30"})
+        self.assertEqual(policy.max_tries, 30)
+
+    def test_from_config_adaptive(self):
+        policy = polling.from_config({"CLOUDSTACK_POLLING_POLICY": "adaptive"})
+        self.assertIsInstance(policy, polling.AdaptivePolicy)
+        self.assertLess(policy.first_delay, 1)
+        self.assertEqual(policy.deadline, 300)
+        self.assertIs(policy, polling.from_config({"CLOUDSTACK_POLLING_POLICY": "adaptive"}))
+
+    def test_from_config_backoff(self):
+        policy = polling.from_config({
+            "CLOUDSTACK_POLLING_POLICY": "backoff",
+            "CLOUDSTACK_POLLING_FIRST_DELAY": "0.1",
+            "CLOUDSTACK_POLLING_FACTOR": "3",
+            "CLOUDSTACK_POLLING_MAX_DELAY": "5",
+            "CLOUDSTACK_POLLING_DEADLINE": "60",
+            "CLOUDSTACK_POLLING_JITTER": "true",
+            "CLOUDSTACK_MAX_TRIES": "20",
+        })
+        self.assertEqual(type(policy), polling.BackoffPolicy)
+        self.assertEqual(policy.first_delay, 0.1)
+        self.assertEqual(policy.factor, 3)
+        self.assertEqual(policy.max_delay, 5)
+        self.assertEqual(policy.deadline, 60)
+        self.assertTrue(policy.jitter)
+
+    def test_from_config_invalid(self):
+        with self.assertRaises(config.MissConfigurationError):
+            polling.from_config({"CLOUDSTACK_POLLING_POLICY": "whatever"})
+
+    def test_max_tries_schedule(self):
+        schedule = polling.MaxTriesPolicy(3).schedule()
+        self.assertEqual([schedule.next_delay() for i in range(4)], [0, 1, 1, None])
+        exc = schedule.timeout_error("job-1")
+        self.assertIsInstance(exc, cloudstack_client.MaxTryWaitingForJobError)
+        self.assertEqual(str(exc), "exceeded 3 tries waiting for job job-1")
+
+    @mock.patch("hm.iaas.polling.time")
+    def test_backoff_schedule(self, time):
+        time.time.return_value = 100
+        schedule = polling.BackoffPolicy(first_delay=0.25, factor=2, max_delay=1, deadline=10).schedule()
+        self.assertEqual([schedule.next_delay() for i in range(5)], [0.25, 0.5, 1, 1, 1])
+        time.time.return_value = 109.5
+        self.assertEqual(schedule.next_delay(), 0.5)
+        time.time.return_value = 110
+        self.assertIsNone(schedule.next_delay())
+        exc = schedule.timeout_error("job-1")
+        self.assertIsInstance(exc, cloudstack_client.MaxTryWaitingForJobError)
+        self.assertEqual(str(exc), "exceeded 10 seconds waiting for job job-1")
+
+    def test_backoff_jitter(self):
+        policy = polling.BackoffPolicy(first_delay=1, factor=2, max_delay=8, jitter=True)
+        for i in range(20):
+            delay = policy.delay(2)
+            self.assertTrue(2 <= delay <= 4)
+
+    def test_adaptive_learns_command_duration(self):
+        policy = polling.AdaptivePolicy(first_delay=0.25, deadline=100)
+        self.assertEqual(policy.schedule("deployVirtualMachine").next_delay(), 0.25)
+        policy.observe("deployVirtualMachine", 30)
+        self.assertEqual(policy.schedule("deployVirtualMachine").next_delay(), 27)
+        policy.observe("deployVirtualMachine", 40)
+        self.assertEqual(policy.durations["deployVirtualMachine"], 33)
+        policy.observe("createTags", 0.1)
+        self.assertEqual(policy.schedule("createTags").next_delay(), 0.25)
+        self.assertEqual(policy.schedule(None).next_delay(), 0.25)
+
+
+class WaitForJobPolicyTestCase(unittest.TestCase):
+
+    @mock.patch('hm.iaas.cloudstack_client.time')
+    @mock.patch('hm.iaas.cloudstack_client.urllib')
+    def test_wait_for_job_observes_command(self, urllib, time):
+        client = cloudstack_client.CloudStack("http://localhost", "api_key", "secret!")
+        urllib.quote_plus.side_effect = lambda x: x
+        urllib.urlopen.return_value.read.side_effect = [
+            '{"createtagsresponse":{"jobid":"j1"}}',
+            '{"queryasyncjobresultresponse":{"jobstatus":0}}',
+            '{"queryasyncjobresultresponse":{"jobstatus":1}}',
+        ]
+        policy = polling.AdaptivePolicy(first_delay=0.2, factor=2)
+        rsp = client.createTags({"resourceids": "vm-1"})
+        client.wait_for_job(rsp["jobid"], policy)
+        self.assertEqual(time.sleep.call_args_list, [mock.call(0.2), mock.call(0.4)])
+        self.assertIn("createTags", policy.durations)
+        self.assertEqual(client.job_commands, {})
+
+    @mock.patch('hm.iaas.cloudstack_client.time')
+    @mock.patch('hm.iaas.cloudstack_client.urllib')
+    def test_wait_for_job_deadline(self, urllib, time):
+        client = cloudstack_client.CloudStack("http://localhost", "api_key", "secret!")
+        urllib.quote_plus.side_effect = lambda x: x
+        urllib.urlopen.return_value.read.return_value = '{"queryasyncjobresultresponse":{"jobstatus":0}}'
+        policy = polling.BackoffPolicy(first_delay=0.25, deadline=0)
+        with self.assertRaises(cloudstack_client.JobDeadlineExceededError) as cm:
+            client.wait_for_job("x", policy)
+        self.assertEqual(cm.exception.job_id, "x")
+        self.assertEqual(urllib.urlopen.call_count, 0)
@@ -0,0 +1,339 @@
+# Copyright 2016 hm authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import itertools
+import threading
+import time
+import unittest
+
+import mock
+
+from hm import journal, lb_managers, managers, model, pool
+from hm.model.host import Host
+from hm.model.load_balancer import LoadBalancer
+from hm.storage import memory
+
+
+class PoolManager(managers.BaseManager):
+
+    ids = itertools.count()
+    lock = threading.Lock()
+
+    def create_host(self, name=None, alternative_id=0):
+        return Host('new-vm', 'new-vm.host', alternative_id=alternative_id)
+
+    def create_pool_host(self, alternative_id=0):
+        with self.lock:
+            id = 'vm-{}'.format(next(self.ids))
+        journal.record('deploy_vm', vm_id=id)
+        return Host(id, id + '.host', alternative_id=alternative_id)
+
+    def claim_pool_host(self, host, name=None):
+        host.claimed_as = name
+        return host
+
+    def destroy_host(self, id):
+        pass
+
+    def rollback_operation(self, operation):
+        for step in operation.steps:
+            self.destroy_host(step['vm_id'])
+
+
+class PoolLBManager(lb_managers.BaseLBManager):
+
+    def create_load_balancer(self, name):
+        return LoadBalancer('new-lb', name, '10.0.0.1')
+
+    def create_pool_load_balancer(self):
+        name = self.pool_name()
+        return LoadBalancer('id-' + name, name, '10.0.0.2')
+
+    def claim_pool_load_balancer(self, lb, name):
+        lb.name = name
+        return lb
+
+    def destroy_load_balancer(self, lb):
+        pass
+
+    def attach_real(self, lb, host):
+        pass
+
+    def detach_real(self, lb, host):
+        pass
+
+    def rollback_operation(self, operation):
+        for step in operation.steps:
+            if step['name'] == 'claim_pool_lb':
+                self.destroy_load_balancer(LoadBalancer.from_dict(step['document']))
+
+
+managers.register('pool', PoolManager)
+lb_managers.register('pool', PoolLBManager)
+
+
+class HostPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        memory.clear()
+        pool.clear()
+        self.conf = {"STORAGE_ENGINE": "memory", "HOST_POOL_SIZE": "2", "HOST_POOL_FILL_INTERVAL": "0",
+                     "HM_ALTERNATIVE_CONFIG_COUNT": "2", "HM_JOURNAL": "true"}
+        self.storage = model.storage(self.conf)
+
+    def tearDown(self):
+        pool.clear()
+        memory.clear()
+
+    def test_host_pool_disabled(self):
+        self.assertIsNone(pool.host_pool('pool', {"STORAGE_ENGINE": "memory"}))
+        self.assertIsNone(pool.host_pool('pool', dict(self.conf, HOST_POOL_SIZE="0")))
+
+    def test_host_pool_is_shared(self):
+        host_pool = pool.host_pool('pool', self.conf)
+        self.assertIsInstance(host_pool, pool.HostPool)
+        self.assertIs(pool.host_pool('pool', dict(self.conf)), host_pool)
+        self.assertIsNot(pool.host_pool('pool', dict(self.conf, HOST_POOL_SIZE="3")), host_pool)
+        self.assertEqual((host_pool.size, host_pool.interval), (2, 0))
+        self.assertIsNone(host_pool._thread)
+
+    def test_fill(self):
+        host_pool = pool.host_pool('pool', self.conf)
+        self.assertEqual(host_pool.fill(), 4)
+        for alternative_id in range(2):
+            filters = {'kind': 'host', 'manager': 'pool', 'alternative_id': alternative_id}
+            self.assertEqual(self.storage.count_pool_items(filters), 2)
+        self.assertEqual(self.storage.list_operations({}), [])
+        self.assertEqual(self.storage.count_pool_items({'reserved': True}), 0)
+        self.assertEqual(host_pool.fill(), 0)
+
+    def test_fill_counts_pending_reservations(self):
+        host_pool = pool.host_pool('pool', dict(self.conf, HM_JOURNAL="false"))
+        now = time.time()
+        for id, fingerprint, created_at in [('r1', host_pool.fingerprint, now), ('r2', 'other', now),
+                                            ('r3', host_pool.fingerprint, now - 7200)]:
+            self.storage.store_pool_item({'_id': id, 'kind': 'host', 'manager': 'pool', 'alternative_id': 1,
+                                          'fingerprint': fingerprint, 'reserved': True,
+                                          'created_at': created_at})
+        self.assertIsNone(host_pool.claim(alternative_id=1))
+        self.assertEqual(host_pool.fill(), 3)
+        self.assertEqual(sorted(id for id in self._pooled_ids() if id.startswith('r')), ['r1', 'r2'])
+        self.assertEqual(self.storage.count_pool_items({'reserved': True}), 2)
+
+    def test_fill_releases_reservations(self):
+        conf = dict(self.conf, HM_ALTERNATIVE_CONFIG_COUNT="1", HOST_POOL_SIZE="1")
+        host_pool = pool.host_pool('pool', conf)
+        reservations = []
+
+        def create_pool_host(alternative_id=0):
+            reservations.append(self.storage.count_pool_items({'reserved': True}))
+            return Host('vm-r', 'vm-r.host', alternative_id=alternative_id)
+        with mock.patch.object(PoolManager, 'create_pool_host', side_effect=create_pool_host):
+            host_pool.fill()
+        self.assertEqual(reservations, [1])
+        self.assertEqual(self.storage.count_pool_items({'reserved': True}), 0)
+
+    def test_items_are_partitioned_by_settings(self):
+        conf = dict(self.conf, HM_ALTERNATIVE_CONFIG_COUNT="1", TEMPLATE="redis")
+        redis_pool = pool.host_pool('pool', conf)
+        self.assertEqual(redis_pool.fill(), 2)
+        mongo_conf = dict(conf, TEMPLATE="mongo")
+        mongo_pool = pool.host_pool('pool', mongo_conf)
+        self.assertNotEqual(mongo_pool.fingerprint, redis_pool.fingerprint)
+        self.assertIsNone(mongo_pool.claim(alternative_id=0))
+        self.assertEqual(Host.create('pool', 'g1', mongo_conf).id, 'new-vm')
+        self.assertTrue(Host.create('pool', 'g1', conf).id.startswith('vm-'))
+        same_pool = pool.host_pool('pool', dict(conf, HOST_POOL_MAX_PARALLEL="1"))
+        self.assertIsNot(same_pool, redis_pool)
+        self.assertEqual(same_pool.fingerprint, redis_pool.fingerprint)
+        self.assertIsNotNone(same_pool.claim(alternative_id=0))
+
+    def test_fill_store_failure_destroys_item(self):
+        conf = dict(self.conf, HM_ALTERNATIVE_CONFIG_COUNT="1", HOST_POOL_SIZE="1")
+        host_pool = pool.host_pool('pool', conf)
+        with mock.patch.object(memory.MemoryStorage, 'store_pool_item', side_effect=self._fail_items):
+            with mock.patch.object(PoolManager, 'destroy_host') as destroy_host:
+                self.assertEqual(host_pool.fill(), 0)
+        self.assertTrue(destroy_host.call_args[0][0].startswith('vm-'))
+        self.assertEqual(self.storage.list_operations({}), [])
+        self.assertEqual(self.storage.count_pool_items({}), 0)
+
+    def test_fill_failure_is_journaled(self):
+        conf = dict(self.conf, HM_ALTERNATIVE_CONFIG_COUNT="1", HOST_POOL_SIZE="1")
+        host_pool = pool.host_pool('pool', conf)
+        with mock.patch.object(memory.MemoryStorage, 'store_pool_item', side_effect=self._fail_items):
+            with mock.patch.object(PoolManager, 'destroy_host', side_effect=Exception("api down")):
+                self.assertEqual(host_pool.fill(), 0)
+        ops = self.storage.list_operations({})
+        self.assertEqual(ops[0]['status'], journal.FAILED)
+        self.assertEqual(journal.resume_or_rollback(self.conf)['resumed'], [ops[0]['_id']])
+        item = self.storage.claim_pool_item({'kind': 'host', 'manager': 'pool', 'alternative_id': 0})
+        self.assertEqual(item['document']['_id'], ops[0]['steps'][0]['vm_id'])
+
+    def test_fill_failure_is_rolled_back(self):
+        conf = dict(self.conf, HM_ALTERNATIVE_CONFIG_COUNT="1", HOST_POOL_SIZE="1")
+        host_pool = pool.host_pool('pool', conf)
+        with mock.patch.object(Host, 'to_json', side_effect=Exception("boom")):
+            self.assertEqual(host_pool.fill(), 0)
+        vm_id = self.storage.list_operations({})[0]['steps'][0]['vm_id']
+        with mock.patch.object(PoolManager, 'destroy_host') as destroy_host:
+            self.assertEqual(len(journal.resume_or_rollback(self.conf)['rolled_back']), 1)
+        destroy_host.assert_called_once_with(vm_id)
+        self.assertEqual(self.storage.count_pool_items({}), 0)
+
+    def test_claim_stats(self):
+        host_pool = pool.host_pool('pool', self.conf)
+        self.assertIsNone(host_pool.claim(alternative_id=0))
+        host_pool.fill()
+        document = host_pool.claim(alternative_id=1)
+        self.assertEqual((document['manager'], document['alternative_id']), ('pool', 1))
+        stats = host_pool.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['hit_rate']), (1, 1, 0.5))
+        self.assertIsNone(stats['last_refill_lag'])
+        self.assertGreaterEqual(stats['refill_pending_for'], 0)
+        host_pool.fill()
+        stats = host_pool.stats()
+        self.assertGreaterEqual(stats['last_refill_lag'], 0)
+        self.assertEqual(stats['max_refill_lag'], stats['last_refill_lag'])
+        self.assertIsNone(stats['refill_pending_for'])
+
+    def test_claim_wakes_filler(self):
+        host_pool = pool.host_pool('pool', dict(self.conf, HOST_POOL_FILL_INTERVAL="60",
+                                                HM_ALTERNATIVE_CONFIG_COUNT="1"))
+        filters = {'kind': 'host', 'manager': 'pool', 'alternative_id': 0}
+        self._wait(lambda: self.storage.count_pool_items(filters) == 2)
+        self.assertIsNotNone(host_pool.claim(alternative_id=0))
+        self._wait(lambda: self.storage.count_pool_items(filters) == 2)
+        self._wait(lambda: host_pool.stats()['last_refill_lag'] is not None)
+
+    def test_host_create_claims_from_pool(self):
+        pool.host_pool('pool', self.conf).fill()
+        host = Host.create('pool', 'g1', self.conf)
+        self.assertTrue(host.id.startswith('vm-'))
+        self.assertEqual(host.claimed_as, 'g1')
+        stored = self.storage.find_host(host.id)
+        self.assertEqual((stored.manager, stored.group), ('pool', 'g1'))
+        self.assertEqual(self.storage.count_pool_items({}), 3)
+        self.assertEqual(self.storage.list_operations({}), [])
+
+    def test_host_create_pool_empty(self):
+        host = Host.create('pool', 'g1', self.conf)
+        self.assertEqual(host.id, 'new-vm')
+        self.assertEqual(pool.host_pool('pool', self.conf).stats()['misses'], 1)
+
+    def test_host_create_claim_failure_destroys_vm(self):
+        conf = dict(self.conf, HM_ALTERNATIVE_CONFIG_COUNT="1", HOST_POOL_SIZE="1", HM_JOURNAL="false")
+        pool.host_pool('pool', conf).fill()
+        pooled_id = self._pooled_ids()[0]
+        with mock.patch.object(PoolManager, 'claim_pool_host', side_effect=Exception("tag failed")), \
+                mock.patch.object(PoolManager, 'destroy_host') as destroy_host:
+            host = Host.create('pool', 'g1', conf)
+        destroy_host.assert_called_once_with(pooled_id)
+        self.assertEqual(host.id, 'new-vm')
+        self.assertEqual([h.id for h in self.storage.list_hosts({})], ['new-vm'])
+        self.assertEqual(self._pooled_ids(), [])
+
+    def test_host_create_claim_failure_returns_vm_to_pool(self):
+        conf = dict(self.conf, HM_ALTERNATIVE_CONFIG_COUNT="1", HOST_POOL_SIZE="1")
+        pool.host_pool('pool', conf).fill()
+        pooled_ids = self._pooled_ids()
+        with mock.patch.object(PoolManager, 'claim_pool_host', side_effect=Exception("tag failed")), \
+                mock.patch.object(PoolManager, 'destroy_host', side_effect=Exception("destroy failed")):
+            self.assertEqual(Host.create('pool', 'g1', conf).id, 'new-vm')
+        self.assertEqual(self._pooled_ids(), pooled_ids)
+        self.assertEqual(self.storage.list_operations({}), [])
+
+    def test_host_create_claim_failure_not_disposed_is_journaled(self):
+        conf = dict(self.conf, HM_ALTERNATIVE_CONFIG_COUNT="1", HOST_POOL_SIZE="1")
+        pool.host_pool('pool', conf).fill()
+        with mock.patch.object(PoolManager, 'claim_pool_host', side_effect=Exception("tag failed")), \
+                mock.patch.object(PoolManager, 'destroy_host', side_effect=Exception("destroy failed")), \
+                mock.patch.object(memory.MemoryStorage, 'store_pool_item', side_effect=Exception("db down")):
+            with self.assertRaises(Exception):
+                Host.create('pool', 'g1', conf)
+        ops = self.storage.list_operations({})
+        self.assertEqual([(op['kind'], op['status']) for op in ops], [('create_host', journal.FAILED)])
+        self.assertEqual(ops[0]['steps'][0]['name'], 'claim_pool_vm')
+
+    def _fail_items(self, doc):
+        if not doc.get('reserved'):
+            raise Exception("db down")
+        memory._pool[doc['_id']] = doc
+
+    def _pooled_ids(self):
+        return [item['_id'] for item in memory._pool.values()]
+
+    def _wait(self, condition, timeout=5):
+        deadline = time.time() + timeout
+        while not condition():
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.01)
+
+
+class LoadBalancerPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        memory.clear()
+        pool.clear()
+        self.conf = {"STORAGE_ENGINE": "memory", "LB_POOL_SIZE": "2", "LB_POOL_FILL_INTERVAL": "0",
+                     "HM_JOURNAL": "true"}
+        self.storage = model.storage(self.conf)
+
+    def tearDown(self):
+        pool.clear()
+        memory.clear()
+
+    def test_load_balancer_pool_disabled(self):
+        self.assertIsNone(pool.load_balancer_pool('pool', {"STORAGE_ENGINE": "memory"}))
+
+    def test_fill(self):
+        lb_pool = pool.load_balancer_pool('pool', self.conf)
+        self.assertIsInstance(lb_pool, pool.LoadBalancerPool)
+        self.assertEqual(lb_pool.fill(), 2)
+        self.assertEqual(self.storage.count_pool_items({'kind': 'load_balancer', 'manager': 'pool'}), 2)
+        self.assertEqual(self.storage.count_pool_items({'kind': 'host'}), 0)
+        self.assertEqual(lb_pool.fill(), 0)
+
+    def test_load_balancer_create_claims_from_pool(self):
+        pool.load_balancer_pool('pool', self.conf).fill()
+        lb = LoadBalancer.create('pool', 'my-lb', self.conf)
+        self.assertTrue(lb.id.startswith('id-hm-pool-'))
+        stored = self.storage.find_load_balancer('my-lb')
+        self.assertEqual((stored.id, stored.address, stored.manager), (lb.id, '10.0.0.2', 'pool'))
+        self.assertEqual(self.storage.count_pool_items({}), 1)
+        self.assertEqual(self.storage.list_operations({}), [])
+
+    def test_load_balancer_create_pool_empty(self):
+        lb = LoadBalancer.create('pool', 'my-lb', self.conf)
+        self.assertEqual(lb.id, 'new-lb')
+        self.assertEqual(pool.load_balancer_pool('pool', self.conf).stats()['misses'], 1)
+
+    def test_load_balancer_name_taken_destroys_claimed(self):
+        pool.load_balancer_pool('pool', self.conf).fill()
+        self.storage.store_load_balancer(LoadBalancer('other', 'my-lb', '10.0.0.3'))
+        with self.assertRaises(Exception):
+            LoadBalancer.create('pool', 'my-lb', self.conf)
+        with mock.patch.object(PoolLBManager, 'destroy_load_balancer') as destroy:
+            self.assertEqual(len(journal.resume_or_rollback(self.conf)['rolled_back']), 1)
+        self.assertTrue(destroy.call_args[0][0].id.startswith('id-hm-pool-'))
+        self.assertEqual(self.storage.find_load_balancer('my-lb').id, 'other')
+
+    def test_load_balancer_claim_failure_destroys_claimed(self):
+        conf = dict(self.conf, LB_POOL_SIZE="1", HM_JOURNAL="false")
+        pool.load_balancer_pool('pool', conf).fill()
+        pooled = list(memory._pool.values())[0]['document']
+        with mock.patch.object(PoolLBManager, 'claim_pool_load_balancer', side_effect=Exception("rename")), \
+                mock.patch.object(PoolLBManager, 'destroy_load_balancer') as destroy:
+            lb = LoadBalancer.create('pool', 'my-lb', conf)
+        self.assertEqual(destroy.call_args[0][0].id, pooled['id'])
+        self.assertEqual(lb.id, 'new-lb')
+        self.assertEqual(self.storage.find_load_balancer('my-lb').id, 'new-lb')
+        self.assertEqual(self.storage.count_pool_items({}), 0)
+
+    def test_load_balancer_items_are_partitioned_by_settings(self):
+        pool.load_balancer_pool('pool', dict(self.conf, VIP_PORT="80")).fill()
+        lb = LoadBalancer.create('pool', 'my-lb', dict(self.conf, VIP_PORT="8080"))
+        self.assertEqual(lb.id, 'new-lb')
+        lb = LoadBalancer.create('pool', 'other-lb', dict(self.conf, VIP_PORT="80"))
+        self.assertTrue(lb.id.startswith('id-hm-pool-'))
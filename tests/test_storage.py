@@ -0,0 +1,119 @@
+# Copyright 2016 hm authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import unittest
+
+import mock
+from bson.raw_bson import RawBSONDocument
+
+from hm import storage, storage_watcher
+
+
+@mock.patch("hm.storage.pymongo.MongoClient")
+class MongoDBStorageRegistryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        storage.reset()
+
+    def tearDown(self):
+        storage.reset()
+
+    def test_storages_share_client(self, MongoClient):
+        stor1 = storage.MongoDBStorage({"MONGO_URI": "mongodb://db1:27017/"})
+        stor2 = storage.MongoDBStorage({"MONGO_URI": "mongodb://db1:27017/"})
+        MongoClient.assert_called_once_with("mongodb://db1:27017/")
+        MongoClient.return_value.__getitem__.assert_called_once_with("host_manager")
+        self.assertIs(stor1.db, stor2.db)
+
+    def test_database_from_uri(self, MongoClient):
+        stor = storage.MongoDBStorage({"MONGO_URI": "mongodb://db1:27017/hm", "MONGO_DATABASE": "other"})
+        self.assertEqual(stor.mongo_database, "hm")
+        MongoClient.return_value.__getitem__.assert_called_once_with("hm")
+
+    def test_keyed_by_uri_and_database(self, MongoClient):
+        stor1 = storage.MongoDBStorage({"MONGO_URI": "mongodb://db1:27017/", "MONGO_DATABASE": "a"})
+        stor2 = storage.MongoDBStorage({"MONGO_URI": "mongodb://db1:27017/", "MONGO_DATABASE": "b"})
+        stor3 = storage.MongoDBStorage({"DBAAS_MONGODB_ENDPOINT": "mongodb://db2:27017/a",
+                                        "MONGO_URI": "mongodb://db1:27017/"})
+        self.assertEqual(MongoClient.call_args_list, [mock.call("mongodb://db1:27017/"),
+                                                      mock.call("mongodb://db2:27017/a")])
+        self.assertEqual(MongoClient.return_value.__getitem__.call_args_list,
+                         [mock.call("a"), mock.call("b"), mock.call("a")])
+        self.assertEqual([stor1.mongo_database, stor2.mongo_database, stor3.mongo_database], ["a", "b", "a"])
+        self.assertEqual(stor3.mongo_uri, "mongodb://db2:27017/a")
+
+    def test_close(self, MongoClient):
+        storage.MongoDBStorage({"MONGO_URI": "mongodb://db1:27017/"})
+        storage.close()
+        MongoClient.return_value.close.assert_called_once_with()
+        storage.MongoDBStorage({"MONGO_URI": "mongodb://db1:27017/"})
+        self.assertEqual(MongoClient.call_count, 2)
+
+    def test_reset(self, MongoClient):
+        storage.MongoDBStorage({"MONGO_URI": "mongodb://db1:27017/"})
+        storage.reset()
+        self.assertFalse(MongoClient.return_value.close.called)
+        storage.MongoDBStorage({"MONGO_URI": "mongodb://db1:27017/"})
+        self.assertEqual(MongoClient.call_count, 2)
+
+    def test_ensure_indexes_opt_in(self, MongoClient):
+        db = MongoClient.return_value.__getitem__.return_value
+        storage.MongoDBStorage({"MONGO_URI": "mongodb://db1:27017/"})
+        self.assertFalse(db.__getitem__.return_value.create_index.called)
+        conf = {"MONGO_URI": "mongodb://db1:27017/", "MONGO_ENSURE_INDEXES": "true"}
+        storage.MongoDBStorage(conf)
+        storage.MongoDBStorage(conf)
+        self.assertEqual(db.__getitem__.return_value.create_index.call_count, 6)
+
+    def test_raw_documents(self, MongoClient):
+        db = MongoClient.return_value.__getitem__.return_value
+        stor = storage.MongoDBStorage({"MONGO_URI": "mongodb://db1:27017/"})
+        self.assertIs(stor._hosts_collection(), db.__getitem__.return_value)
+        stor = storage.MongoDBStorage({"MONGO_URI": "mongodb://db1:27017/", "MONGO_RAW_DOCUMENTS": "true"})
+        self.assertIs(stor._lb_collection(), db.get_collection.return_value)
+        name, kwargs = db.get_collection.call_args
+        self.assertEqual(name, ("load_balancers",))
+        self.assertIs(kwargs["codec_options"].document_class, RawBSONDocument)
+
+    @mock.patch("hm.storage.storage_watcher.CacheWatcher")
+    def test_cache_watcher_opt_in(self, CacheWatcher, MongoClient):
+        conf = {"MONGO_URI": "mongodb://db1:27017/", "MONGO_CACHE_SIZE": "10"}
+        self.assertIsNotNone(storage.MongoDBStorage(conf).cache)
+        self.assertFalse(CacheWatcher.called)
+        storage.reset()
+        conf["MONGO_CACHE_WATCH"] = "true"
+        stor = storage.MongoDBStorage(conf)
+        storage.MongoDBStorage(conf)
+        CacheWatcher.assert_called_once_with(stor.db, stor.cache,
+                                             {"hosts": "host", "load_balancers": "lb"}, 1)
+        CacheWatcher.return_value.start.assert_called_once_with()
+        storage.reset()
+        CacheWatcher.return_value.stop.assert_called_once_with()
+
+    @mock.patch("hm.storage.storage_watcher.CacheWatcher")
+    def test_cache_watcher_start_failure(self, CacheWatcher, MongoClient):
+        conf = {"MONGO_URI": "mongodb://db1:27017/", "MONGO_CACHE_SIZE": "10", "MONGO_CACHE_WATCH": "true"}
+        CacheWatcher.return_value.start.side_effect = Exception("mongo unreachable")
+        with self.assertRaises(Exception):
+            storage.MongoDBStorage(conf)
+        CacheWatcher.return_value.stop.assert_called_once_with()
+        self.assertEqual((storage._caches, storage._watchers), ({}, {}))
+        CacheWatcher.return_value.start.side_effect = None
+        stor = storage.MongoDBStorage(conf)
+        self.assertEqual(CacheWatcher.return_value.start.call_count, 2)
+        self.assertIs(storage.MongoDBStorage(conf).cache, stor.cache)
+
+    @mock.patch("hm.storage.log")
+    @mock.patch("hm.storage.storage_watcher.CacheWatcher")
+    def test_cache_disabled_when_watcher_unavailable(self, CacheWatcher, log, MongoClient):
+        conf = {"MONGO_URI": "mongodb://db1:27017/", "MONGO_CACHE_SIZE": "10", "MONGO_CACHE_WATCH": "true"}
+        CacheWatcher.return_value.start.side_effect = storage_watcher.WatcherUnavailable("standalone")
+        self.assertIsNone(storage.MongoDBStorage(conf).cache)
+        self.assertIsNone(storage.MongoDBStorage(conf).cache)
+        CacheWatcher.return_value.start.assert_called_once_with()
+        CacheWatcher.return_value.stop.assert_called_once_with()
+        self.assertEqual(log.error.call_count, 1)
+        storage.reset()
+        CacheWatcher.return_value.start.side_effect = None
+        self.assertIsNotNone(storage.MongoDBStorage(conf).cache)
@@ -0,0 +1,305 @@
+# Copyright 2016 hm authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import mock
+from pymongo.errors import DuplicateKeyError
+
+from hm import model, storage
+from hm.model.host import Host
+from hm.model.load_balancer import LoadBalancer
+from hm.storage import memory, sqlite
+
+
+class StorageContractMixin(object):
+
+    def test_store_find_remove_host(self):
+        self.storage.store_host(Host('h1', 'h1.com', manager='fake', group='g1', alternative_id=1, extra='x'))
+        h = self.storage.find_host('h1')
+        self.assertEqual((h.id, h.dns_name, h.manager, h.group, h.alternative_id, h.extra),
+                         ('h1', 'h1.com', 'fake', 'g1', 1, 'x'))
+        self.storage.remove_host('h1')
+        self.assertIsNone(self.storage.find_host('h1'))
+
+    def test_store_host_duplicate(self):
+        self.storage.store_host(Host('h1', 'h1.com'))
+        with self.assertRaises(DuplicateKeyError):
+            self.storage.store_host(Host('h1', 'other.com'))
+        self.assertEqual(self.storage.find_host('h1').dns_name, 'h1.com')
+
+    def test_store_hosts_ordered(self):
+        self.storage.store_host(Host('h2', 'h2.com'))
+        with self.assertRaises(storage.BulkStoreError) as cm:
+            self.storage.store_hosts(Host('h{}'.format(i), 'h{}.com'.format(i)) for i in range(1, 5))
+        self.assertEqual(cm.exception.written, 1)
+        self.assertEqual([(e['index'], e['id'], e['code']) for e in cm.exception.errors], [(1, 'h2', 11000)])
+        self.assertItemsEqual([h.id for h in self.storage.list_hosts({})], ['h1', 'h2'])
+
+    def test_store_hosts_unordered(self):
+        self.storage.store_hosts([Host('h2', 'h2.com'), Host('h4', 'h4.com')])
+        with self.assertRaises(storage.BulkStoreError) as cm:
+            self.storage.store_hosts([Host('h{}'.format(i), 'h{}.com'.format(i)) for i in range(1, 6)],
+                                     ordered=False)
+        self.assertEqual(cm.exception.written, 3)
+        self.assertEqual([(e['index'], e['id']) for e in cm.exception.errors], [(1, 'h2'), (3, 'h4')])
+        self.assertItemsEqual([h.id for h in self.storage.list_hosts({})], ['h1', 'h2', 'h3', 'h4', 'h5'])
+
+    def test_remove_hosts(self):
+        self.storage.store_hosts([Host('h1', 'h1.com'), Host('h2', 'h2.com'), Host('h3', 'h3.com')])
+        self.assertEqual(self.storage.remove_hosts(['h1', 'h3', 'missing']), 2)
+        self.assertEqual([h.id for h in self.storage.list_hosts({})], ['h2'])
+        self.assertEqual(self.storage.remove_hosts([]), 0)
+
+    def test_add_hosts_to_load_balancer_keyed_by_id(self):
+        self.storage.store_load_balancer(LoadBalancer('lb-id', 'lb1', '10.0.0.1'))
+        self.storage.add_hosts_to_load_balancer('lb1', [Host('h1', 'h1.com'), Host('h2', 'h2.com')])
+        self.storage.add_host_to_load_balancer('lb1', Host('h1', 'new.com'))
+        self.storage.add_hosts_to_load_balancer('lb1', [Host('h2', 'h2.com'), Host('h3', 'h3.com')])
+        lb = self.storage.find_load_balancer('lb1')
+        self.assertEqual([(h.id, h.dns_name) for h in lb.hosts],
+                         [('h1', 'new.com'), ('h2', 'h2.com'), ('h3', 'h3.com')])
+
+    def test_upsert_load_balancers(self):
+        self.storage.store_load_balancer(LoadBalancer('lb-id', 'lb1', '10.0.0.1', manager='fake'))
+        self.storage.add_host_to_load_balancer('lb1', Host('h1', 'h1.com'))
+        lb1 = LoadBalancer('lb-id', 'lb1', '10.0.0.9', manager='fake')
+        lb1.hosts = [Host('h2', 'h2.com')]
+        self.storage.upsert_load_balancers(iter([lb1, LoadBalancer('lb-id2', 'lb2', '10.0.0.2')]))
+        lb = self.storage.find_load_balancer('lb1')
+        self.assertEqual((lb.address, [h.id for h in lb.hosts]), ('10.0.0.9', ['h2']))
+        lb = self.storage.find_load_balancer('lb2')
+        self.assertEqual((lb.id, lb.address, lb.hosts), ('lb-id2', '10.0.0.2', []))
+
+    def test_list_hosts(self):
+        self.storage.store_hosts([Host('h1', 'h1.com', manager='a', group='g1'),
+                                  Host('h2', 'h2.com', manager='b', group='g1', extra='x'),
+                                  Host('h3', 'h3.com', manager='a', group='g2', extra='x')])
+        self.assertItemsEqual([h.id for h in self.storage.list_hosts({'group': 'g1'})], ['h1', 'h2'])
+        self.assertItemsEqual([h.id for h in self.storage.list_hosts({'manager': 'a', 'extra': 'x'})], ['h3'])
+        self.assertItemsEqual([h.id for h in self.storage.list_hosts({})], ['h1', 'h2', 'h3'])
+        hosts = self.storage.list_hosts({'group': 'g2'}, fields=['group'], lazy=True)
+        h = list(hosts)[0]
+        self.assertEqual((h.id, h.dns_name, h.group), ('h3', 'h3.com', 'g2'))
+        self.assertFalse(hasattr(h, 'extra'))
+
+    def test_list_hosts_filter_operators(self):
+        self.storage.store_hosts([Host('h1', 'h1.com', group='g1', alternative_id=0, tags=['a', 'b']),
+                                  Host('h2', 'h2.com', group='g1', alternative_id=1),
+                                  Host('h3', 'h3.com', group='g2', alternative_id=2, tags=['c'])])
+        ids = lambda filters: sorted(h.id for h in self.storage.list_hosts(filters))
+        self.assertEqual(ids({'_id': {'$in': ['h1', 'h3', 'missing']}}), ['h1', 'h3'])
+        self.assertEqual(ids({'group': {'$ne': 'g1'}}), ['h3'])
+        self.assertEqual(ids({'group': {'$nin': ['g2']}, 'alternative_id': {'$gte': 1}}), ['h2'])
+        self.assertEqual(ids({'alternative_id': {'$gt': 0, '$lt': 2}}), ['h2'])
+        self.assertEqual(ids({'tags': 'a'}), ['h1'])
+        self.assertEqual(ids({'tags': {'$exists': False}}), ['h2'])
+        self.assertEqual(ids({'tags': None}), ['h2'])
+
+    def test_list_load_balancers_dotted_filters(self):
+        self.storage.store_load_balancer(LoadBalancer('lb-id1', 'lb1', '10.0.0.1', manager='fake'))
+        self.storage.store_load_balancer(LoadBalancer('lb-id2', 'lb2', '10.0.0.2', manager='fake'))
+        self.storage.add_hosts_to_load_balancer('lb1', [Host('h1', 'h1.com'), Host('h2', 'h2.com')])
+        self.storage.add_hosts_to_load_balancer('lb2', [Host('h3', 'h3.com')])
+        names = lambda filters: sorted(lb.name for lb in self.storage.list_load_balancers(filters))
+        self.assertEqual(names({'hosts._id': 'h2'}), ['lb1'])
+        self.assertEqual(names({'hosts._id': {'$in': ['h1', 'h3']}}), ['lb1', 'lb2'])
+        self.assertEqual(names({'hosts._id': {'$ne': 'h3'}, 'manager': 'fake'}), ['lb1'])
+        self.assertEqual(names({'_id': {'$in': ['lb2']}}), ['lb2'])
+
+    def test_count_hosts_by_alternative(self):
+        self.storage.store_hosts([Host('h1', 'h1.com', group='g1', alternative_id=0),
+                                  Host('h2', 'h2.com', group='g1', alternative_id=None),
+                                  Host('h3', 'h3.com', group='g1', alternative_id=1),
+                                  Host('h4', 'h4.com', group='g2', alternative_id=1)])
+        self.assertEqual(self.storage.count_hosts_by_alternative('g1'), {0: 2, 1: 1})
+        self.assertEqual(self.storage.count_hosts_by_alternative('g3'), {})
+
+    def test_load_balancer_hosts(self):
+        self.storage.store_load_balancer(LoadBalancer('lb-id', 'lb1', '10.0.0.1', manager='fake'))
+        with self.assertRaises(DuplicateKeyError):
+            self.storage.store_load_balancer(LoadBalancer('lb-id', 'lb1', '10.0.0.1'))
+        self.storage.add_host_to_load_balancer('lb1', Host('h1', 'h1.com'))
+        self.storage.add_hosts_to_load_balancer('lb1', [Host('h2', 'h2.com'), Host('h3', 'h3.com')])
+        self.storage.remove_hosts_from_load_balancer('lb1', [Host('h1', 'h1.com'), Host('h3', 'h3.com')])
+        lb = self.storage.find_load_balancer('lb1')
+        self.assertEqual((lb.id, lb.name, lb.address, lb.manager), ('lb-id', 'lb1', '10.0.0.1', 'fake'))
+        self.assertEqual([(h.id, h.dns_name) for h in lb.hosts], [('h2', 'h2.com')])
+        self.storage.remove_host_from_load_balancer('lb1', Host('h2', 'h2.com'))
+        self.assertEqual(self.storage.find_load_balancer('lb1').hosts, [])
+        self.assertEqual([l.name for l in self.storage.list_load_balancers({'manager': 'fake'})], ['lb1'])
+        self.assertEqual(self.storage.list_load_balancers({'manager': 'other'}), [])
+        self.storage.remove_load_balancer('lb1')
+        self.assertIsNone(self.storage.find_load_balancer('lb1'))
+
+    def test_load_balancer_networks(self):
+        self.storage.store_load_balancer(LoadBalancer('lb-id', 'lb1', '10.0.0.1'))
+        self.storage.add_load_balancer_networks('lb1', ['net1', 'net2'])
+        self.storage.add_load_balancer_networks('lb1', ['net2', 'net3'])
+        self.storage.remove_load_balancer_networks('lb1', ['net1', 'other'])
+        self.assertEqual(self.storage.find_load_balancer('lb1').vip_networks, ['net2', 'net3'])
+        self.storage.add_load_balancer_networks('missing', ['net1'])
+        self.assertIsNone(self.storage.find_load_balancer('missing'))
+
+    def test_operations(self):
+        self.storage.store_operation({'_id': 'op1', 'kind': 'create_host', 'status': 'running', 'steps': []})
+        self.storage.store_operation({'_id': 'op2', 'kind': 'create_host', 'status': 'failed', 'steps': []})
+        self.storage.add_operation_step('op1', {'name': 'deploy_vm', 'vm_id': 'vm-1'}, {'updated_at': 10})
+        self.storage.add_operation_step('op1', {'name': 'deploy_vm', 'vm_id': 'vm-2'})
+        self.storage.remove_operation_step('op1', {'name': 'deploy_vm', 'vm_id': 'vm-1'})
+        self.assertFalse(self.storage.update_operation('op1', {'status': 'recovering'}, {'status': 'failed'}))
+        self.assertTrue(self.storage.update_operation('op1', {'status': 'recovering'}, {'updated_at': 10}))
+        ops = self.storage.list_operations({'status': 'recovering'})
+        self.assertEqual([(op['_id'], op['updated_at'], op['steps']) for op in ops],
+                         [('op1', 10, [{'name': 'deploy_vm', 'vm_id': 'vm-2'}])])
+        self.storage.remove_operation('op1')
+        self.assertEqual([op['_id'] for op in self.storage.list_operations({})], ['op2'])
+        self.assertFalse(self.storage.update_operation('op1', {'status': 'failed'}))
+
+    def test_pool_items(self):
+        self.storage.store_pool_item({'_id': 'vm-2', 'kind': 'host', 'manager': 'fake', 'alternative_id': 0,
+                                      'document': {'_id': 'vm-2'}, 'created_at': 20})
+        self.storage.store_pool_item({'_id': 'vm-1', 'kind': 'host', 'manager': 'fake', 'alternative_id': 0,
+                                      'document': {'_id': 'vm-1'}, 'created_at': 10})
+        self.storage.store_pool_item({'_id': 'vm-3', 'kind': 'host', 'manager': 'fake', 'alternative_id': 1,
+                                      'document': {'_id': 'vm-3'}, 'created_at': 5})
+        with self.assertRaises(DuplicateKeyError):
+            self.storage.store_pool_item({'_id': 'vm-1', 'kind': 'host', 'manager': 'fake', 'created_at': 30})
+        filters = {'kind': 'host', 'manager': 'fake', 'alternative_id': 0}
+        self.assertEqual(self.storage.count_pool_items(filters), 2)
+        self.assertEqual(self.storage.count_pool_items({'kind': 'host', 'manager': 'other'}), 0)
+        self.assertEqual(self.storage.claim_pool_item(filters)['document'], {'_id': 'vm-1'})
+        self.assertEqual(self.storage.claim_pool_item(filters)['_id'], 'vm-2')
+        self.assertIsNone(self.storage.claim_pool_item(filters))
+        self.assertEqual(self.storage.count_pool_items({'kind': 'host'}), 1)
+
+
+class EmulatedFiltersMixin(object):
+    """Engines matching filters in Python must reject the ones they cannot
+    evaluate instead of silently matching nothing."""
+
+    def test_unsupported_filters(self):
+        for filters in [{'group': {'$regex': 'g.*'}}, {'$or': [{'group': 'g1'}]}, {'_id': {'$in': 'h1'}}]:
+            with self.assertRaises(storage.InvalidStorage):
+                self.storage.list_hosts(filters)
+            with self.assertRaises(storage.InvalidStorage):
+                self.storage.list_operations(filters)
+            with self.assertRaises(storage.InvalidStorage):
+                self.storage.count_pool_items(filters)
+
+
+class MemoryStorageTestCase(StorageContractMixin, EmulatedFiltersMixin, unittest.TestCase):
+
+    def setUp(self):
+        memory.clear()
+        self.storage = storage.by_name('memory')
+
+    def tearDown(self):
+        memory.clear()
+
+
+class SQLiteStorageTestCase(StorageContractMixin, EmulatedFiltersMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.storage = storage.by_name('sqlite', {'SQLITE_PATH': ':memory:'})
+
+    def tearDown(self):
+        sqlite.close()
+
+    def test_indexes(self):
+        plan = self.storage.conn.execute(
+            "EXPLAIN QUERY PLAN SELECT document FROM hosts WHERE group_name = ?", ('g1',)).fetchall()
+        self.assertIn('hosts_group', str(plan))
+        plan = self.storage.conn.execute(
+            "EXPLAIN QUERY PLAN SELECT document FROM load_balancers WHERE manager = ?", ('a',)).fetchall()
+        self.assertIn('load_balancers_manager', str(plan))
+
+    def test_shared_connection(self):
+        other = storage.by_name('sqlite', {'SQLITE_PATH': ':memory:'})
+        self.assertIs(other.conn, self.storage.conn)
+
+
+class SQLiteStorageProcessesTestCase(unittest.TestCase):
+    """Uses a second connection to the same file, like another hm process
+    would."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        path = os.path.join(self.dir, 'hm.db')
+        self.storage = storage.by_name('sqlite', {'SQLITE_PATH': path})
+        self.other = sqlite3.connect(path)
+
+    def tearDown(self):
+        self.other.close()
+        sqlite.close()
+        shutil.rmtree(self.dir)
+
+    def test_claim_pool_item_claimed_by_other_process(self):
+        for id, created_at in [('vm-1', 10), ('vm-2', 20)]:
+            self.storage.store_pool_item({'_id': id, 'kind': 'host', 'manager': 'fake',
+                                          'document': {'_id': id}, 'created_at': created_at})
+        select = self.storage._select
+
+        def select_and_race(*args, **kwargs):
+            docs = select(*args, **kwargs)
+            with self.other:
+                self.other.execute("DELETE FROM pool WHERE id = 'vm-1'")
+            return docs
+        with mock.patch.object(self.storage, '_select', side_effect=select_and_race):
+            self.assertEqual(self.storage.claim_pool_item({'kind': 'host'})['_id'], 'vm-2')
+        self.assertIsNone(self.storage.claim_pool_item({'kind': 'host'}))
+
+    def test_update_operation_changed_by_other_process(self):
+        self.storage.store_operation({'_id': 'op1', 'status': 'failed', 'steps': []})
+        recovering = json.dumps({'_id': 'op1', 'status': 'recovering', 'steps': []})
+        calls = []
+
+        def matches_and_race(document, filters):
+            calls.append(document['status'])
+            if len(calls) == 1:
+                with self.other:
+                    self.other.execute("UPDATE operations SET document = ? WHERE id = 'op1'", (recovering,))
+            return storage.matches(document, filters)
+        with mock.patch.object(sqlite, 'matches', side_effect=matches_and_race):
+            updated = self.storage.update_operation('op1', {'status': 'recovering'}, {'status': 'failed'})
+        self.assertFalse(updated)
+        self.assertEqual(calls, ['failed', 'recovering'])
+
+    def test_update_load_balancer_changed_by_other_process(self):
+        self.storage.store_load_balancer(LoadBalancer('lb1', 'my-lb', '10.0.0.1'))
+        calls = []
+
+        def add_to_set_and_race(current, values):
+            calls.append(list(current))
+            if len(calls) == 1:
+                row = self.other.execute("SELECT document FROM load_balancers WHERE name = 'my-lb'")
+                doc = json.loads(row.fetchone()[0])
+                doc['vip_networks'] = ['net-2']
+                with self.other:
+                    self.other.execute("UPDATE load_balancers SET document = ? WHERE name = 'my-lb'",
+                                       (json.dumps(doc),))
+            return current + [v for v in values if v not in current]
+        with mock.patch.object(sqlite, 'add_to_set', side_effect=add_to_set_and_race):
+            self.storage.add_load_balancer_networks('my-lb', ['net-1'])
+        self.assertEqual(calls, [[], ['net-2']])
+        self.assertEqual(self.storage.find_load_balancer('my-lb').vip_networks, ['net-2', 'net-1'])
+
+
+class StorageRegistryTestCase(unittest.TestCase):
+
+    def test_from_config(self):
+        self.assertIsInstance(storage.from_config({}), storage.MongoDBStorage)
+        self.assertIsInstance(model.storage({'STORAGE_ENGINE': 'memory'}), memory.MemoryStorage)
+        self.assertIsInstance(storage.from_config({'STORAGE_ENGINE': 'sqlite', 'SQLITE_PATH': ':memory:'}),
+                              sqlite.SQLiteStorage)
+        sqlite.close()
+
+    def test_register_invalid(self):
+        with self.assertRaises(storage.InvalidStorage):
+            storage.register('invalid', object)
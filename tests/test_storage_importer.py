@@ -0,0 +1,58 @@
+# Copyright 2016 hm authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import json
+import unittest
+
+import mock
+
+from hm import storage
+from hm.model.host import Host
+from hm.storage import importer, memory
+
+
+def dump(*docs):
+    return [json.dumps(doc) + "\n" for doc in docs]
+
+
+class ImportJSONLTestCase(unittest.TestCase):
+
+    def setUp(self):
+        memory.clear()
+        self.conf = {"STORAGE_ENGINE": "memory"}
+        self.storage = storage.from_config(self.conf)
+
+    def tearDown(self):
+        memory.clear()
+
+    def test_import_in_batches(self):
+        lines = dump(*[{"host": {"_id": "h{}".format(i), "dns_name": "h{}.com".format(i)}} for i in range(5)])
+        lines += ["\n"] + dump({"load_balancer": {"_id": "lb1", "id": "lb-id", "address": "10.0.0.1",
+                                                  "hosts": [{"_id": "h1", "dns_name": "h1.com"}]}})
+        with mock.patch.object(memory.MemoryStorage, "store_hosts", autospec=True,
+                               side_effect=memory.MemoryStorage.store_hosts) as store_hosts:
+            result = importer.import_jsonl(iter(lines), batch_size=2, conf=self.conf)
+        self.assertEqual([len(call[0][1]) for call in store_hosts.call_args_list], [2, 2, 1])
+        self.assertEqual((result.hosts, result.load_balancers, result.errors), (5, 1, []))
+        self.assertEqual(len(self.storage.list_hosts({})), 5)
+        self.assertEqual([h.id for h in self.storage.find_load_balancer("lb1").hosts], ["h1"])
+
+    def test_import_reports_errors(self):
+        self.storage.store_host(Host("h1", "h1.com"))
+        lines = dump({"host": {"_id": "h0", "dns_name": "h0.com"}},
+                     {"host": {"_id": "h1", "dns_name": "h1.com"}},
+                     {"other": {}},
+                     {"host": {"_id": "h2", "dns_name": "h2.com"}})
+        result = importer.import_jsonl(lines, batch_size=10, conf=self.conf)
+        self.assertEqual(result.hosts, 2)
+        self.assertEqual([(e["line"], e["id"]) for e in result.errors], [(3, None), (2, "h1")])
+        self.assertItemsEqual([h.id for h in self.storage.list_hosts({})], ["h0", "h1", "h2"])
+
+    def test_import_ordered_stops_at_first_error(self):
+        self.storage.store_host(Host("h1", "h1.com"))
+        lines = dump(*[{"host": {"_id": "h{}".format(i), "dns_name": "h{}.com".format(i)}} for i in range(4)])
+        result = importer.import_jsonl(lines, batch_size=2, ordered=True, conf=self.conf)
+        self.assertEqual(result.hosts, 1)
+        self.assertEqual([(e["line"], e["id"]) for e in result.errors], [(2, "h1")])
+        self.assertItemsEqual([h.id for h in self.storage.list_hosts({})], ["h0", "h1"])
@@ -0,0 +1,113 @@
+# Copyright 2016 hm authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import threading
+import unittest
+
+import mock
+from bson.timestamp import Timestamp
+from pymongo.collection import Collection
+
+from hm import cache, storage_watcher
+
+
+class OplogWatcherTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.db = mock.MagicMock()
+        self.db.name = "hm"
+        self.db.__getitem__.return_value = mock.Mock(spec=Collection)
+        self.oplog = self.db.client.local.__getitem__.return_value
+        self.cache = cache.LRUCache(10, 60)
+        self.watcher = storage_watcher.CacheWatcher(
+            self.db, self.cache, {"hosts": "host", "load_balancers": "lb"})
+        self.watcher.last_ts = Timestamp(100, 1)
+        self.oplog.find_one.return_value = {"ts": Timestamp(90, 1)}
+        self.db.client.admin.command.return_value = {"ismaster": True, "setName": "rs0"}
+        self.db.client.local.collection_names.return_value = ["oplog.rs"]
+
+    def test_uses_oplog_without_change_streams(self):
+        self.assertFalse(self.watcher.use_change_streams)
+
+    def test_poll_invalidates_changed_documents(self):
+        for key in [("host", "h1"), ("host", "h2"), ("lb", "lb1"), ("host", "h3")]:
+            self.cache.set(key, {})
+        self.oplog.find.return_value = [
+            {"ts": Timestamp(101, 1), "ns": "hm.hosts", "op": "i", "o": {"_id": "h1"}},
+            {"ts": Timestamp(102, 1), "ns": "hm.hosts", "op": "u", "o": {"$set": {"a": 1}},
+             "o2": {"_id": "h2"}},
+            {"ts": Timestamp(103, 1), "ns": "hm.load_balancers", "op": "d", "o": {"_id": "lb1"}},
+        ]
+        self.watcher.poll()
+        query = self.oplog.find.call_args[0][0]
+        self.assertEqual(query["ts"], {"$gt": Timestamp(100, 1)})
+        self.assertItemsEqual(query["ns"]["$in"], ["hm.hosts", "hm.load_balancers"])
+        self.assertEqual([self.cache.get(k)[0] for k in [("host", "h1"), ("host", "h2"), ("lb", "lb1")]],
+                         [None, None, None])
+        self.assertEqual(self.cache.get(("host", "h3"))[0], {})
+        self.assertEqual(self.watcher.last_ts, Timestamp(103, 1))
+
+    def test_poll_clears_cache_on_commands(self):
+        self.cache.set(("host", "h1"), {})
+        self.oplog.find.return_value = [
+            {"ts": Timestamp(101, 1), "ns": "hm.hosts", "op": "c", "o": {"drop": "hosts"}},
+        ]
+        self.watcher.poll()
+        self.assertEqual(self.cache.get(("host", "h1"))[0], None)
+
+    def test_poll_clears_cache_when_oplog_rolled_over(self):
+        self.cache.set(("host", "h1"), {})
+        self.oplog.find_one.return_value = {"ts": Timestamp(200, 1)}
+        self.oplog.find.return_value = []
+        self.watcher.poll()
+        self.assertEqual(self.cache.get(("host", "h1"))[0], None)
+
+    def test_start_reads_latest_timestamp(self):
+        self.oplog.find_one.return_value = {"ts": Timestamp(300, 1)}
+        watcher = storage_watcher.CacheWatcher(self.db, self.cache, {"hosts": "host"}, interval=60)
+        watcher.start()
+        watcher.stop()
+        self.assertEqual(watcher.last_ts, Timestamp(300, 1))
+        self.db.client.admin.command.assert_called_once_with("ismaster")
+
+    def test_start_requires_replica_set(self):
+        self.db.client.admin.command.return_value = {"ismaster": True}
+        with self.assertRaises(storage_watcher.WatcherUnavailable):
+            self.watcher.start()
+        self.db.client.admin.command.return_value = {"ismaster": True, "msg": "isdbgrid"}
+        with self.assertRaises(storage_watcher.WatcherUnavailable):
+            self.watcher.start()
+        self.assertFalse(self.oplog.find_one.called)
+
+    def test_start_requires_oplog(self):
+        self.db.client.local.collection_names.return_value = []
+        with self.assertRaises(storage_watcher.WatcherUnavailable) as cm:
+            self.watcher.start()
+        self.assertEqual(str(cm.exception), "local.oplog.rs not found")
+
+
+class ChangeStreamWatcherTestCase(unittest.TestCase):
+
+    def test_change_streams_invalidate_documents(self):
+        done = threading.Event()
+        changes = [{"operationType": "update", "documentKey": {"_id": "h1"}}]
+
+        def stream():
+            for change in changes:
+                yield change
+            done.set()
+            threading.Event().wait()
+        collection = mock.MagicMock()
+        collection.watch.return_value.__enter__.return_value = stream()
+        db = mock.MagicMock()
+        db.__getitem__.return_value = collection
+        db.client.admin.command.return_value = {"ismaster": True, "msg": "isdbgrid"}
+        documents = cache.LRUCache(10, 60)
+        documents.set(("host", "h1"), {})
+        watcher = storage_watcher.CacheWatcher(db, documents, {"hosts": "host"})
+        self.assertTrue(watcher.use_change_streams)
+        watcher.start()
+        self.assertTrue(done.wait(5))
+        watcher.stop()
+        self.assertEqual(documents.get(("host", "h1"))[0], None)
@@ -0,0 +1,173 @@
+# Copyright 2016 hm authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import BaseHTTPServer
+import errno
+import httplib
+import socket
+import SocketServer
+import threading
+import unittest
+
+import mock
+
+from hm.iaas import cloudstack_client, transport
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    wbufsize = -1
+
+    def do_GET(self):
+        self.server.paths.append(self.path)
+        body = '{"listvirtualmachinesresponse": {"count": 0}}'
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        if "close=1" in self.path:
+            self.close_connection = 1
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), StubHandler)
+        self.paths = []
+        self.connections = 0
+        self.closed = threading.Event()
+
+    def process_request(self, request, client_address):
+        self.connections += 1
+        SocketServer.ThreadingMixIn.process_request(self, request, client_address)
+
+    def shutdown_request(self, request):
+        BaseHTTPServer.HTTPServer.shutdown_request(self, request)
+        self.closed.set()
+
+
+class PooledTransportTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubServer()
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.01,))
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = "http://127.0.0.1:{}/client/api".format(self.server.server_address[1])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        transport.close_transports()
+
+    def test_get_reuses_connection(self):
+        pooled = transport.PooledTransport()
+        for i in range(5):
+            data = pooled.get(self.url + "?command=listVirtualMachines&i={}".format(i))
+            self.assertEqual(data, '{"listvirtualmachinesresponse": {"count": 0}}')
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(self.server.paths[-1], "/client/api?command=listVirtualMachines&i=4")
+        pooled.close()
+
+    def test_get_discards_idle_connections(self):
+        pooled = transport.PooledTransport(idle_timeout=0)
+        with mock.patch("hm.iaas.transport.time") as time_mock:
+            time_mock.time.side_effect = [10, 10, 11, 11]
+            pooled.get(self.url)
+            pooled.get(self.url)
+        self.assertEqual(self.server.connections, 2)
+        pooled.close()
+
+    def test_get_discards_connection_closed_by_server(self):
+        pooled = transport.PooledTransport()
+        pooled.get(self.url + "?close=1")
+        self.assertTrue(self.server.closed.wait(5))
+        pooled.get(self.url)
+        self.assertEqual(self.server.connections, 2)
+        pooled.close()
+
+    def test_get_retries_stale_connection_reset_while_sending(self):
+        stale = self._pooled_connection()
+        stale.request.side_effect = socket.error(errno.ECONNRESET, "Connection reset by peer")
+        data = self._pooled_get(stale)
+        self.assertEqual(data, '{"listvirtualmachinesresponse": {"count": 0}}')
+        self.assertEqual(self.server.connections, 1)
+        stale.close.assert_called_once_with()
+
+    def test_get_retries_stale_connection_closed_without_response(self):
+        stale = self._pooled_connection()
+        stale.getresponse.side_effect = httplib.BadStatusLine("''")
+        data = self._pooled_get(stale)
+        self.assertEqual(data, '{"listvirtualmachinesresponse": {"count": 0}}')
+        self.assertEqual(self.server.connections, 1)
+
+    def test_get_does_not_retry_timeouts(self):
+        stale = self._pooled_connection()
+        stale.getresponse.side_effect = socket.timeout("timed out")
+        with self.assertRaises(socket.timeout):
+            self._pooled_get(stale)
+        stale.request.side_effect = socket.timeout("timed out")
+        with self.assertRaises(socket.timeout):
+            self._pooled_get(stale)
+        self.assertEqual(self.server.connections, 0)
+
+    def test_get_does_not_retry_errors_after_sending(self):
+        stale = self._pooled_connection()
+        stale.getresponse.side_effect = socket.error(errno.ECONNRESET, "Connection reset by peer")
+        with self.assertRaises(socket.error):
+            self._pooled_get(stale)
+        stale.getresponse.side_effect = httplib.BadStatusLine("HTTP/1.1 50")
+        with self.assertRaises(httplib.BadStatusLine):
+            self._pooled_get(stale)
+        self.assertEqual(self.server.connections, 0)
+        self.assertEqual(stale.request.call_count, 2)
+
+    def test_get_does_not_retry_new_connections(self):
+        pooled = transport.PooledTransport()
+        conn = self._pooled_connection()
+        conn.request.side_effect = socket.error(errno.ECONNRESET, "Connection reset by peer")
+        with mock.patch.object(pooled, "_new_connection", return_value=conn):
+            with self.assertRaises(socket.error):
+                pooled.get(self.url)
+        self.assertEqual(conn.request.call_count, 1)
+
+    def _pooled_connection(self):
+        conn = mock.Mock()
+        conn.sock = None
+        return conn
+
+    def _pooled_get(self, conn):
+        pooled = transport.PooledTransport()
+        with mock.patch.object(pooled, "_acquire", return_value=(conn, True)):
+            try:
+                return pooled.get(self.url)
+            finally:
+                pooled.close()
+
+    def test_client_uses_transport(self):
+        pooled = transport.PooledTransport()
+        client = cloudstack_client.CloudStack(self.url, "api_key", "secret!", pooled)
+        rsp = client.listVirtualMachines({"id": "vm-1"})
+        self.assertEqual(rsp, {"count": 0})
+        client.listVirtualMachines({"id": "vm-2"})
+        self.assertEqual(self.server.connections, 1)
+        pooled.close()
+
+    def test_get_transport_shared(self):
+        conf = {"CLOUDSTACK_HTTP_POOL_SIZE": "3", "CLOUDSTACK_HTTP_IDLE_TIMEOUT": "5",
+                "CLOUDSTACK_HTTP_TIMEOUT": "20"}
+        pooled = transport.get_transport(conf)
+        self.assertIs(pooled, transport.get_transport(dict(conf)))
+        self.assertEqual(pooled.pool_size, 3)
+        self.assertEqual(pooled.idle_timeout, 5)
+        self.assertEqual(pooled.timeout, 20)
+        self.assertIsNot(pooled, transport.get_transport())
+
+    def test_get_transport_disabled(self):
+        self.assertIsNone(transport.get_transport({"CLOUDSTACK_HTTP_POOL_SIZE": "0"}))